@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.backend.context import current_context
+from src.backend.resilience import LatencyTracker
+
+# --- Admission Control for Agent Runs ---
+# /run 系のエンドポイントに、グラフ種別ごとの同時実行数の上限と、優先度付きの有限な待ち行列を設けます。
+# - 上限に空きがあれば即座に実行し、無ければ優先度順（同じ優先度なら到着順）に待たせる
+# - 待ち行列が満杯、または待ち時間が上限を超えた場合は 503 と Retry-After を返して負荷を落とす
+# - 待機はイベントループ上で行うため、待っているリクエストがスレッドプールを占有しない
+# 優先度: HITL の承認 > 通常の請求書 > 高額・大量の請求書（バルク）
+# 環境変数:
+#   ADMISSION_MAX_INFLIGHT: グラフ種別ごとの同時実行数 (デフォルト 4)。ADMISSION_MAX_INFLIGHT_SECURE のように個別指定も可
+#   ADMISSION_MAX_QUEUE: グラフ種別ごとの待ち行列の長さ (デフォルト 32)
+#   ADMISSION_MAX_WAIT: 待ち時間の上限秒数 (デフォルト 30)
+#   ADMISSION_BULK_AMOUNT: この金額以上を含む請求書はバルク扱い (デフォルト 1000000)
+#   ADMISSION_BULK_CHARS: この文字数以上の請求書はバルク扱い (デフォルト 4000)
+
+PRIORITY_APPROVAL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_APPROVAL: "approval",
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BULK: "bulk",
+}
+
+_AMOUNT_PATTERN = re.compile(r"\d{1,3}(?:,\d{3})+|\d{4,}")
+
+
+def invoice_priority(invoice_text: Optional[str], hint: Optional[str] = None) -> int:
+    """請求書の内容（金額・長さ）と X-Priority ヘッダから優先度を決めます。"""
+    if hint == "bulk":
+        return PRIORITY_BULK
+    text = invoice_text or ""
+    if len(text) >= int(os.getenv("ADMISSION_BULK_CHARS", "4000")):
+        return PRIORITY_BULK
+    amounts = [int(m.replace(",", "")) for m in _AMOUNT_PATTERN.findall(text)]
+    if amounts and max(amounts) >= int(os.getenv("ADMISSION_BULK_AMOUNT", "1000000")):
+        return PRIORITY_BULK
+    return PRIORITY_INTERACTIVE
+
+
+class OverloadedError(Exception):
+    """同時実行数と待ち行列が埋まっているため、リクエストを受け付けなかったことを示します。"""
+
+    def __init__(self, graph: str, retry_after: float, reason: str):
+        super().__init__(f"Server is busy ({graph}: {reason}). Retry after {retry_after:.0f}s.")
+        self.graph = graph
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class _GraphGate:
+    def __init__(self, graph: str, max_inflight: int, max_queue: int):
+        self.graph = graph
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self.wait_times = LatencyTracker()
+        self.service_times = LatencyTracker()
+        self.counters: Dict[str, int] = {"admitted": 0, "queued": 0, "rejected": 0, "timeouts": 0}
+        self.admitted_by_priority: Dict[str, int] = {name: 0 for name in PRIORITY_NAMES.values()}
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, f in self._waiters if not f.done())
+
+    def retry_after(self) -> float:
+        # 平均処理時間 × (待ち行列を捌くのに必要な周回数) で再試行までの目安を出す
+        service = self.service_times.percentile(0.5) or 1.0
+        rounds = math.ceil((self.queue_depth + 1) / max(self.max_inflight, 1))
+        return max(service * rounds, 1.0)
+
+    async def acquire(self, priority: int, max_wait: float) -> None:
+        if self.in_flight < self.max_inflight and self.queue_depth == 0:
+            self.in_flight += 1
+            return
+        if self.queue_depth >= self.max_queue:
+            self.counters["rejected"] += 1
+            raise OverloadedError(self.graph, self.retry_after(), "queue full")
+
+        self.counters["queued"] += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        try:
+            # 枠は release() から直接引き渡される（in_flight はそちらで加算済み）
+            await asyncio.wait_for(asyncio.shield(future), timeout=max_wait)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # タイムアウトと同時に枠を受け取っていた場合はそのまま実行する
+                return
+            future.cancel()
+            self.counters["timeouts"] += 1
+            raise OverloadedError(self.graph, self.retry_after(), "queue wait timeout")
+        except asyncio.CancelledError:
+            # クライアント切断などで待機が中断された場合、受け取り済みの枠は次へ回す
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+
+    def release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        p50 = self.wait_times.percentile(0.5)
+        p95 = self.wait_times.percentile(0.95)
+        return {
+            "max_inflight": self.max_inflight,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "wait_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "wait_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            **self.counters,
+            "admitted_by_priority": dict(self.admitted_by_priority),
+        }
+
+
+class AdmissionController:
+    def __init__(self, max_inflight: Optional[int] = None, max_queue: Optional[int] = None, max_wait: Optional[float] = None):
+        self.max_inflight = max_inflight or int(os.getenv("ADMISSION_MAX_INFLIGHT", "4"))
+        self.max_queue = max_queue or int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+        self.max_wait = max_wait or float(os.getenv("ADMISSION_MAX_WAIT", "30"))
+        self._gates: Dict[str, _GraphGate] = {}
+
+    def gate(self, graph: str) -> _GraphGate:
+        gate = self._gates.get(graph)
+        if gate is None:
+            limit = int(os.getenv(f"ADMISSION_MAX_INFLIGHT_{graph.upper()}", str(self.max_inflight)))
+            gate = self._gates[graph] = _GraphGate(graph, limit, self.max_queue)
+        return gate
+
+    @asynccontextmanager
+    async def slot(self, graph: str, priority: int = PRIORITY_INTERACTIVE):
+        """グラフ種別 graph の実行枠を1つ確保します。確保できなければ OverloadedError を送出します。"""
+        gate = self.gate(graph)
+        queued_at = time.monotonic()
+        # リクエストのデッドラインより長くは待たない（過ぎた場合は DeadlineExceeded）
+        ctx = current_context()
+        try:
+            await gate.acquire(priority, ctx.clip(self.max_wait))
+        except OverloadedError:
+            ctx.check()
+            raise
+        started = time.monotonic()
+        gate.wait_times.record(started - queued_at)
+        gate.counters["admitted"] += 1
+        gate.admitted_by_priority[PRIORITY_NAMES.get(priority, str(priority))] += 1
+        try:
+            yield
+        finally:
+            gate.service_times.record(time.monotonic() - started)
+            gate.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_wait": self.max_wait,
+            "graphs": {name: gate.stats() for name, gate in self._gates.items()},
+        }
+
+
+admission = AdmissionController()
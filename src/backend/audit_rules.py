@@ -0,0 +1,107 @@
+import math
+from typing import Dict, Optional, Tuple
+
+from src.backend.ledger_analytics import LedgerAnalytics
+
+# --- Audit Rules ---
+# 銀行ログの監査ルールとしきい値をまとめたものです。
+# 稼働中の監査（MockBank.audit_logs）と、記録済みの操作を再生する what-if 監査（replay.py）が同じ実装を使います。
+# ルール:
+#   1. BLACKLIST_HIT: ログに blacklist の文字列を含む
+#   2. AMOUNT_ANOMALY: amount_threshold を超える送金
+#   3. 統計的異常（LedgerAnalytics）: z-score / 送金速度 / 口座変更直後の送金
+
+
+# 数値パラメータの型と範囲: (整数のみか, 下限, 下限を含むか, 上限)
+# window は取引先ごとのリングバッファの長さになるため上限を設ける
+_NUMERIC_PARAMS = {
+    "amount_threshold": (True, 0, True, None),
+    "window": (True, 1, True, 10000),
+    "min_history": (True, 1, True, 10000),
+    "zscore_threshold": (False, 0, False, None),
+    "velocity_window": (False, 0, False, None),
+    "velocity_limit": (False, 0, True, None),
+}
+
+
+def _check_number(name: str, value: object) -> None:
+    integer, low, inclusive, high = _NUMERIC_PARAMS[name]
+    if isinstance(value, bool) or not isinstance(value, (int, float) if not integer else int):
+        raise ValueError(f"{name} must be {'an integer' if integer else 'a number'}")
+    if not math.isfinite(value) or value < low or (value == low and not inclusive) or (high is not None and value > high):
+        bounds = f"{'>=' if inclusive else '>'} {low}" + (f" and <= {high}" if high is not None else "")
+        raise ValueError(f"{name} must be {bounds}")
+
+
+class AuditRules:
+    PARAMS = (
+        "amount_threshold", "blacklist", "window", "min_history",
+        "zscore_threshold", "velocity_window", "velocity_limit",
+    )
+
+    def __init__(
+        self,
+        amount_threshold: int = 10000,
+        blacklist: Tuple[str, ...] = ("MAINTENANCE-999", "HACKER"),
+        window: int = 20,
+        min_history: int = 3,
+        zscore_threshold: float = 3.0,
+        velocity_window: float = 3600.0,
+        velocity_limit: float = 100000.0,
+    ):
+        # 型・範囲の誤り（window=0、負のしきい値、文字列など）は ValueError（/audit/replay では 400）
+        for name, value in (
+            ("amount_threshold", amount_threshold), ("window", window), ("min_history", min_history),
+            ("zscore_threshold", zscore_threshold), ("velocity_window", velocity_window), ("velocity_limit", velocity_limit),
+        ):
+            _check_number(name, value)
+        if isinstance(blacklist, str) or not isinstance(blacklist, (list, tuple)) or not all(
+            isinstance(item, str) and item for item in blacklist
+        ):
+            raise ValueError("blacklist must be a list of non-empty strings")
+        self.amount_threshold = amount_threshold
+        self.blacklist = tuple(blacklist)
+        self.window = window
+        self.min_history = min_history
+        self.zscore_threshold = zscore_threshold
+        self.velocity_window = velocity_window
+        self.velocity_limit = velocity_limit
+
+    def with_overrides(self, **overrides) -> "AuditRules":
+        """一部のしきい値だけを変えたルールを返します（未知のパラメータ・型や範囲の誤りは ValueError）。"""
+        unknown = [k for k in overrides if k not in self.PARAMS]
+        if unknown:
+            raise ValueError(f"Unknown audit rule parameters: {', '.join(unknown)}")
+        params = self.to_dict()
+        params.update({k: v for k, v in overrides.items() if v is not None})
+        return AuditRules(**params)
+
+    def to_dict(self) -> Dict[str, object]:
+        return {name: getattr(self, name) for name in self.PARAMS}
+
+    def analytics(self) -> LedgerAnalytics:
+        return LedgerAnalytics(
+            window=self.window,
+            min_history=self.min_history,
+            zscore_threshold=self.zscore_threshold,
+            velocity_window=self.velocity_window,
+            velocity_limit=self.velocity_limit,
+        )
+
+    def scan_line(self, log: str) -> Optional[Dict[str, str]]:
+        """ログ1行に対する文字列ルール（ブラックリスト・金額）を評価します。"""
+        # Check 1: Blacklist
+        if any(item in log for item in self.blacklist):
+            return {"type": "BLACKLIST_HIT", "log": log, "severity": "HIGH"}
+
+        # Check 2: Amount anomaly (Heuristic)
+        # ログの文字列から "Sent X,XXX JPY" を簡易パース
+        if "Sent" in log and "JPY" in log:
+            try:
+                parts = log.split("Sent ")[1].split(" JPY")[0]
+                amount = int(parts.replace(",", ""))
+                if amount > self.amount_threshold:
+                    return {"type": "AMOUNT_ANOMALY", "log": log, "severity": "MEDIUM", "details": f"Amount {amount:,} > {self.amount_threshold:,}"}
+            except (IndexError, ValueError):
+                pass
+        return None
@@ -0,0 +1,197 @@
+import hashlib
+import threading
+import weakref
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import ormsgpack
+from langchain_core.messages import BaseMessage
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+# --- Content-addressed Checkpoint Storage ---
+# チェックポイントに保存されるメッセージのリストを、内容のハッシュ（sha256）で共有される断片に分けて保存します。
+# - 長いメッセージ本文（請求書テキストなど）は本文単位で1度だけ保持する（メッセージIDが異なっても共有される）
+# - 本文を除いたメッセージ自体も、同じ内容なら1度だけ保持する
+# - チャネルの値には、メッセージのダイジェストの並びだけを保存する
+# 同じ請求書テンプレートを何千回処理しても、メモリ使用量は実行回数ではなく「異なる内容の数」に比例します。
+# スレッド削除時には、どのチェックポイントからも参照されなくなった断片を回収します（マーク＆スイープ）。
+
+DEDUP_TYPE = "dedup_messages"
+
+# これより短い本文はメッセージと一緒に保存する（ダイジェストの方が大きくなるため）
+INTERN_MIN_CHARS = 64
+
+
+def _digest(*parts: bytes) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part)
+    return h.hexdigest()
+
+
+class ContentStore:
+    """ダイジェスト → 内容 の共有ストア。複数の Saver（secure / HITL）から共有されます。"""
+
+    def __init__(self):
+        self._contents: Dict[str, str] = {}
+        self._messages: Dict[str, Tuple[str, bytes, Optional[str]]] = {}
+        self._savers: "weakref.WeakSet[DedupMemorySaver]" = weakref.WeakSet()
+        self._lock = threading.Lock()
+        # 断片ごとの最終書き込み世代。シリアライズ済みでまだ Saver に格納されていない断片を誤って回収しないよう、
+        # 直前のコンパクション以降に書き込まれた断片は次の回まで回収を見送る
+        self._epoch = 0
+        self._touched: Dict[str, int] = {}
+        self.logical_bytes = 0  # 共有しなかった場合に保存されていたはずのバイト数（累計）
+
+    def register(self, saver: "DedupMemorySaver") -> None:
+        self._savers.add(saver)
+
+    def put_content(self, content: str) -> str:
+        encoded = content.encode("utf-8")
+        digest = _digest(encoded)
+        with self._lock:
+            self._contents.setdefault(digest, content)
+            self._touched[digest] = self._epoch
+            self.logical_bytes += len(encoded)
+        return digest
+
+    def put_message(self, type_: str, data: bytes, content_digest: Optional[str]) -> str:
+        digest = _digest(type_.encode(), b"\0", data, b"\0", (content_digest or "").encode())
+        with self._lock:
+            self._messages.setdefault(digest, (type_, data, content_digest))
+            self._touched[digest] = self._epoch
+            self.logical_bytes += len(data)
+        return digest
+
+    def get_message(self, digest: str) -> Tuple[str, bytes, Optional[str]]:
+        with self._lock:
+            return self._messages[digest]
+
+    def get_content(self, digest: str) -> str:
+        with self._lock:
+            return self._contents[digest]
+
+    def compact(self) -> Dict[str, int]:
+        """登録済みの Saver から参照されている断片（と直近に書き込まれた断片）だけを残します。"""
+        with self._lock:
+            self._epoch += 1
+            cutoff = self._epoch - 1
+        live: set = set()
+        for saver in list(self._savers):
+            for data in saver.iter_serialized():
+                if data[0] == DEDUP_TYPE:
+                    live.update(ormsgpack.unpackb(data[1]))
+        with self._lock:
+            dead_messages = [d for d in self._messages if d not in live and self._touched[d] < cutoff]
+            for d in dead_messages:
+                del self._messages[d]
+                del self._touched[d]
+            live_contents = {entry[2] for entry in self._messages.values() if entry[2] is not None}
+            dead_contents = [d for d in self._contents if d not in live_contents and self._touched[d] < cutoff]
+            for d in dead_contents:
+                del self._contents[d]
+                del self._touched[d]
+        return {"messages_removed": len(dead_messages), "contents_removed": len(dead_contents)}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stored = sum(len(c.encode("utf-8")) for c in self._contents.values())
+            stored += sum(len(m[1]) for m in self._messages.values())
+            return {
+                "unique_messages": len(self._messages),
+                "unique_contents": len(self._contents),
+                "stored_bytes": stored,
+                "logical_bytes": self.logical_bytes,
+            }
+
+
+class DedupSerializer:
+    """メッセージのリストだけを ContentStore に分解して保存し、それ以外は内側のシリアライザに任せます。"""
+
+    def __init__(self, store: ContentStore, inner: Optional[Any] = None):
+        self.store = store
+        self.inner = inner or JsonPlusSerializer()
+
+    def dumps_typed(self, obj: Any) -> Tuple[str, bytes]:
+        if not (isinstance(obj, list) and obj and all(isinstance(m, BaseMessage) for m in obj)):
+            return self.inner.dumps_typed(obj)
+        digests: List[str] = []
+        for message in obj:
+            content_digest = None
+            if isinstance(message.content, str) and len(message.content) >= INTERN_MIN_CHARS:
+                content_digest = self.store.put_content(message.content)
+                message = message.model_copy(update={"content": ""})
+            type_, data = self.inner.dumps_typed(message)
+            digests.append(self.store.put_message(type_, data, content_digest))
+        return DEDUP_TYPE, ormsgpack.packb(digests)
+
+    def loads_typed(self, data: Tuple[str, bytes]) -> Any:
+        if data[0] != DEDUP_TYPE:
+            return self.inner.loads_typed(data)
+        return self.load_messages(ormsgpack.unpackb(data[1]))
+
+    def load_messages(self, digests: Iterable[str]) -> List[BaseMessage]:
+        """指定したダイジェストのメッセージだけを復元します（ページ単位の読み出し用）。"""
+        messages = []
+        for digest in digests:
+            type_, payload, content_digest = self.store.get_message(digest)
+            message = self.inner.loads_typed((type_, payload))
+            if content_digest is not None:
+                message.content = self.store.get_content(content_digest)
+            messages.append(message)
+        return messages
+
+
+class DedupMemorySaver(MemorySaver):
+    def __init__(self, store: ContentStore):
+        super().__init__(serde=DedupSerializer(store))
+        self.store = store
+        store.register(self)
+
+    def iter_serialized(self) -> Iterable[Tuple[str, bytes]]:
+        """保存済みのチャネル値と書き込みを列挙します（コンパクション用）。"""
+        for value in list(self.blobs.values()):
+            yield value
+        for writes in list(self.writes.values()):
+            for _, _, value, _ in list(writes.values()):
+                yield value
+
+    # --- 構造化された読み出し（メッセージはダイジェストのまま扱い、必要な分だけ復元する） ---
+
+    def checkpoint_ids(self, thread_id: str, checkpoint_ns: str = "") -> List[str]:
+        """スレッドのチェックポイントID（新しい順）。"""
+        return sorted(self.storage.get(thread_id, {}).get(checkpoint_ns, {}), reverse=True)
+
+    def read_checkpoint(self, thread_id: str, checkpoint_id: Optional[str] = None,
+                        checkpoint_ns: str = "") -> Optional[Tuple[str, Dict[str, Any], Dict[str, Any], Optional[str]]]:
+        """(チェックポイントID, チェックポイント, メタデータ, 親ID) を返します。チャネルの値は読み込みません。"""
+        checkpoints = self.storage.get(thread_id, {}).get(checkpoint_ns)
+        if not checkpoints:
+            return None
+        checkpoint_id = checkpoint_id or max(checkpoints)
+        saved = checkpoints.get(checkpoint_id)
+        if saved is None:
+            return None
+        checkpoint, metadata, parent_id = saved
+        return checkpoint_id, self.serde.loads_typed(checkpoint), self.serde.loads_typed(metadata), parent_id
+
+    def channel_blob(self, thread_id: str, checkpoint: Dict[str, Any], channel: str,
+                     checkpoint_ns: str = "") -> Optional[Tuple[str, bytes]]:
+        version = checkpoint["channel_versions"].get(channel)
+        if version is None:
+            return None
+        blob = self.blobs.get((thread_id, checkpoint_ns, channel, version))
+        return blob if blob is not None and blob[0] != "empty" else None
+
+    def message_digests(self, blob: Tuple[str, bytes]) -> Optional[List[str]]:
+        """メッセージリストのチャネルなら、本文を復元せずにダイジェストの並びを返します。"""
+        return ormsgpack.unpackb(blob[1]) if blob[0] == DEDUP_TYPE else None
+
+    def delete_thread(self, thread_id: str) -> None:
+        self.delete_threads([thread_id])
+
+    def delete_threads(self, thread_ids: Iterable[str]) -> None:
+        """複数スレッドを削除してから1度だけコンパクションします。"""
+        for thread_id in thread_ids:
+            super().delete_thread(thread_id)
+        self.store.compact()
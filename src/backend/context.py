@@ -1,6 +1,160 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
 from contextvars import ContextVar
+from typing import Any, Optional
 
-# ユーザーの権限レベルを保持するコンテキスト変数
-# デフォルトは "ADMIN" (全権限)
-# "READ_ONLY" の場合は送金などの書き込み操作をブロックする
-user_role_var: ContextVar[str] = ContextVar("user_role", default="ADMIN")
+from starlette.datastructures import Headers
+
+# --- Request Context ---
+# 1つのリクエストの実行コンテキスト（権限・セッション・デッドライン・トレースID・LLMの予算）です。
+# ContextVar には RequestContext オブジェクトそのものを入れるため、
+# グラフのノード・ツール・MockBank の呼び出し・スレッドプール（contextvars.copy_context() で引き継ぐ）のどこからでも
+# 同じオブジェクトを参照でき、キャンセルやデッドラインも全スレッドに伝わります。
+# - デッドライン: X-Request-Timeout ヘッダ（秒）、無ければ REQUEST_TIMEOUT。過ぎると以降のモデル呼び出し・ツール実行を止める
+# - キャンセル: クライアントが切断したら cancel() し、実行中の処理は次の確認点で RequestCancelled になる
+# - トレースID: X-Request-ID ヘッダ（または traceparent のトレースID）、無ければ生成し、応答の X-Request-ID に返す
+# 処理の打ち切りは協調的です（実行中のLLM呼び出しやツールを途中で止めることはせず、次の呼び出しの前に確認する）。
+# 環境変数:
+#   REQUEST_TIMEOUT: クライアントが指定しない場合のデッドライン秒数 (デフォルト 0 = なし)
+
+DEFAULT_ROLE = "ADMIN"
+DEFAULT_SESSION = "default"
+
+# クライアントが指定できるデッドラインの上限（秒）
+MAX_REQUEST_TIMEOUT = 3600.0
+
+
+class DeadlineExceeded(TimeoutError):
+    """リクエストのデッドラインを過ぎたため、処理を打ち切ったことを示します。"""
+
+
+class RequestCancelled(Exception):
+    """クライアントが切断したため、処理を打ち切ったことを示します。"""
+
+
+class RequestContext:
+    def __init__(self, session_id: str = DEFAULT_SESSION, role: str = DEFAULT_ROLE,
+                 trace_id: Optional[str] = None, timeout: Optional[float] = None):
+        # ユーザーの権限レベル。"READ_ONLY" の場合は送金などの書き込み操作をブロックする
+        self.role = role
+        # セッションごとに独立した銀行・エージェント状態を使う
+        self.session_id = session_id
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.deadline = time.monotonic() + timeout if timeout else None
+        # 実行中の LLM 使用量（usage.RunUsage。実行の間だけ設定される）
+        self.budget: Optional[Any] = None
+        self._cancelled = threading.Event()
+        self.cancel_reason: Optional[str] = None
+        # このリクエストで実行したツール呼び出しの数（失敗した実行に副作用があったかの判定に使う）
+        self.tool_calls = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_headers(cls, headers: Headers) -> "RequestContext":
+        trace_id = headers.get("x-request-id")
+        traceparent = headers.get("traceparent", "").split("-")
+        if not trace_id and len(traceparent) == 4:
+            trace_id = traceparent[1]
+        timeout = float(os.getenv("REQUEST_TIMEOUT", "0")) or None
+        try:
+            requested = float(headers.get("x-request-timeout", ""))
+            if requested > 0:
+                timeout = min(requested, MAX_REQUEST_TIMEOUT)
+        except ValueError:
+            pass
+        return cls(trace_id=trace_id[:64] if trace_id else None, timeout=timeout)
+
+    def remaining(self) -> Optional[float]:
+        """デッドラインまでの秒数（デッドラインが無ければ None）"""
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def cancel(self, reason: str) -> None:
+        self.cancel_reason = reason
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def check(self) -> None:
+        """打ち切るべきなら例外を送出します（モデル呼び出し・ツール実行の前に呼ぶ）。"""
+        if self._cancelled.is_set():
+            raise RequestCancelled(f"Request {self.trace_id} was cancelled ({self.cancel_reason})")
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"Request {self.trace_id} exceeded its deadline")
+
+    def record_tool_call(self) -> None:
+        with self._lock:
+            self.tool_calls += 1
+
+    def wait_cancelled(self, timeout: float) -> bool:
+        """最大 timeout 秒、キャンセルを待ちます（リトライの待機などに使う）。"""
+        return self._cancelled.wait(timeout)
+
+    def clip(self, timeout: float) -> float:
+        """timeout をデッドラインまでの残り時間で切り詰めます。"""
+        remaining = self.remaining()
+        return timeout if remaining is None else max(min(timeout, remaining), 0.0)
+
+
+# リクエストの外（起動時・バックグラウンドの決済タイマーなど）では、デッドラインの無い既定のコンテキストを使う
+_BACKGROUND = RequestContext()
+
+request_context_var: ContextVar[RequestContext] = ContextVar("request_context", default=_BACKGROUND)
+
+
+def current_context() -> RequestContext:
+    return request_context_var.get()
+
+
+class RequestContextMiddleware:
+    """
+    リクエストごとに RequestContext を作成し、クライアントの切断を検知したらキャンセルします。
+    同期のハンドラは実行中に receive を読まないため、受信はこのミドルウェアが先読みしてアプリへ渡します。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        ctx = RequestContext.from_headers(Headers(scope=scope))
+        token = request_context_var.set(ctx)
+        messages: asyncio.Queue = asyncio.Queue()
+        responded = False
+
+        async def pump():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    # 応答を送り終えた後の切断は、処理の打ち切りには当たらない
+                    if not responded:
+                        ctx.cancel("client disconnected")
+                    return
+
+        async def receive_wrapper():
+            if ctx.cancelled and messages.empty():
+                return {"type": "http.disconnect"}
+            return await messages.get()
+
+        async def send_wrapper(message):
+            nonlocal responded
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", ctx.trace_id.encode("latin-1"))]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                responded = True
+            await send(message)
+
+        reader = asyncio.create_task(pump())
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            reader.cancel()
+            request_context_var.reset(token)
@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional
+
+from src.backend.log_store import SegmentedLog
+
+# --- Bank Operation Stream ---
+# 銀行の状態を変えた操作を、発生順のイベントとして記録します（イベントソーシング）。
+# 口座・残高・ログはこのイベント列を先頭から適用すれば再構築でき、監査ルールを変えた what-if 監査にも使えます。
+# イベント:
+#   reset           : 初期状態（accounts / balances のスナップショット）
+#   log             : 銀行ログに書かれた1行（pos = ログ上の通し番号。行そのものはログにだけ保存し、読み出し時に with_lines で結合する）
+#   account_changed : 口座変更の確定（vendor, account）
+#   payment         : 送金の確定（vendor, account, amount）。まとめて決済では割当1件ごとに記録する
+# 保存には SegmentedLog を使うため、古いイベントは圧縮セグメントとしてディスクへ退避されます。
+# /reset 時は現在のイベント列をアーカイブし、直近のアーカイブは再生の対象として参照できます（同時に退避したログの場所も記録する）。
+# 環境変数:
+#   EVENT_ARCHIVE_LIMIT: 再生の対象として保持するアーカイブ数 (デフォルト 20)
+
+EVENT_RESET = "reset"
+EVENT_LOG = "log"
+EVENT_ACCOUNT_CHANGED = "account_changed"
+EVENT_PAYMENT = "payment"
+
+
+class EventLog:
+    def __init__(self, name: str, archive_limit: Optional[int] = None):
+        self._log = SegmentedLog(name)
+        self._seq = 0
+        self._lock = threading.Lock()
+        limit = archive_limit or int(os.getenv("EVENT_ARCHIVE_LIMIT", "20"))
+        self.archives: Deque[Dict[str, object]] = deque(maxlen=limit)
+
+    def append(self, kind: str, ts: Optional[float] = None, **fields) -> Dict[str, object]:
+        with self._lock:
+            event = {"seq": self._seq, "ts": time.time() if ts is None else ts, "kind": kind, **fields}
+            self._seq += 1
+            self._log.append(event)
+        return event
+
+    def archive(self, logs_archive: Optional[str] = None) -> Optional[str]:
+        """現在のイベント列をアーカイブして空にします。logs_archive には、同時に退避した銀行ログの場所を渡します。"""
+        with self._lock:
+            count = self._seq
+            archive_dir = self._log.archive()
+            self._seq = 0
+        if archive_dir is not None:
+            self.archives.append({"path": archive_dir, "logs": logs_archive, "events": count, "archived_at": time.time()})
+        return archive_dir
+
+    def __len__(self) -> int:
+        return len(self._log)
+
+    def __iter__(self) -> Iterator[Dict[str, object]]:
+        return iter(self._log)
+
+    def with_lines(self, logs: SegmentedLog) -> Iterator[Dict[str, object]]:
+        """log イベントに、ログの行（"line"）を付けて返します（銀行のロック内で呼べば、イベント列とログは同じ時点になる）。"""
+        return attach_lines(iter(self), iter(logs))
+
+    def list_archives(self) -> List[Dict[str, object]]:
+        return list(self.archives)
+
+    @staticmethod
+    def iter_archive(archive: Dict[str, object]) -> Iterator[Dict[str, object]]:
+        """list_archives() の1件のイベント列を、ログの行を付けて返します。"""
+        logs = SegmentedLog.iter_archive(archive["logs"]) if archive.get("logs") else iter(())
+        return attach_lines(SegmentedLog.iter_archive(archive["path"]), logs)
+
+
+def attach_lines(events: Iterator[Dict[str, object]], lines: Iterator[str]) -> Iterator[Dict[str, object]]:
+    """log イベントの pos に対応するログの行を、"line" として付けます（どちらも先頭から順に読む）。"""
+    position = 0
+    for event in events:
+        if event["kind"] == EVENT_LOG and "line" not in event:
+            while position < event["pos"]:
+                next(lines, None)
+                position += 1
+            event = {**event, "line": next(lines, None)}
+            position += 1
+        yield event
@@ -0,0 +1,217 @@
+import csv
+import io
+import json
+import os
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from src.backend.event_log import EventLog, EVENT_LOG, EVENT_ACCOUNT_CHANGED, EVENT_PAYMENT
+
+try:
+    import pyarrow as pa
+except ImportError:  # 列指向の形式（Arrow）は pyarrow がある場合のみ
+    pa = None
+
+# --- Bulk Export ---
+# 銀行の履歴（操作イベント列）と監査結果を、JSONL / CSV / Arrow IPC ストリームで書き出します。
+# - 行はイベント列（ディスク上のセグメントを含む）から1件ずつ読み、batch_rows 件ごとに書き出す（常駐メモリは一定）
+# - 時刻範囲・取引先・種別・重要度のフィルタはサーバ側で適用する
+# - gzip はストリームのまま逐次圧縮する
+# データセット:
+#   ledger   : 送金・口座変更（1行 = 1操作）
+#   logs     : 銀行ログの各行
+#   anomalies: 監査結果（現在の期間のみ。文字列ルールの異常は取引先を持たないため vendor フィルタでは除外される）
+# 環境変数:
+#   EXPORT_BATCH_ROWS: 1回に書き出す行数 (デフォルト 1000)
+
+FORMATS = {
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrow"),
+}
+
+COLUMNS: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    "ledger": (
+        ("epoch", "string"), ("seq", "int64"), ("ts", "float64"), ("kind", "string"), ("vendor", "string"),
+        ("account", "string"), ("amount", "int64"), ("settlement_id", "string"), ("allocation_id", "string"),
+    ),
+    "logs": (("epoch", "string"), ("seq", "int64"), ("ts", "float64"), ("line", "string")),
+    "anomalies": (
+        ("ts", "float64"), ("type", "string"), ("severity", "string"), ("vendor", "string"),
+        ("index", "int64"), ("log", "string"), ("details", "string"),
+    ),
+}
+
+# 表計算ソフトで数式として解釈される先頭文字（CSV インジェクション対策）
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+class ExportFilter:
+    def __init__(self, start: Optional[float] = None, end: Optional[float] = None, vendor: Optional[str] = None,
+                 kinds: Optional[Sequence[str]] = None, severities: Optional[Sequence[str]] = None):
+        self.start = start
+        self.end = end
+        self.vendor = vendor
+        self.kinds = set(kinds) if kinds else None
+        self.severities = {s.upper() for s in severities} if severities else None
+
+    def in_range(self, ts: Optional[float]) -> bool:
+        if ts is None:
+            return self.start is None and self.end is None
+        return (self.start is None or ts >= self.start) and (self.end is None or ts <= self.end)
+
+
+# --- Rows ---
+
+def iter_ledger(epochs: Iterable[Tuple[str, Iterable[Dict[str, object]]]], flt: ExportFilter) -> Iterator[Dict[str, object]]:
+    for epoch, events in epochs:
+        for event in events:
+            if event["kind"] not in (EVENT_PAYMENT, EVENT_ACCOUNT_CHANGED):
+                continue
+            if flt.kinds is not None and event["kind"] not in flt.kinds:
+                continue
+            if flt.vendor is not None and event["vendor"] != flt.vendor:
+                continue
+            if not flt.in_range(event["ts"]):
+                continue
+            yield {
+                "epoch": epoch, "seq": event["seq"], "ts": event["ts"], "kind": event["kind"],
+                "vendor": event["vendor"], "account": event.get("account"), "amount": event.get("amount"),
+                "settlement_id": event.get("settlement_id"), "allocation_id": event.get("allocation_id"),
+            }
+
+
+def iter_log_lines(epochs: Iterable[Tuple[str, Iterable[Dict[str, object]]]], flt: ExportFilter) -> Iterator[Dict[str, object]]:
+    for epoch, events in epochs:
+        for event in events:
+            if event["kind"] != EVENT_LOG or not flt.in_range(event["ts"]):
+                continue
+            if flt.vendor is not None and flt.vendor not in event["line"]:
+                continue
+            yield {"epoch": epoch, "seq": event["seq"], "ts": event["ts"], "line": event["line"]}
+
+
+def iter_anomalies(bank, flt: ExportFilter) -> Iterator[Dict[str, object]]:
+    """現在の期間の監査結果（MockBank.audit_logs と同じ順序）に、発生時刻を付けて返します。"""
+    def keep(anomaly: Dict[str, object], ts: Optional[float]) -> bool:
+        if flt.severities is not None and anomaly["severity"] not in flt.severities:
+            return False
+        if flt.kinds is not None and anomaly["type"] not in flt.kinds:
+            return False
+        if flt.vendor is not None and anomaly.get("vendor") != flt.vendor:
+            return False
+        return flt.in_range(ts)
+
+    # 文字列ルール: ログの各行をイベント列と結合して読み、その行の時刻を使う
+    with bank._lock:
+        events = bank.events.with_lines(bank.logs)
+    for event in events:
+        if event["kind"] != EVENT_LOG:
+            continue
+        anomaly = bank.audit_rules.scan_line(event["line"])
+        if anomaly is not None and keep(anomaly, event["ts"]):
+            yield {"ts": event["ts"], **anomaly}
+    # 統計ルール: 異常の index は分析用の列の行番号
+    ts_column = bank.analytics.ts.values
+    for anomaly in list(bank.analytics.anomalies):
+        ts = float(ts_column[anomaly["index"]]) if anomaly["index"] < len(ts_column) else None
+        if keep(anomaly, ts):
+            yield {"ts": ts, **anomaly}
+
+
+def bank_epochs(bank, include_archived: bool) -> List[Tuple[str, Iterable[Dict[str, object]]]]:
+    epochs: List[Tuple[str, Iterable[Dict[str, object]]]] = []
+    if include_archived:
+        for archive in bank.events.list_archives():
+            epochs.append((os.path.basename(archive["path"]), EventLog.iter_archive(archive)))
+    with bank._lock:
+        epochs.append(("current", bank.events.with_lines(bank.logs)))
+    return epochs
+
+
+# --- Encoders ---
+
+def _batches(rows: Iterable[Dict[str, object]], size: int) -> Iterator[List[Dict[str, object]]]:
+    batch: List[Dict[str, object]] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _csv_cell(value):
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def encode_jsonl(batches: Iterable[List[Dict[str, object]]], columns) -> Iterator[bytes]:
+    names = [name for name, _ in columns]
+    for batch in batches:
+        yield "".join(json.dumps({n: row.get(n) for n in names}, ensure_ascii=False) + "\n" for row in batch).encode("utf-8")
+
+
+def encode_csv(batches: Iterable[List[Dict[str, object]]], columns) -> Iterator[bytes]:
+    names = [name for name, _ in columns]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for batch in batches:
+        writer.writerows([_csv_cell(row.get(n)) for n in names] for row in batch)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """pyarrow の書き込み先。書かれたバイト列を溜めておき、バッチごとに取り出す。"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def encode_arrow(batches: Iterable[List[Dict[str, object]]], columns) -> Iterator[bytes]:
+    schema = pa.schema([(name, getattr(pa, type_)()) for name, type_ in columns])
+    sink = _ChunkSink()
+    writer = pa.ipc.new_stream(pa.PythonFile(sink, mode="w"), schema)
+    for batch in batches:
+        writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def gzip_stream(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31: gzip 形式
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(rows: Iterable[Dict[str, object]], dataset: str, fmt: str, gzip: bool = True,
+                  batch_rows: Optional[int] = None) -> Iterator[bytes]:
+    if fmt == "arrow" and pa is None:
+        raise RuntimeError("Arrow export requires pyarrow to be installed")
+    batches = _batches(rows, batch_rows or int(os.getenv("EXPORT_BATCH_ROWS", "1000")))
+    encoder = {"jsonl": encode_jsonl, "csv": encode_csv, "arrow": encode_arrow}[fmt]
+    chunks = encoder(batches, COLUMNS[dataset])
+    return gzip_stream(chunks) if gzip else chunks
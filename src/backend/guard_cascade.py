@@ -0,0 +1,238 @@
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import Any, Dict, List, Literal, Optional
+
+from langchain_core.messages import BaseMessage
+from langchain_groq import ChatGroq
+from pydantic import BaseModel, Field, ValidationError
+
+from src.backend.context import current_context
+from src.backend.resilience import LatencyTracker, ResilientCaller
+from src.backend.usage import usage_meter
+
+# --- Guardrail Model Cascade ---
+# ガードレールの判定を「小さく速いモデル → 大きいモデル」の順に行います。
+# 小モデルは判定（ALLOW / BLOCK）と確信度だけを短く出力し、
+# 確信度が低い場合、または送金額がしきい値以上の場合にのみ大モデル（70B）で再判定します。
+# 判定は JSON モードで {"decision", "reason_code", "confidence"} の順に出力させ、スキーマで検証します。
+# ストリーミングで受け取り、3つのフィールドが揃った時点で残りの出力を待たずに打ち切ります。
+# 環境変数:
+#   GUARD_CASCADE: "0" で小モデルを使わず大モデルのみで判定 (デフォルト "1")
+#   GUARD_SMALL_MODEL: 小モデル (デフォルト llama-3.1-8b-instant)
+#   GUARD_LARGE_MODEL: 大モデル (デフォルト llama-3.3-70b-versatile)
+#   GUARD_CONFIDENCE_THRESHOLD: これ未満の確信度なら大モデルへ (デフォルト 0.8)
+#   GUARD_ESCALATE_AMOUNT: この金額以上の送金は常に大モデルで判定 (デフォルト 50000)
+
+ReasonCode = Literal[
+    "OK",
+    "NOT_IN_INVOICE",
+    "SUSPICIOUS_ACCOUNT",
+    "HIDDEN_INSTRUCTION",
+    "AMOUNT_MISMATCH",
+    "OTHER",
+    "INVALID_OUTPUT",
+]
+
+
+class GuardDecision(BaseModel):
+    """ガードレールLLMに出力させる判定のスキーマ。"""
+    decision: Literal["ALLOW", "BLOCK"]
+    reason_code: ReasonCode
+    confidence: float = Field(ge=0.0, le=1.0)
+
+
+class GuardVerdict(GuardDecision):
+    tier: str
+    latency_ms: float
+    early_exit: bool = False
+
+
+def parse_amount(value: Any) -> Optional[float]:
+    """
+    ツール引数の金額を数値にします（"1,500,000"・"1500000.0"・" 1500000" なども受け付ける）。
+    数値として読めない場合は None（呼び出し側は高額として扱う）。
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        amount = float(value)
+    else:
+        text = unicodedata.normalize("NFKC", str(value)).strip().replace(",", "").replace("_", "")
+        try:
+            amount = float(text)
+        except ValueError:
+            return None
+    return amount if math.isfinite(amount) else None
+
+
+# ストリーム途中のJSONから各フィールドを拾うためのパターン
+_FIELD_PATTERNS = {
+    "decision": re.compile(r'"decision"\s*:\s*"([A-Z]+)"'),
+    "reason_code": re.compile(r'"reason_code"\s*:\s*"([A-Z_]+)"'),
+    "confidence": re.compile(r'"confidence"\s*:\s*(\d+(?:\.\d+)?)(?=\s*[,}])'),
+}
+
+
+def _scan_fields(text: str) -> Dict[str, str]:
+    found = {}
+    for name, pattern in _FIELD_PATTERNS.items():
+        match = pattern.search(text)
+        if match:
+            found[name] = match.group(1)
+    return found
+
+
+def parse_decision(text: str) -> Optional[GuardDecision]:
+    """出力（完全なJSON、または3フィールドが揃った途中のJSON）をスキーマで検証します。不正なら None。"""
+    try:
+        return GuardDecision.model_validate_json(text)
+    except ValidationError:
+        pass
+    fields = _scan_fields(text)
+    if len(fields) < len(_FIELD_PATTERNS):
+        return None
+    try:
+        return GuardDecision.model_validate(fields)
+    except ValidationError:
+        return None
+
+
+class GuardTier:
+    def __init__(self, name: str, model: str, max_tokens: int = 48):
+        self.name = name
+        self.model = model
+        self.caller = ResilientCaller(f"guardrail-{name}")
+        # 判定JSONは30トークン程度に収まるため、出力トークン数を小さく制限してデコード時間を抑える
+        self.llm = ChatGroq(
+            model=model,
+            temperature=0,
+            max_tokens=max_tokens,
+            max_retries=0,
+            timeout=self.caller.timeout,
+            model_kwargs={"response_format": {"type": "json_object"}}
+        )
+        self.latency = LatencyTracker()
+
+    def _stream_decision(self, messages: List[BaseMessage]):
+        """ストリーミングで出力を受け取り、判定に必要なフィールドが揃った時点で打ち切ります。"""
+        text = ""
+        usage = None
+        try:
+            for chunk in self.llm.stream(messages):
+                # クライアントが切断・デッドラインを過ぎたら、残りの出力を待たずに打ち切る
+                current_context().check()
+                text += str(chunk.content)
+                usage = chunk.usage_metadata or usage
+                if len(_scan_fields(text)) == len(_FIELD_PATTERNS):
+                    return parse_decision(text), True
+            return parse_decision(text), False
+        finally:
+            # 途中で打ち切った場合は使用量が届かないため、usage_meter が文字数から見積もる
+            usage_meter.record_call(self.model, messages, text, usage)
+
+    def judge(self, messages: List[BaseMessage]) -> GuardVerdict:
+        started = time.monotonic()
+        decision, early_exit = self.caller.call(self._stream_decision, messages)
+        elapsed = time.monotonic() - started
+        self.latency.record(elapsed)
+        if decision is None:
+            # スキーマに従わない出力は確信度0のBLOCKとして扱う（上位モデルがあればそちらで再判定される）
+            decision = GuardDecision(decision="BLOCK", reason_code="INVALID_OUTPUT", confidence=0.0)
+        return GuardVerdict(
+            **decision.model_dump(),
+            tier=self.name,
+            latency_ms=round(elapsed * 1000, 1),
+            early_exit=early_exit,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        p50 = self.latency.percentile(0.5)
+        p95 = self.latency.percentile(0.95)
+        return {
+            "model": self.model,
+            "calls": self.caller.counters["calls"],
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "resilience": self.caller.stats(),
+        }
+
+
+class GuardrailCascade:
+    def __init__(self, small: Optional[GuardTier], large: GuardTier, confidence_threshold: float = 0.8, escalate_amount: int = 50000):
+        self.small = small
+        self.large = large
+        self.confidence_threshold = confidence_threshold
+        self.escalate_amount = escalate_amount
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {"judgements": 0, "escalations": 0, "compared": 0, "agreements": 0, "small_failures": 0}
+        self.decisions: Dict[str, int] = {}
+        self.reason_codes: Dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls) -> "GuardrailCascade":
+        small = None
+        if os.getenv("GUARD_CASCADE", "1") != "0":
+            small = GuardTier("small", os.getenv("GUARD_SMALL_MODEL", "llama-3.1-8b-instant"))
+        large = GuardTier("large", os.getenv("GUARD_LARGE_MODEL", "llama-3.3-70b-versatile"))
+        return cls(
+            small,
+            large,
+            confidence_threshold=float(os.getenv("GUARD_CONFIDENCE_THRESHOLD", "0.8")),
+            escalate_amount=int(os.getenv("GUARD_ESCALATE_AMOUNT", "50000")),
+        )
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self.counters[key] += 1
+
+    def judge(self, messages: List[BaseMessage], amount: Optional[float] = 0) -> GuardVerdict:
+        """
+        ツール呼び出し1件を判定します。大モデルが失敗した場合は例外を送出します。
+        amount が None（金額を読めなかった）の場合は高額として扱い、大モデルで判定します。
+        """
+        self._count("judgements")
+        first: Optional[GuardVerdict] = None
+        if self.small is not None:
+            try:
+                first = self.small.judge(messages)
+            except Exception as e:
+                # 小モデルの障害は大モデルで救済する
+                print(f"Guardrail small tier error: {type(e).__name__}: {e}")
+                self._count("small_failures")
+            if first is not None and first.confidence >= self.confidence_threshold and amount is not None and amount < self.escalate_amount:
+                return self._record(first)
+
+        if self.small is not None:
+            self._count("escalations")
+        final = self.large.judge(messages)
+        if first is not None:
+            self._count("compared")
+            if first.decision == final.decision:
+                self._count("agreements")
+        return self._record(final)
+
+    def _record(self, verdict: GuardVerdict) -> GuardVerdict:
+        with self._lock:
+            self.decisions[verdict.decision] = self.decisions.get(verdict.decision, 0) + 1
+            self.reason_codes[verdict.reason_code] = self.reason_codes.get(verdict.reason_code, 0) + 1
+        return verdict
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self.counters)
+            decisions = dict(self.decisions)
+            reason_codes = dict(self.reason_codes)
+        compared = counters["compared"]
+        return {
+            "confidence_threshold": self.confidence_threshold,
+            "escalate_amount": self.escalate_amount,
+            "agreement_rate": round(counters["agreements"] / compared, 3) if compared else None,
+            **counters,
+            "decisions": decisions,
+            "reason_codes": reason_codes,
+            "tiers": {t.name: t.stats() for t in (self.small, self.large) if t is not None},
+        }
@@ -0,0 +1,161 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from src.backend.context import current_context
+
+# --- Idempotent Run Requests ---
+# 同じ請求書の二重送信（ダブルクリック・クライアントの再送）で、LLM の実行と送金が重複しないようにします。
+# - キー: クライアントが送る Idempotency-Key ヘッダ。無ければ「ロール + 請求書本文」のハッシュ
+# - 実行中の同じキーのリクエストは、最初の実行の完了を待って同じ結果を返す（coalesced）
+# - 完了済みのキーは、有効期限内なら保存した結果をそのまま返す（cached）
+# - ツールを1つも実行せずに失敗した実行は保存しない（再送で実行し直せる）
+#   送金などのツールを実行した後に失敗した場合は、その失敗を結果として保存し、再送には同じエラーを返す（二重送金を防ぐ）
+# - 同じ Idempotency-Key で異なる内容が送られた場合は 422 とする
+# キーはセッションごとに分かれ、セッションのリセット時に破棄されます。
+# 環境変数:
+#   IDEMPOTENCY_KEY_TTL: Idempotency-Key 付きの結果を保持する秒数 (デフォルト 86400)
+#   IDEMPOTENCY_CONTENT_TTL: 本文ハッシュによる重複抑止の秒数。二重送信・再送の吸収が目的なので短め (デフォルト 60)
+#   IDEMPOTENCY_MAX_ENTRIES: 保持するキーの最大数。超えた分は古い完了済みのものから捨てる (デフォルト 1000)
+#   IDEMPOTENCY_WAIT: 実行中の同じキーの完了を待つ秒数 (デフォルト 120)
+
+_MAX_CLIENT_KEY_LENGTH = 255
+
+
+class IdempotencyKeyMismatch(Exception):
+    """同じ Idempotency-Key が異なるリクエスト内容で再利用されたことを示します。"""
+
+
+def fingerprint(role: str, invoice_text: Optional[str]) -> str:
+    return hashlib.sha256(f"{role}\0{invoice_text or ''}".encode("utf-8")).hexdigest()
+
+
+class _Entry:
+    __slots__ = ("session_id", "fingerprint", "ttl", "done", "result", "error", "completed_at")
+
+    def __init__(self, session_id: str, fingerprint: str, ttl: float):
+        self.session_id = session_id
+        self.fingerprint = fingerprint
+        self.ttl = ttl
+        self.done = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[BaseException] = None
+        self.completed_at: Optional[float] = None
+
+    def expired(self, now: float) -> bool:
+        return self.completed_at is not None and now - self.completed_at > self.ttl
+
+
+class IdempotencyStore:
+    def __init__(self):
+        self.key_ttl = float(os.getenv("IDEMPOTENCY_KEY_TTL", "86400"))
+        self.content_ttl = float(os.getenv("IDEMPOTENCY_CONTENT_TTL", "60"))
+        self.max_entries = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "1000"))
+        self.wait_timeout = float(os.getenv("IDEMPOTENCY_WAIT", "120"))
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {"executed": 0, "coalesced": 0, "cached": 0, "failed": 0, "failed_kept": 0, "evicted": 0}
+
+    def key_for(self, session_id: str, graph: str, role: str, invoice_text: Optional[str],
+                client_key: Optional[str] = None) -> Tuple[str, str, float]:
+        """(キー, リクエスト内容の指紋, 有効期限) を返します。"""
+        digest = fingerprint(role, invoice_text)
+        if client_key:
+            return f"{session_id}:{graph}:key:{client_key[:_MAX_CLIENT_KEY_LENGTH]}", digest, self.key_ttl
+        return f"{session_id}:{graph}:sha256:{digest}", digest, self.content_ttl
+
+    def run(self, key: str, digest: str, ttl: float, session_id: str,
+            execute: Callable[[], Dict[str, Any]]) -> Tuple[Dict[str, Any], str]:
+        """
+        キーに対応する結果を返します（無ければ execute を実行して保存する）。
+        戻り値は (結果, "executed" / "coalesced" / "cached")。
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expired(now):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                if entry.fingerprint != digest:
+                    raise IdempotencyKeyMismatch("Idempotency-Key was already used with a different request")
+                status = "cached" if entry.done.is_set() else "coalesced"
+                self.counters[status] += 1
+            else:
+                entry = self._entries[key] = _Entry(session_id, digest, ttl)
+                self.counters["executed"] += 1
+                self._evict()
+                status = "executed"
+
+        if status == "executed":
+            ctx = current_context()
+            tool_calls = ctx.tool_calls
+            try:
+                entry.result = execute()
+            except BaseException as e:
+                entry.error = e
+                with self._lock:
+                    self.counters["failed"] += 1
+                    if ctx.tool_calls > tool_calls:
+                        # ツールを実行した後の失敗は保存する（再送で送金などを繰り返さない）
+                        self.counters["failed_kept"] += 1
+                    elif self._entries.get(key) is entry:
+                        # 副作用の無い失敗は保存しない（待っているリクエストには同じエラーを返し、以後の再送は実行し直す）
+                        del self._entries[key]
+                raise
+            finally:
+                entry.completed_at = time.time()
+                entry.done.set()
+            return entry.result, status
+
+        # 合流したリクエストも、自分のデッドラインを過ぎたら待つのをやめる
+        ctx = current_context()
+        if not entry.done.wait(ctx.clip(self.wait_timeout)):
+            ctx.check()
+            raise TimeoutError(f"Identical request is still running after {self.wait_timeout:.0f}s")
+        if entry.error is not None:
+            raise entry.error
+        return entry.result, status
+
+    def _evict(self) -> None:
+        now = time.time()
+        for key in [k for k, e in self._entries.items() if e.expired(now)]:
+            del self._entries[key]
+        # 実行中のものは捨てない（待っているリクエストが同じ実行に合流できなくなるため）
+        while len(self._entries) > self.max_entries:
+            victim = next((k for k, e in self._entries.items() if e.done.is_set()), None)
+            if victim is None:
+                break
+            del self._entries[victim]
+            self.counters["evicted"] += 1
+
+    def forget_thread(self, thread_id: str) -> None:
+        """承認・拒否で状態が進んだスレッドの結果は、再送で返さないよう破棄します。"""
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e.result and e.result.get("thread_id") == thread_id]:
+                del self._entries[key]
+
+    def clear(self, session_id: Optional[str] = None) -> None:
+        with self._lock:
+            if session_id is None:
+                self._entries.clear()
+                return
+            for key in [k for k, e in self._entries.items() if e.session_id == session_id]:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            in_flight = sum(1 for e in self._entries.values() if not e.done.is_set())
+            return {
+                "entries": len(self._entries),
+                "in_flight": in_flight,
+                "key_ttl": self.key_ttl,
+                "content_ttl": self.content_ttl,
+                **self.counters,
+            }
+
+
+idempotency = IdempotencyStore()
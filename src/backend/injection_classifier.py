@@ -0,0 +1,239 @@
+import os
+import threading
+import unicodedata
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from src.data.injection_corpus import labeled_corpus
+
+# --- Local Injection Classifier (Guardrail Tier 0) ---
+# LLMガードレールの前段で動く、CPUのみの軽量なインジェクション検知器です。
+# 文字n-gramと単語n-gramをハッシュ化した疎な特徴量に対して、NumPyで線形モデル（ロジスティック回帰）を適用します。
+# バッチ全体を1つのバイト列として処理するため、Pythonレベルのループは文書数にも文字数にも比例しません。
+
+_MASK64 = (1 << 64) - 1
+_BASE = 0x100000001B3  # 奇数なので 2^64 を法として逆元を持つ
+_BASE_INV = pow(_BASE, -1, 1 << 64)
+
+# 特徴量の種類ごとのソルト（同じハッシュ値でも別の特徴として扱う）
+_SALT_CHAR = 0x9E3779B97F4A7C15
+_SALT_WORD = 0xC2B2AE3D27D4EB4F
+_SALT_BIGRAM = 0x165667B19E3779F9
+
+
+def _mix(h: np.ndarray) -> np.ndarray:
+    """splitmix64 の最終化関数でハッシュ値を撹拌します。"""
+    h = h ^ (h >> np.uint64(30))
+    h = h * np.uint64(0xBF58476D1CE4E5B9)
+    h = h ^ (h >> np.uint64(27))
+    h = h * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text or "").casefold()
+
+
+class _SparseBatch:
+    """文書ID・特徴ID・値の三つ組で表した疎な特徴行列です（各行はL2正規化済み）。"""
+
+    def __init__(self, n_docs: int, doc: np.ndarray, col: np.ndarray, val: np.ndarray):
+        self.n_docs = n_docs
+        self.doc = doc
+        self.col = col
+        self.val = val
+
+    def dot(self, weights: np.ndarray) -> np.ndarray:
+        return np.bincount(self.doc, weights=self.val * weights[self.col], minlength=self.n_docs)
+
+    def transpose_dot(self, residual: np.ndarray, n_features: int) -> np.ndarray:
+        return np.bincount(self.col, weights=self.val * residual[self.doc], minlength=n_features)
+
+
+def _featurize(texts: Sequence[str], n_features: int, char_ngrams: range) -> _SparseBatch:
+    n_docs = len(texts)
+    encoded = [_normalize(t).encode("utf-8") for t in texts]
+    lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=n_docs)
+    total = int(lengths.sum())
+    if total == 0:
+        empty_i = np.zeros(0, dtype=np.int64)
+        return _SparseBatch(n_docs, empty_i, empty_i, np.zeros(0))
+
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64) + np.uint64(1)
+    doc_of = np.repeat(np.arange(n_docs, dtype=np.int64), lengths)
+
+    # 多項式ハッシュの累積和: 区間 [s, e) のハッシュは (H[e] - H[s]) * BASE^-s で位置に依存せず求まる
+    powers = np.empty(total, dtype=np.uint64)
+    powers[0] = 1
+    powers[1:] = _BASE
+    np.cumprod(powers, out=powers)
+    inv_powers = np.empty(total, dtype=np.uint64)
+    inv_powers[0] = 1
+    inv_powers[1:] = _BASE_INV
+    np.cumprod(inv_powers, out=inv_powers)
+    prefix = np.zeros(total + 1, dtype=np.uint64)
+    np.cumsum(data * powers, out=prefix[1:])
+
+    def span_hash(starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        return (prefix[ends] - prefix[starts]) * inv_powers[starts]
+
+    docs: List[np.ndarray] = []
+    keys: List[np.ndarray] = []
+
+    # 1. 文字（バイト）n-gram
+    for n in char_ngrams:
+        if total < n:
+            continue
+        starts = np.arange(total - n + 1, dtype=np.int64)
+        valid = doc_of[starts] == doc_of[starts + n - 1]
+        starts = starts[valid]
+        h = span_hash(starts, starts + n) + np.uint64((_SALT_CHAR * n) & _MASK64)
+        docs.append(doc_of[starts])
+        keys.append(h)
+
+    # 2. 単語 unigram / bigram（英数字と非ASCII文字の連続を単語とみなす）
+    raw = data - np.uint64(1)
+    is_word = (
+        ((raw >= 0x30) & (raw <= 0x39))
+        | ((raw >= 0x61) & (raw <= 0x7A))
+        | (raw == 0x5F)
+        | (raw >= 0x80)
+    )
+    boundary = np.ones(total + 1, dtype=bool)
+    boundary[1:-1] = (is_word[1:] != is_word[:-1]) | (doc_of[1:] != doc_of[:-1])
+    edges = np.flatnonzero(boundary)
+    run_starts, run_ends = edges[:-1], edges[1:]
+    word_runs = is_word[run_starts]
+    w_starts, w_ends = run_starts[word_runs], run_ends[word_runs]
+    if w_starts.size:
+        w_hash = _mix(span_hash(w_starts, w_ends))
+        w_doc = doc_of[w_starts]
+        docs.append(w_doc)
+        keys.append(w_hash + np.uint64(_SALT_WORD))
+        same_doc = w_doc[1:] == w_doc[:-1]
+        if same_doc.any():
+            bigram = w_hash[:-1][same_doc] * np.uint64(_BASE) + w_hash[1:][same_doc]
+            docs.append(w_doc[:-1][same_doc])
+            keys.append(bigram + np.uint64(_SALT_BIGRAM))
+
+    doc = np.concatenate(docs)
+    col = (_mix(np.concatenate(keys)) % np.uint64(n_features)).astype(np.int64)
+
+    # 文書内で同じ特徴をまとめ、log(1+tf) を値として各行をL2正規化する
+    flat, counts = np.unique(doc * n_features + col, return_counts=True)
+    doc = flat // n_features
+    col = flat % n_features
+    val = np.log1p(counts.astype(np.float64))
+    norms = np.sqrt(np.bincount(doc, weights=val * val, minlength=n_docs))
+    val = val / norms[doc]
+    return _SparseBatch(n_docs, doc, col, val)
+
+
+class InjectionClassifier:
+    """
+    ハッシュ化n-gram特徴量とロジスティック回帰によるインジェクション分類器。
+    threshold 以上のスコアを「インジェクションの疑いあり」と判定します。
+    """
+
+    def __init__(
+        self,
+        n_features: int = 1 << 16,
+        char_ngrams: range = range(3, 6),
+        threshold: float = 0.5,
+        l2: float = 1e-4,
+        epochs: int = 300,
+        learning_rate: float = 2.0,
+    ):
+        self.n_features = n_features
+        self.char_ngrams = char_ngrams
+        self.threshold = threshold
+        self.l2 = l2
+        self.epochs = epochs
+        self.learning_rate = learning_rate
+        self.weights = np.zeros(n_features)
+        self.bias = 0.0
+
+    def fit(self, texts: Sequence[str], labels: Sequence[int]) -> "InjectionClassifier":
+        """フルバッチ勾配降下法で学習します。"""
+        batch = _featurize(texts, self.n_features, self.char_ngrams)
+        y = np.asarray(labels, dtype=np.float64)
+        weights = np.zeros(self.n_features)
+        bias = 0.0
+        n = max(len(y), 1)
+        for _ in range(self.epochs):
+            p = 1.0 / (1.0 + np.exp(-(batch.dot(weights) + bias)))
+            residual = p - y
+            weights -= self.learning_rate * (batch.transpose_dot(residual, self.n_features) / n + self.l2 * weights)
+            bias -= self.learning_rate * float(residual.mean())
+        self.weights = weights
+        self.bias = bias
+        return self
+
+    def predict_proba(self, texts: Sequence[str]) -> np.ndarray:
+        """各テキストがインジェクションである確率（0.0〜1.0）を返します。"""
+        if not texts:
+            return np.zeros(0)
+        batch = _featurize(texts, self.n_features, self.char_ngrams)
+        return 1.0 / (1.0 + np.exp(-(batch.dot(self.weights) + self.bias)))
+
+    def predict(self, texts: Sequence[str]) -> np.ndarray:
+        return self.predict_proba(texts) >= self.threshold
+
+    def screen(self, texts: Sequence[str]) -> List[Dict[str, object]]:
+        """バッチを判定し、APIレスポンス向けの辞書のリストを返します。"""
+        scores = self.predict_proba(texts)
+        return [
+            {
+                "score": round(float(s), 4),
+                "flagged": bool(s >= self.threshold),
+                "label": "INJECTION" if s >= self.threshold else "CLEAN",
+            }
+            for s in scores
+        ]
+
+
+# --- Default instance ---
+# 初回利用時にシードコーパスで学習します（学習は数百ミリ秒程度）。
+# 環境変数:
+#   INJECTION_THRESHOLD: 判定しきい値 (デフォルト 0.5)
+#   INJECTION_PRESCREEN: "off" / "annotate" (スコアをレスポンスに付与) / "gate" (LLM呼び出し前にブロック)
+
+_default_classifier: Optional[InjectionClassifier] = None
+_default_lock = threading.Lock()
+
+
+def get_injection_classifier() -> InjectionClassifier:
+    global _default_classifier
+    if _default_classifier is None:
+        with _default_lock:
+            if _default_classifier is None:
+                threshold = float(os.getenv("INJECTION_THRESHOLD", "0.5"))
+                texts, labels = labeled_corpus()
+                _default_classifier = InjectionClassifier(threshold=threshold).fit(texts, labels)
+    return _default_classifier
+
+
+def prescreen_mode() -> str:
+    mode = os.getenv("INJECTION_PRESCREEN", "annotate").lower()
+    return mode if mode in ("off", "annotate", "gate") else "annotate"
+
+
+INJECTION_BLOCK_MESSAGE = (
+    "【セキュリティ警告】この請求書はインジェクション検知分類器によって「不正」と判定され、ブロックされました。"
+    "LLMは呼び出されておらず、送金は実行されていません。"
+)
+
+
+def prescreen_invoice(invoice_text: str) -> Optional[Dict[str, object]]:
+    """
+    LLM呼び出し前に請求書をスコアリングします。
+    モードが "off" の場合は None を返します。"gate" の場合のみ blocked が True になり得ます。
+    """
+    mode = prescreen_mode()
+    if mode == "off":
+        return None
+    verdict = get_injection_classifier().screen([invoice_text or ""])[0]
+    verdict["mode"] = mode
+    verdict["blocked"] = mode == "gate" and verdict["flagged"]
+    return verdict
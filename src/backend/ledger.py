@@ -0,0 +1,160 @@
+import bisect
+import itertools
+import threading
+import time
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+
+# --- Double-entry Ledger ---
+# 銀行の残高を複式簿記の仕訳として記録します。1つの仕訳の借方・貸方の合計は常に 0 になります。
+# 勘定:
+#   COMPANY_MAIN などの資産勘定（残高がマイナスになる仕訳は InsufficientFundsError で拒否する）
+#   VENDOR:<取引先>  取引先への支払累計（送金のたびに借方に計上）
+#   EQUITY:OPENING  期首残高の相手勘定
+# 勘定ごとに「現在残高」と「仕訳ごとの残高の推移（時刻, 残高）」を持つため、
+#   - 現在残高は O(1)
+#   - 任意の時刻 T 時点の残高、期間内の支払合計は二分探索で O(log n)
+# で求められ、照合レポートのために全履歴を再生する必要がありません。
+
+OPENING_ACCOUNT = "EQUITY:OPENING"
+VENDOR_PREFIX = "VENDOR:"
+
+
+def vendor_account(vendor: str) -> str:
+    return f"{VENDOR_PREFIX}{vendor}"
+
+
+class InsufficientFundsError(Exception):
+    def __init__(self, account: str, balance: int, amount: int):
+        super().__init__(f"Insufficient funds in {account}: balance {balance:,} JPY, requested {amount:,} JPY")
+        self.account = account
+        self.balance = balance
+        self.amount = amount
+
+
+class JournalEntry:
+    __slots__ = ("entry_id", "timestamp", "memo", "postings")
+
+    def __init__(self, entry_id: int, timestamp: float, memo: str, postings: Tuple[Tuple[str, int], ...]):
+        self.entry_id = entry_id
+        self.timestamp = timestamp
+        self.memo = memo
+        self.postings = postings
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "entry_id": self.entry_id,
+            "timestamp": self.timestamp,
+            "memo": self.memo,
+            "postings": [{"account": a, "amount": v} for a, v in self.postings],
+        }
+
+
+class _AccountHistory:
+    """勘定ごとの残高推移。時刻は単調増加なので、そのまま二分探索できます。"""
+    __slots__ = ("times", "balances")
+
+    def __init__(self):
+        self.times: List[float] = []
+        self.balances: List[int] = []
+
+    def balance_at(self, timestamp: float, inclusive: bool = True) -> int:
+        index = (bisect.bisect_right if inclusive else bisect.bisect_left)(self.times, timestamp)
+        return self.balances[index - 1] if index else 0
+
+
+class Ledger:
+    def __init__(self, asset_accounts: Tuple[str, ...] = ("COMPANY_MAIN",)):
+        self.asset_accounts = set(asset_accounts)
+        self.entries: List[JournalEntry] = []
+        self._balances: Dict[str, int] = {}
+        self._history: Dict[str, _AccountHistory] = {}
+        self._ids = itertools.count(1)
+        self._last_timestamp = 0.0
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_balances(cls, balances: Mapping[str, int]) -> "Ledger":
+        """期首残高から台帳を作成します（相手勘定は EQUITY:OPENING）。"""
+        ledger = cls(tuple(balances))
+        for account, amount in balances.items():
+            ledger.post([(account, amount), (OPENING_ACCOUNT, -amount)], memo=f"Opening balance for {account}")
+        return ledger
+
+    # --- Write ---
+
+    def post(self, postings: List[Tuple[str, int]], memo: str = "", timestamp: Optional[float] = None) -> JournalEntry:
+        """
+        仕訳を1件記録します。借方（正）と貸方（負）の合計は 0 でなければなりません。
+        資産勘定の残高がマイナスになる場合は InsufficientFundsError を送出し、何も記録しません。
+        """
+        if sum(amount for _, amount in postings) != 0:
+            raise ValueError("Journal entry is not balanced")
+        with self._lock:
+            for account, amount in postings:
+                if account in self.asset_accounts and amount < 0:
+                    balance = self._balances.get(account, 0)
+                    if balance + amount < 0:
+                        raise InsufficientFundsError(account, balance, -amount)
+            # 二分探索のため、時刻は単調増加に揃える
+            now = time.time() if timestamp is None else timestamp
+            now = max(now, self._last_timestamp)
+            self._last_timestamp = now
+            entry = JournalEntry(next(self._ids), now, memo, tuple(postings))
+            for account, amount in postings:
+                balance = self._balances.get(account, 0) + amount
+                self._balances[account] = balance
+                history = self._history.get(account)
+                if history is None:
+                    history = self._history[account] = _AccountHistory()
+                history.times.append(now)
+                history.balances.append(balance)
+            self.entries.append(entry)
+            return entry
+
+    def record_payment(self, source: str, vendor: str, amount: int, memo: str = "", timestamp: Optional[float] = None) -> JournalEntry:
+        # 負の金額は貸借が逆の仕訳（取引先から送金元への入金）になってしまうため受け付けない
+        if isinstance(amount, bool) or not isinstance(amount, int) or amount <= 0:
+            raise ValueError(f"Payment amount must be a positive integer: {amount!r}")
+        return self.post([(vendor_account(vendor), amount), (source, -amount)], memo=memo, timestamp=timestamp)
+
+    def can_pay(self, source: str, amount: int) -> bool:
+        return self._balances.get(source, 0) >= amount
+
+    # --- Read ---
+
+    def balance(self, account: str) -> int:
+        return self._balances.get(account, 0)
+
+    def balances_view(self) -> Mapping[str, int]:
+        """資産勘定の現在残高の読み取り専用ビュー（コピーしない）。"""
+        return MappingProxyType({a: self._balances.get(a, 0) for a in self.asset_accounts})
+
+    def balance_at(self, account: str, timestamp: float) -> int:
+        """時刻 timestamp 時点（その時刻の仕訳を含む）の残高。O(log n)"""
+        with self._lock:
+            history = self._history.get(account)
+            return history.balance_at(timestamp) if history else 0
+
+    def paid_to(self, vendor: str, start: Optional[float] = None, end: Optional[float] = None) -> int:
+        """期間 [start, end] に取引先へ支払った合計。O(log n)"""
+        with self._lock:
+            history = self._history.get(vendor_account(vendor))
+            if history is None:
+                return 0
+            upper = history.balances[-1] if end is None else history.balance_at(end)
+            lower = 0 if start is None else history.balance_at(start, inclusive=False)
+            return upper - lower
+
+    def trial_balance(self, timestamp: Optional[float] = None) -> Dict[str, object]:
+        """全勘定の残高（時刻指定可）。借方・貸方の合計が一致していれば total は 0 になる。"""
+        with self._lock:
+            if timestamp is None:
+                balances = dict(self._balances)
+            else:
+                balances = {a: h.balance_at(timestamp) for a, h in self._history.items()}
+        return {"timestamp": timestamp, "balances": balances, "total": sum(balances.values())}
+
+    def vendors(self) -> List[str]:
+        with self._lock:
+            return [a[len(VENDOR_PREFIX):] for a in self._history if a.startswith(VENDOR_PREFIX)]
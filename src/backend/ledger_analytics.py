@@ -0,0 +1,323 @@
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# --- Statistical Anomaly Scoring (Detection Layer) ---
+# 取引を列指向（NumPy配列）で保持し、取引先ごとの統計的な異常を検知します。
+# 検知ルール:
+# 1. ZSCORE_ANOMALY: 直近 window 件の送金の平均・標準偏差に対する z-score が zscore_threshold を超える
+# 2. VELOCITY_ANOMALY: velocity_window 秒以内の同一取引先への送金合計が velocity_limit を超える
+# 3. FIRST_PAYMENT_AFTER_ACCOUNT_CHANGE: 口座変更後の最初の送金
+# 送金ごとの判定は取引先単位の状態を O(1) で更新して行い、バックフィル時は recompute() で全件を一括再計算します。
+
+KIND_PAYMENT = 0
+KIND_ACCOUNT_CHANGE = 1
+
+
+class _Column:
+    """容量を倍々に拡張する、追記専用のNumPy配列です。"""
+
+    def __init__(self, dtype, capacity: int = 1024):
+        self._data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, value) -> None:
+        if self.size == len(self._data):
+            self._grow(self.size + 1)
+        self._data[self.size] = value
+        self.size += 1
+
+    def extend(self, values: np.ndarray) -> None:
+        n = len(values)
+        if self.size + n > len(self._data):
+            self._grow(self.size + n)
+        self._data[self.size:self.size + n] = values
+        self.size += n
+
+    def _grow(self, required: int) -> None:
+        capacity = max(required, len(self._data) * 2)
+        data = np.empty(capacity, dtype=self._data.dtype)
+        data[:self.size] = self._data[:self.size]
+        self._data = data
+
+    @property
+    def values(self) -> np.ndarray:
+        return self._data[:self.size]
+
+
+class _VendorState:
+    """取引先ごとの増分計算用の状態です。"""
+
+    def __init__(self, window: int):
+        self.recent = np.zeros(window)  # 直近 window 件の送金額（リングバッファ）
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.velocity: Deque[Tuple[float, float]] = deque()
+        self.velocity_total = 0.0
+        self.account_changed = False
+
+
+class LedgerAnalytics:
+    def __init__(
+        self,
+        window: int = 20,
+        min_history: int = 3,
+        zscore_threshold: float = 3.0,
+        velocity_window: float = 3600.0,
+        velocity_limit: float = 100000.0,
+    ):
+        self.window = window
+        self.min_history = min_history
+        self.zscore_threshold = zscore_threshold
+        self.velocity_window = velocity_window
+        self.velocity_limit = velocity_limit
+
+        self.vendor_ids: Dict[str, int] = {}
+        self.vendor_names: List[str] = []
+        self.ts = _Column(np.float64)
+        self.vendor = _Column(np.int32)
+        self.amount = _Column(np.float64)
+        self.kind = _Column(np.int8)
+
+        self._states: Dict[int, _VendorState] = {}
+        self.anomalies: List[Dict[str, object]] = []
+        self._lock = threading.Lock()
+
+    # --- Ingestion ---
+
+    def _vendor_id(self, vendor: str) -> int:
+        vid = self.vendor_ids.get(vendor)
+        if vid is None:
+            vid = len(self.vendor_names)
+            self.vendor_ids[vendor] = vid
+            self.vendor_names.append(vendor)
+        return vid
+
+    def _state(self, vid: int) -> _VendorState:
+        state = self._states.get(vid)
+        if state is None:
+            state = self._states[vid] = _VendorState(self.window)
+        return state
+
+    def record_account_change(self, vendor: str, ts: Optional[float] = None) -> None:
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            vid = self._vendor_id(vendor)
+            self.ts.append(ts)
+            self.vendor.append(vid)
+            self.amount.append(0.0)
+            self.kind.append(KIND_ACCOUNT_CHANGE)
+            self._state(vid).account_changed = True
+
+    def record_payment(self, vendor: str, amount: float, ts: Optional[float] = None) -> List[Dict[str, object]]:
+        """送金を1件追加し、その送金で検知された異常を返します。"""
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            vid = self._vendor_id(vendor)
+            index = self.ts.size
+            self.ts.append(ts)
+            self.vendor.append(vid)
+            self.amount.append(amount)
+            self.kind.append(KIND_PAYMENT)
+
+            state = self._state(vid)
+            found: List[Dict[str, object]] = []
+
+            history = min(state.count, self.window)
+            if history >= self.min_history:
+                mean = state.total / history
+                std = np.sqrt(max(state.total_sq / history - mean * mean, 0.0))
+                z = (amount - mean) / self._std_floor(std, mean)
+                if z > self.zscore_threshold:
+                    found.append(self._zscore_anomaly(index, vendor, amount, float(z), float(mean)))
+
+            while state.velocity and state.velocity[0][0] <= ts - self.velocity_window:
+                state.velocity_total -= state.velocity.popleft()[1]
+            state.velocity.append((ts, amount))
+            state.velocity_total += amount
+            if state.velocity_total > self.velocity_limit:
+                found.append(self._velocity_anomaly(index, vendor, amount, state.velocity_total))
+
+            if state.account_changed:
+                found.append(self._account_change_anomaly(index, vendor, amount))
+                state.account_changed = False
+
+            slot = state.count % self.window
+            if state.count >= self.window:
+                evicted = state.recent[slot]
+                state.total -= evicted
+                state.total_sq -= evicted * evicted
+            state.recent[slot] = amount
+            state.total += amount
+            state.total_sq += amount * amount
+            state.count += 1
+
+            self.anomalies.extend(found)
+            return found
+
+    def extend(self, vendors: Iterable[str], amounts: Iterable[float], timestamps: Iterable[float], kinds: Optional[Iterable[int]] = None) -> None:
+        """
+        過去データを一括で取り込みます（バックフィル用）。
+        増分状態は更新しないため、取り込み後に recompute() を呼び出してください。
+        """
+        with self._lock:
+            vids = np.fromiter((self._vendor_id(v) for v in vendors), dtype=np.int32)
+            self.vendor.extend(vids)
+            self.amount.extend(np.asarray(list(amounts), dtype=np.float64))
+            self.ts.extend(np.asarray(list(timestamps), dtype=np.float64))
+            if kinds is None:
+                self.kind.extend(np.full(len(vids), KIND_PAYMENT, dtype=np.int8))
+            else:
+                self.kind.extend(np.asarray(list(kinds), dtype=np.int8))
+
+    # --- Batch recompute ---
+
+    def _std_floor(self, std, mean):
+        # 履歴がすべて同額（std=0）の場合でも z-score が発散しないよう、平均の5%を下限にする
+        return np.maximum(np.maximum(std, 0.05 * np.abs(mean)), 1.0)
+
+    def recompute(self) -> List[Dict[str, object]]:
+        """全取引から異常を一括再計算し、増分状態も再構築します。"""
+        with self._lock:
+            ts = self.ts.values
+            vendor = self.vendor.values
+            amount = self.amount.values
+            kind = self.kind.values
+            n = len(ts)
+            self.anomalies = []
+            self._states = {}
+            if n == 0:
+                return []
+
+            # 取引先 → 時刻 → 追加順で安定ソート
+            order = np.lexsort((np.arange(n), ts, vendor))
+            s_vendor = vendor[order]
+            s_kind = kind[order]
+            s_ts = ts[order]
+
+            # 同じ取引先で、直近の口座変更より後にまだ送金がなければ「口座変更後の最初の送金」
+            is_payment = s_kind == KIND_PAYMENT
+            last_payment_pos = np.where(is_payment, np.arange(n), -1)
+            np.maximum.accumulate(last_payment_pos, out=last_payment_pos)
+            last_change_pos = np.where(s_kind == KIND_ACCOUNT_CHANGE, np.arange(n), -1)
+            np.maximum.accumulate(last_change_pos, out=last_change_pos)
+            prior_payment = np.full(n, -1)
+            prior_payment[1:] = last_payment_pos[:-1]
+            group_start = np.zeros(n, dtype=np.int64)
+            boundaries = np.flatnonzero(np.diff(s_vendor)) + 1
+            group_start[boundaries] = boundaries
+            np.maximum.accumulate(group_start, out=group_start)
+            after_change = is_payment & (last_change_pos >= group_start) & (last_change_pos > prior_payment)
+
+            # 以降は送金のみで計算する
+            p_idx = order[is_payment]
+            p_vendor = s_vendor[is_payment]
+            p_ts = s_ts[is_payment]
+            p_amount = amount[p_idx]
+            p_after_change = after_change[is_payment]
+            m = len(p_idx)
+            if m == 0:
+                for vid in np.unique(s_vendor):
+                    self._state(int(vid)).account_changed = True
+                return []
+
+            starts = np.zeros(m, dtype=np.int64)
+            p_bounds = np.flatnonzero(np.diff(p_vendor)) + 1
+            starts[p_bounds] = p_bounds
+            np.maximum.accumulate(starts, out=starts)
+            position = np.arange(m) - starts
+
+            # 1. 直近 window 件のローリング平均・標準偏差（累積和の差分で計算）
+            cs = np.concatenate(([0.0], np.cumsum(p_amount)))
+            cs_sq = np.concatenate(([0.0], np.cumsum(p_amount * p_amount)))
+            history = np.minimum(position, self.window)
+            lo = np.arange(m) - history
+            hi = np.arange(m)
+            safe = np.maximum(history, 1)
+            mean = (cs[hi] - cs[lo]) / safe
+            var = np.maximum((cs_sq[hi] - cs_sq[lo]) / safe - mean * mean, 0.0)
+            z = (p_amount - mean) / self._std_floor(np.sqrt(var), mean)
+            z_hit = (history >= self.min_history) & (z > self.zscore_threshold)
+
+            # 2. velocity_window 秒以内の合計（取引先をオフセットに埋め込んで searchsorted）
+            t0 = p_ts.min()
+            span = (p_ts.max() - t0) + self.velocity_window + 1.0
+            key = p_vendor.astype(np.float64) * span + (p_ts - t0)
+            first = np.searchsorted(key, key - self.velocity_window, side="right")
+            first = np.maximum(first, starts)
+            velocity = cs[hi + 1] - cs[first]
+            v_hit = velocity > self.velocity_limit
+
+            hits = np.flatnonzero(z_hit | v_hit | p_after_change)
+            for i in hits[np.argsort(p_idx[hits], kind="stable")]:
+                name = self.vendor_names[p_vendor[i]]
+                if z_hit[i]:
+                    self.anomalies.append(self._zscore_anomaly(int(p_idx[i]), name, float(p_amount[i]), float(z[i]), float(mean[i])))
+                if v_hit[i]:
+                    self.anomalies.append(self._velocity_anomaly(int(p_idx[i]), name, float(p_amount[i]), float(velocity[i])))
+                if p_after_change[i]:
+                    self.anomalies.append(self._account_change_anomaly(int(p_idx[i]), name, float(p_amount[i])))
+
+            self._rebuild_states(p_vendor, p_ts, p_amount, starts, after_change, s_vendor, s_kind)
+            return list(self.anomalies)
+
+    def _rebuild_states(self, p_vendor, p_ts, p_amount, starts, after_change, s_vendor, s_kind) -> None:
+        """一括再計算後に、以降の増分計算が続けられるよう取引先ごとの状態を復元します。"""
+        ends = np.append(np.flatnonzero(np.diff(p_vendor)) + 1, len(p_vendor))
+        for start, end in zip(np.unique(starts), ends):
+            vid = int(p_vendor[start])
+            state = self._state(vid)
+            amounts = p_amount[start:end]
+            state.count = len(amounts)
+            recent = amounts[-self.window:]
+            # リングバッファ上の位置を増分計算と揃える
+            slots = np.arange(state.count - len(recent), state.count) % self.window
+            state.recent[slots] = recent
+            state.total = float(recent.sum())
+            state.total_sq = float((recent * recent).sum())
+            times = p_ts[start:end]
+            cutoff = times[-1] - self.velocity_window
+            keep = times > cutoff
+            state.velocity = deque(zip(times[keep].tolist(), amounts[keep].tolist()))
+            state.velocity_total = float(amounts[keep].sum())
+        # 末尾が口座変更で終わっている取引先は、次の送金で検知できるようにする
+        ends_all = np.append(np.flatnonzero(np.diff(s_vendor)), len(s_vendor) - 1)
+        for last in ends_all:
+            if s_kind[last] == KIND_ACCOUNT_CHANGE:
+                self._state(int(s_vendor[last])).account_changed = True
+
+    # --- Anomaly records ---
+
+    def _zscore_anomaly(self, index: int, vendor: str, amount: float, z: float, mean: float) -> Dict[str, object]:
+        return {
+            "type": "ZSCORE_ANOMALY",
+            "log": f"Payment #{index}: {amount:,.0f} JPY to {vendor}",
+            "severity": "MEDIUM",
+            "details": f"z-score {z:.1f} > {self.zscore_threshold} (rolling mean {mean:,.0f} JPY)",
+            "vendor": vendor,
+            "index": index,
+        }
+
+    def _velocity_anomaly(self, index: int, vendor: str, amount: float, total: float) -> Dict[str, object]:
+        return {
+            "type": "VELOCITY_ANOMALY",
+            "log": f"Payment #{index}: {amount:,.0f} JPY to {vendor}",
+            "severity": "MEDIUM",
+            "details": f"{total:,.0f} JPY within {self.velocity_window:,.0f}s > {self.velocity_limit:,.0f}",
+            "vendor": vendor,
+            "index": index,
+        }
+
+    def _account_change_anomaly(self, index: int, vendor: str, amount: float) -> Dict[str, object]:
+        return {
+            "type": "FIRST_PAYMENT_AFTER_ACCOUNT_CHANGE",
+            "log": f"Payment #{index}: {amount:,.0f} JPY to {vendor}",
+            "severity": "HIGH",
+            "details": f"First payment to {vendor} after its bank account was changed",
+            "vendor": vendor,
+            "index": index,
+        }
@@ -0,0 +1,323 @@
+import hashlib
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+from array import array
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+
+from src.backend.ledger_analytics import _Column
+
+# --- Inverted Index over Bank Logs ---
+# 銀行ログの各行を、追加時に増分でインデックスします（行番号 = ログ上の通し番号）。
+# - 語: 英数字のトークン（小文字化、"1,000,000" は "1000000" にまとめる）
+# - フィールド: actor（[BankAPI] など）, vendor, account（"MAINTENANCE-999" のような口座番号）, amount
+# - フレーズ: 隣り合う2語の組もインデックスし、フレーズ内の連続する2語の組がすべて含まれる行を返す
+#   （金額など数字を含む組は語の種類が際限なく増えるため索引せず、その部分は各語の AND で代用する）
+# - 時刻: 行ごとの記録時刻を持ち、時刻範囲は二分探索で行番号の範囲に変換する
+# ポスティングは行番号の昇順の配列（array('i')）なので、AND は短い順の積集合、時刻範囲は searchsorted で絞り込めます。
+# ログ（SegmentedLog）が古い行をディスクへ書き出すのに合わせて、同じ行の範囲のポスティングと時刻もセグメントファイル
+# （語のハッシュ -> 行番号の配列、.npz）へ書き出すため、常駐メモリはホット領域の分だけで一定です。
+# 検索は時刻範囲に掛かるセグメントだけを mmap し、語のハッシュを二分探索して該当するポスティングだけを読みます。
+# クエリ例:
+#   maintenance-999                 語
+#   "new balance"                   フレーズ
+#   actor:SecuritySystem vendor:AWS フィールド
+#   account:MAINTENANCE-999 -actor:screening   除外（先頭に "-"）
+# 環境変数:
+#   BANK_LOG_HOT_LIMIT: ホット領域の最大行数（ログと同じ値を使う, デフォルト 5000）
+
+FIELDS = ("actor", "vendor", "account", "amount")
+
+_LINE = re.compile(r"^\[(\d{2}:\d{2}:\d{2})\] \[([^\]]+)\] (.*)$", re.DOTALL)
+_THOUSANDS = re.compile(r"(?<=\d),(?=\d{3})")
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+_ACCOUNT = re.compile(r"\b[A-Z][A-Z0-9]*-\d[\d-]*\b")
+_VENDOR = re.compile(r"\b(?:to|for) ([A-Za-z0-9][\w.&-]*)")
+_AMOUNT = re.compile(r"(-?\d+) JPY")
+_QUERY = re.compile(r'(-?)(?:(\w+):)?(?:"([^"]*)"|(\S+))')
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(_THOUSANDS.sub("", text).lower())
+
+
+def _biword(a: str, b: str) -> str:
+    return f"{a}\0{b}"
+
+
+def _phrase_terms(tokens: List[str]) -> List[str]:
+    """フレーズを索引済みの語（数字を含まない2語の組、数字はそのまま）に変換します。"""
+    terms = []
+    for a, b in zip(tokens, tokens[1:]):
+        if a[0].isdigit() or b[0].isdigit():
+            terms.extend(t for t in (a, b) if t[0].isdigit())
+        else:
+            terms.append(_biword(a, b))
+    return list(dict.fromkeys(terms))
+
+
+def line_terms(line: str) -> Set[str]:
+    """1行から索引する語・2語の組・フィールドを取り出します。"""
+    match = _LINE.match(line)
+    actor, message = (match.group(2), match.group(3)) if match else (None, line)
+    tokens = tokenize(message)
+    terms = set(tokens)
+    terms.update(_biword(a, b) for a, b in zip(tokens, tokens[1:]) if not (a[0].isdigit() or b[0].isdigit()))
+    if actor:
+        terms.add(f"actor:{actor.lower()}")
+        terms.update(tokenize(actor))
+    normalized = _THOUSANDS.sub("", message)
+    terms.update(f"account:{a.lower()}" for a in _ACCOUNT.findall(message))
+    terms.update(f"vendor:{v.lower()}" for v in _VENDOR.findall(message))
+    terms.update(f"amount:{int(a)}" for a in _AMOUNT.findall(normalized))
+    return terms
+
+
+class QueryError(ValueError):
+    pass
+
+
+class ParsedQuery:
+    def __init__(self):
+        self.required: List[List[str]] = []  # 各要素は「すべて含む」語の組（1語 or フレーズの2語の組）
+        self.excluded: List[List[str]] = []
+
+
+def parse_query(query: str) -> ParsedQuery:
+    parsed = ParsedQuery()
+    for negate, field, phrase, word in _QUERY.findall(query):
+        value = phrase if phrase else word
+        if field:
+            if field.lower() not in FIELDS:
+                raise QueryError(f"Unknown field: {field} (allowed: {', '.join(FIELDS)})")
+            value = _THOUSANDS.sub("", value).strip().lower()
+            if field.lower() == "amount":
+                try:
+                    value = str(int(value))
+                except ValueError:
+                    raise QueryError(f"amount must be an integer: {value}")
+            terms = [f"{field.lower()}:{value}"]
+        else:
+            tokens = tokenize(value)
+            if not tokens:
+                continue
+            if phrase and len(tokens) > 1:
+                terms = _phrase_terms(tokens)
+            else:
+                terms = tokens
+        (parsed.excluded if negate else parsed.required).append(terms)
+    return parsed
+
+
+class _IndexSegment:
+    """
+    ディスクへ書き出した行番号 [start, start + count) のポスティングと時刻。
+    ファイルは keys（語のハッシュ, int64 昇順）, offsets（int64）, docs（行番号, int32）, ts（float64）を順に並べたもので、
+    検索のたびに mmap して必要な部分だけを読みます（常駐メモリにも、開いたままのファイルにもならない）。
+    """
+
+    def __init__(self, path: str, start: int, count: int, terms: int, postings: int, ts_first: float, ts_last: float):
+        self.path = path
+        self.start = start
+        self.count = count
+        self.terms = terms
+        self.postings = postings
+        self.ts_first = ts_first
+        self.ts_last = ts_last
+
+    def read(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """(keys, offsets, docs, ts) を mmap したファイル上のビューとして返します（ビューが無くなると閉じる）。"""
+        with open(self.path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        keys = np.frombuffer(mapped, dtype=np.int64, count=self.terms)
+        offset = keys.nbytes
+        offsets = np.frombuffer(mapped, dtype=np.int64, count=self.terms + 1, offset=offset)
+        offset += offsets.nbytes
+        docs = np.frombuffer(mapped, dtype=np.int32, count=self.postings, offset=offset)
+        offset += docs.nbytes
+        ts = np.frombuffer(mapped, dtype=np.float64, count=self.count, offset=offset)
+        return keys, offsets, docs, ts
+
+
+def _term_key(term: str) -> int:
+    """セグメントのファイルでは、語を 64bit のハッシュで持つ（語の文字列を保持しないため）"""
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+
+class LogIndex:
+    def __init__(self, directory: Optional[str] = None, hot_limit: Optional[int] = None, segment_lines: Optional[int] = None):
+        # directory を指定した場合、ログ（SegmentedLog）と同じ行数の区切りでポスティングをディスクへ書き出す
+        self.directory = directory
+        self.hot_limit = hot_limit or int(os.getenv("BANK_LOG_HOT_LIMIT", "5000"))
+        self.segment_lines = segment_lines or max(self.hot_limit // 2, 1)
+        self._segments: List[_IndexSegment] = []
+        self._postings: Dict[str, array] = {}  # ホット領域（行番号 >= _hot_start）のポスティング
+        self._ts = _Column(np.float64)         # ホット領域の行の時刻
+        self._hot_start = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._hot_start + self._ts.size
+
+    def add(self, line: str, ts: Optional[float] = None) -> int:
+        """行を追加し、その行番号を返します（行はログに追加した順に渡すこと）。"""
+        terms = line_terms(line)
+        with self._lock:
+            doc = self._hot_start + self._ts.size
+            self._ts.append(time.time() if ts is None else ts)
+            for term in terms:
+                posting = self._postings.get(term)
+                if posting is None:
+                    posting = self._postings[term] = array("i")
+                posting.append(doc)
+            if self.directory is not None and self._ts.size > self.hot_limit:
+                self._spill(self.segment_lines)
+        return doc
+
+    # --- Segments ---
+
+    def _spill(self, count: int) -> None:
+        """ホット領域の先頭 count 行分のポスティングと時刻を、1つのセグメントファイルへ書き出します。"""
+        boundary = self._hot_start + count
+        entries: List[Tuple[int, np.ndarray]] = []
+        postings: Dict[str, array] = {}
+        for term, posting in self._postings.items():
+            values = np.frombuffer(posting, dtype=np.int32)
+            cut = int(np.searchsorted(values, boundary))
+            if cut:
+                entries.append((_term_key(term), values[:cut].copy()))
+            if cut < len(values):
+                rest = array("i")
+                rest.frombytes(values[cut:].tobytes())
+                postings[term] = rest
+            del values
+        entries.sort(key=lambda e: e[0])
+        ts = self._ts.values
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"index-{self._hot_start:012d}.bin")
+        docs = np.concatenate([e[1] for e in entries]) if entries else np.empty(0, dtype=np.int32)
+        with open(path, "wb") as f:
+            f.write(np.array([e[0] for e in entries], dtype=np.int64).tobytes())
+            f.write(np.cumsum([0] + [len(e[1]) for e in entries], dtype=np.int64).tobytes())
+            f.write(docs.astype(np.int32, copy=False).tobytes())
+            f.write(np.ascontiguousarray(ts[:count], dtype=np.float64).tobytes())
+        self._segments.append(
+            _IndexSegment(path, self._hot_start, count, len(entries), len(docs), float(ts[0]), float(ts[count - 1]))
+        )
+        hot_ts = _Column(np.float64)
+        hot_ts.extend(ts[count:])
+        self._postings, self._ts, self._hot_start = postings, hot_ts, boundary
+
+    def archive(self, archive_dir: str) -> None:
+        """セグメントファイルを archive_dir へ移動します（ログのアーカイブと一緒に退避する）。"""
+        with self._lock:
+            if not self._segments:
+                return
+            os.makedirs(archive_dir, exist_ok=True)
+            for segment in self._segments:
+                archived = os.path.join(archive_dir, os.path.basename(segment.path))
+                shutil.move(segment.path, archived)
+                segment.path = archived
+            try:
+                os.rmdir(self.directory)
+            except OSError:
+                pass
+
+    # --- Search ---
+
+    def _parts(self, start: Optional[float], end: Optional[float]) -> Iterator[Tuple[int, np.ndarray, Callable[[str], Optional[np.ndarray]]]]:
+        """時刻範囲に掛かる区間ごとに (先頭の行番号, 時刻, 語 -> ポスティング) を返します。"""
+        for segment in self._segments:
+            if (start is not None and segment.ts_last < start) or (end is not None and segment.ts_first > end):
+                continue
+            keys, offsets, docs, ts = segment.read()
+
+            def posting(term: str, keys=keys, offsets=offsets, docs=docs) -> Optional[np.ndarray]:
+                key = _term_key(term)
+                lo, hi = int(np.searchsorted(keys, key, side="left")), int(np.searchsorted(keys, key, side="right"))
+                if lo == hi:
+                    return None
+                if hi - lo == 1:
+                    return docs[offsets[lo]:offsets[lo + 1]].copy()
+                # ハッシュが衝突した語はまとめて扱う（余分な行が一致しうるだけで、取りこぼしはない）
+                return np.unique(docs[offsets[lo]:offsets[hi]])
+
+            yield segment.start, ts, posting
+            del keys, offsets, docs, ts, posting
+
+        def hot(term: str) -> Optional[np.ndarray]:
+            posting = self._postings.get(term)
+            # array はバッファを公開している間は伸長できないため、コピーして返す
+            return None if posting is None else np.frombuffer(posting, dtype=np.int32).copy()
+
+        yield self._hot_start, self._ts.values, hot
+
+    @staticmethod
+    def _docs(posting: Callable[[str], Optional[np.ndarray]], terms: List[str], lo: int, hi: int) -> np.ndarray:
+        """terms をすべて含み、行番号が [lo, hi) の行"""
+        arrays = []
+        for term in terms:
+            values = posting(term)
+            if values is None:
+                return np.empty(0, dtype=np.int32)
+            arrays.append(values[np.searchsorted(values, lo):np.searchsorted(values, hi)])
+        arrays.sort(key=len)
+        result = arrays[0]
+        for other in arrays[1:]:
+            if not len(result):
+                break
+            result = np.intersect1d(result, other, assume_unique=True)
+        return result
+
+    def search(self, query: str, start: Optional[float] = None, end: Optional[float] = None) -> np.ndarray:
+        """クエリに一致する行番号（昇順）を返します。クエリが空なら時刻範囲内のすべての行。"""
+        parsed = parse_query(query)
+        results = []
+        with self._lock:
+            for first, ts, posting in self._parts(start, end):
+                lo = first + (0 if start is None else int(np.searchsorted(ts, start, side="left")))
+                hi = first + (len(ts) if end is None else int(np.searchsorted(ts, end, side="right")))
+                if lo >= hi:
+                    continue
+                if parsed.required:
+                    docs = self._docs(posting, parsed.required[0], lo, hi)
+                    for terms in parsed.required[1:]:
+                        if not len(docs):
+                            break
+                        docs = np.intersect1d(docs, self._docs(posting, terms, lo, hi), assume_unique=True)
+                else:
+                    docs = np.arange(lo, hi, dtype=np.int32)
+                for terms in parsed.excluded:
+                    if not len(docs):
+                        break
+                    docs = np.setdiff1d(docs, self._docs(posting, terms, lo, hi), assume_unique=True)
+                results.append(docs.astype(np.int32, copy=False))
+        return np.concatenate(results) if results else np.empty(0, dtype=np.int32)
+
+    def timestamps(self, docs: np.ndarray) -> List[float]:
+        docs = np.asarray(docs, dtype=np.int64)
+        result = np.full(len(docs), np.nan)
+        with self._lock:
+            for segment in self._segments:
+                mask = (docs >= segment.start) & (docs < segment.start + segment.count)
+                if mask.any():
+                    ts = segment.read()[3]
+                    result[mask] = ts[docs[mask] - segment.start]
+                    del ts
+            mask = docs >= self._hot_start
+            result[mask] = self._ts.values[docs[mask] - self._hot_start]
+        return result.tolist()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "lines": len(self),
+                "terms": len(self._postings),
+                "postings": sum(len(p) for p in self._postings.values()) + sum(s.postings for s in self._segments),
+                "segments": len(self._segments),
+            }
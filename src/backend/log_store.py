@@ -0,0 +1,187 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+# --- Segmented Log Store ---
+# 銀行ログをメモリ上の「ホットな末尾」と、ディスク上の圧縮セグメントファイルに分けて保持します。
+# ホット領域が hot_limit 行を超えると、古い行から segment_lines 行ずつ gzip ファイルへ書き出します。
+# 読み出しはセグメントを1行ずつストリーミングするため、履歴が増えても常駐メモリは一定です。
+# 環境変数:
+#   BANK_LOG_DIR: セグメントの保存先 (デフォルトは一時ディレクトリ)。ログごとに name のサブディレクトリを使う
+#   BANK_LOG_HOT_LIMIT: メモリ上に保持する最大行数 (デフォルト 5000)
+
+_base_dir: Optional[str] = None
+_base_dir_lock = threading.Lock()
+
+
+def _default_base_dir() -> str:
+    global _base_dir
+    with _base_dir_lock:
+        if _base_dir is None:
+            _base_dir = os.getenv("BANK_LOG_DIR") or tempfile.mkdtemp(prefix="taxmate-logs-")
+        return _base_dir
+
+
+def _read_segment(path: str) -> Iterator[str]:
+    yield from _iter_lines(gzip.open(path, "rt", encoding="utf-8"))
+
+
+def _iter_lines(f) -> Iterator[str]:
+    with f:
+        for raw in f:
+            yield json.loads(raw)
+
+
+class _Segment:
+    def __init__(self, path: str, start: int, count: int):
+        self.path = path
+        self.start = start
+        self.count = count
+
+
+class SegmentedLog:
+    def __init__(self, name: str = "bank", directory: Optional[str] = None, hot_limit: Optional[int] = None, segment_lines: Optional[int] = None):
+        # ディレクトリは最初の書き出し時に作成する（セッションごとのログを安価に作れるように）
+        self.directory = directory or os.path.join(_default_base_dir(), name)
+        self.hot_limit = hot_limit or int(os.getenv("BANK_LOG_HOT_LIMIT", "5000"))
+        self.segment_lines = segment_lines or max(self.hot_limit // 2, 1)
+        self._segments: List[_Segment] = []
+        self._hot: List[str] = []
+        self._hot_start = 0  # ホット領域の先頭行の通し番号
+        self._lock = threading.RLock()
+
+    # --- Write ---
+
+    def append(self, line: str) -> None:
+        with self._lock:
+            self._hot.append(line)
+            if len(self._hot) > self.hot_limit:
+                self._spill(self.segment_lines)
+
+    def _spill(self, count: int) -> None:
+        lines, self._hot = self._hot[:count], self._hot[count:]
+        if not lines:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"segment-{self._hot_start:012d}.log.gz")
+        with gzip.open(path, "wt", encoding="utf-8", compresslevel=6) as f:
+            for line in lines:
+                f.write(json.dumps(line, ensure_ascii=False))
+                f.write("\n")
+        self._segments.append(_Segment(path, self._hot_start, len(lines)))
+        self._hot_start += len(lines)
+
+    def archive(self) -> Optional[str]:
+        """
+        現在のログをすべてセグメントに書き出し、アーカイブ用ディレクトリへ移動して空にします。
+        /reset 後も過去の監査証跡がディスク上に残ります。
+        """
+        with self._lock:
+            self._spill(len(self._hot))
+            if not self._segments:
+                self._hot_start = 0
+                return None
+            archive_dir = os.path.join(self.directory, "archive", time.strftime("%Y%m%d-%H%M%S") + f"-{time.time_ns() % 1_000_000:06d}")
+            os.makedirs(archive_dir, exist_ok=True)
+            for segment in self._segments:
+                archived = os.path.join(archive_dir, os.path.basename(segment.path))
+                shutil.move(segment.path, archived)
+                # 移動前にセグメント一覧を取得したリーダーも、移動後のファイルを読めるようにする
+                segment.path = archived
+            self._segments = []
+            self._hot_start = 0
+            return archive_dir
+
+    # --- Read ---
+
+    def _read(self, segment: _Segment) -> Iterator[str]:
+        # パスの解決とファイルを開くまでをロック内で行う（開いた後は archive() で移動されても読み続けられる）
+        with self._lock:
+            f = gzip.open(segment.path, "rt", encoding="utf-8")
+        yield from _iter_lines(f)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._hot_start + len(self._hot)
+
+    def __iter__(self) -> Iterator[str]:
+        return self.iter_range(0, None)
+
+    def iter_range(self, start: int = 0, stop: Optional[int] = None) -> Iterator[str]:
+        """
+        通し番号 [start, stop) の行をストリーミングで返します（必要なセグメントだけを読みます）。
+        対象の行は呼び出した時点で確定します（他のログと同じロック内で呼べば、同じ時点の内容を読める）。
+        """
+        with self._lock:
+            segments = list(self._segments)
+            hot = list(self._hot)
+            hot_start = self._hot_start
+        stop = hot_start + len(hot) if stop is None else stop
+        return self._iter_range(segments, hot, hot_start, start, stop)
+
+    def _iter_range(self, segments: List[_Segment], hot: List[str], hot_start: int, start: int, stop: int) -> Iterator[str]:
+        for segment in segments:
+            if segment.start + segment.count <= start or segment.start >= stop:
+                continue
+            for offset, line in enumerate(self._read(segment)):
+                pos = segment.start + offset
+                if pos >= stop:
+                    break
+                if pos >= start:
+                    yield line
+        yield from hot[max(start - hot_start, 0):max(stop - hot_start, 0)]
+
+    def get_many(self, positions: List[int]) -> List[str]:
+        """指定した通し番号の行を返します（各セグメントは1度だけ読む）。範囲外の番号は無視します。"""
+        wanted = sorted(set(positions))
+        with self._lock:
+            segments = list(self._segments)
+            hot = list(self._hot)
+            hot_start = self._hot_start
+        found: Dict[int, str] = {}
+        i = 0
+        for segment in segments:
+            end = segment.start + segment.count
+            while i < len(wanted) and wanted[i] < segment.start:
+                i += 1
+            if i == len(wanted) or wanted[i] >= end:
+                continue
+            for offset, line in enumerate(self._read(segment)):
+                pos = segment.start + offset
+                if pos == wanted[i]:
+                    found[pos] = line
+                    i += 1
+                    if i == len(wanted) or wanted[i] >= end:
+                        break
+        for pos in wanted[i:]:
+            if hot_start <= pos < hot_start + len(hot):
+                found[pos] = hot[pos - hot_start]
+        return [found[p] for p in positions if p in found]
+
+    def tail(self, n: int) -> List[str]:
+        total = len(self)
+        return list(self.iter_range(max(total - n, 0), total))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            lines = list(self.iter_range(start, stop))
+            return lines[::step] if step != 1 else lines
+        total = len(self)
+        if index < 0:
+            index += total
+        if not 0 <= index < total:
+            raise IndexError("log index out of range")
+        return next(self.iter_range(index, index + 1))
+
+    @staticmethod
+    def iter_archive(archive_dir: str) -> Iterator[str]:
+        """archive() で退避したログをストリーミングで読み出します。"""
+        for name in sorted(os.listdir(archive_dir)):
+            if name.endswith(".log.gz"):
+                yield from _read_segment(os.path.join(archive_dir, name))
@@ -1,5 +1,39 @@
-from typing import List, Dict
+from types import MappingProxyType
+from typing import Iterator, List, Dict, Mapping, Optional, Tuple
 import datetime
+import itertools
+import os
+import threading
+import time
+import uuid
+
+from src.backend.audit_rules import AuditRules
+from src.backend.event_log import EventLog, EVENT_RESET, EVENT_LOG, EVENT_ACCOUNT_CHANGED, EVENT_PAYMENT
+from src.backend.log_store import SegmentedLog
+from src.backend.log_index import LogIndex
+from src.backend.screening import TransactionScreener, ScreeningResult, HeldOperation, BLOCK, HOLD
+from src.backend.vendor_registry import VendorRegistry
+from src.backend.ledger import Ledger, InsufficientFundsError, vendor_account
+from src.backend.settlement import PendingPayment, SettlementBatcher, net_payments, settlement_mode
+
+# 初期状態（シードスナップショット）
+# セッションごとの銀行はこの辞書を共有して作成され、最初の書き込み時にコピーされる（Copy-on-Write）
+SEED_SNAPSHOT: Mapping[str, Mapping] = MappingProxyType({
+    "accounts": MappingProxyType({
+        "AWS": "AWS-1234-5678",
+        "Azure": "MS-8765-4321",
+        "Google": "GOOG-1122-3344"
+    }),
+    "balances": MappingProxyType({
+        "COMPANY_MAIN": 10000000
+    }),
+})
+
+# 送金元の勘定
+MAIN_ACCOUNT = "COMPANY_MAIN"
+
+# 取引先名の表記ゆれを解決するマスタ（全セッションで共有。取引先を追加した銀行は追加分だけをオーバーレイに持つ）
+vendor_registry = VendorRegistry.from_vendors(SEED_SNAPSHOT["accounts"])
 
 class MockBank:
     _instance = None
@@ -13,25 +47,154 @@ class MockBank:
     def __init__(self):
         if self._initialized:
             return
+        self.session_id = "default"
         self.reset()
         self._initialized = True
 
-    def reset(self):
+    @classmethod
+    def from_snapshot(cls, session_id: str, snapshot: Mapping[str, Mapping] = SEED_SNAPSHOT) -> "MockBank":
+        """
+        シングルトンとは独立した銀行インスタンスを作成します（セッション用）。
+        口座・残高はスナップショットを共有し、最初の書き込み時にコピーします。
+        """
+        bank = super().__new__(cls)
+        bank._initialized = True
+        bank.session_id = session_id
+        bank.reset(snapshot)
+        return bank
+
+    def snapshot(self) -> Mapping[str, Mapping]:
+        """現在の口座・残高の読み取り専用スナップショットを返します。"""
+        return MappingProxyType({
+            "accounts": MappingProxyType(dict(self.accounts)),
+            "balances": MappingProxyType(dict(self.balances)),
+        })
+
+    def reset(self, snapshot: Mapping[str, Mapping] = SEED_SNAPSHOT):
         """銀行の状態を初期化します。"""
-        self.accounts: Dict[str, str] = {
-            "AWS": "AWS-1234-5678",
-            "Azure": "MS-8765-4321",
-            "Google": "GOOG-1122-3344"
-        }
-        self.balances: Dict[str, int] = {
-            "COMPANY_MAIN": 10000000
-        }
-        self.logs: List[str] = []
+        # ツールの並列実行に備え、状態の更新は口座・残高単位でまとめてロックする
+        if getattr(self, "_lock", None) is None:
+            self._lock = threading.RLock()
+        self.accounts: Mapping[str, str] = snapshot["accounts"]
+        self._shared_state = True
+        # 取引先名の辞書も、取引先を追加するまでは共有のマスタを使う（追加分はオーバーレイに持つ）
+        self.vendors: VendorRegistry = vendor_registry
+        self._shared_vendors = True
+        # 残高は複式簿記の台帳で管理する（期首残高はスナップショットから）
+        self.ledger = Ledger.from_balances(snapshot["balances"])
+        # ログはメモリ上の末尾 + ディスク上の圧縮セグメントで保持する
+        # 状態を変えた操作のイベント列（再構築・what-if 監査用）も同様
+        # リセット時も過去のログ・イベント列は破棄せず、アーカイブとしてディスクに残す
+        if getattr(self, "logs", None) is None:
+            self.logs = SegmentedLog(self.logs_name())
+            self.events = EventLog(f"{self.logs_name()}-events")
+        else:
+            self.archive()
+        # リセットごとに変わるID。クライアントはこれが変わったらキャッシュしたログ・監査結果を捨てる
+        self.log_epoch = uuid.uuid4().hex[:12]
+        # ログの転置インデックス（行番号 = ログ上の通し番号）。ログと同じ行数の区切りでディスクへ書き出す
+        self.log_index = LogIndex(
+            os.path.join(self.logs.directory, "index", self.log_epoch),
+            hot_limit=self.logs.hot_limit, segment_lines=self.logs.segment_lines,
+        )
+        self.events.append(EVENT_RESET, accounts=dict(snapshot["accounts"]), balances=dict(snapshot["balances"]))
+        # 監査ルールと、取引先ごとの統計的異常検知（列指向で増分更新）
+        self.audit_rules = AuditRules()
+        self.analytics = self.audit_rules.analytics()
+        # 文字列ルールの異常（ログの追加時に1行ずつ評価して溜める）
+        self.line_anomalies: List[Dict[str, str]] = []
+        # 確定前の同期スクリーニングと、保留中の操作
+        self.screener = TransactionScreener()
+        self.holds: Dict[str, HeldOperation] = {}
+        self._hold_ids = itertools.count(1)
+        # 取引先ごとの口座変更履歴
+        self.account_history: Dict[str, List[Dict[str, str]]] = {}
+        # まとめて決済するモードでは、送金をウィンドウの間溜めておく（リセット時に未決済分は破棄）
+        if getattr(self, "_settlement_timer", None) is not None:
+            self._settlement_timer.cancel()
+        self._settlement_timer = None
+        self.settlement = SettlementBatcher() if settlement_mode() == "batch" else None
         self.log_operation("System", "System initialized.")
 
+    def archive(self) -> Optional[str]:
+        """ログ（とそのインデックス）・イベント列をディスク上のアーカイブへ退避して空にします（リセット・セッション破棄時）。"""
+        with self._lock:
+            archive_dir = self.logs.archive()
+            if archive_dir is not None:
+                self.log_index.archive(os.path.join(archive_dir, "index"))
+            self.events.archive(archive_dir)
+            return archive_dir
+
+    def logs_name(self) -> str:
+        return "bank" if self.session_id == "default" else f"session-{self.session_id}"
+
+    def _own_state(self):
+        """共有中のスナップショットを書き込み前に自分専用へコピーします（Copy-on-Write）。"""
+        if self._shared_state:
+            self.accounts = dict(self.accounts)
+            self._shared_state = False
+
+    @property
+    def balances(self) -> Mapping[str, int]:
+        """資産勘定の現在残高（台帳から O(1) で取得）。"""
+        return self.ledger.balances_view()
+
     def log_operation(self, actor: str, action: str):
-        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-        self.logs.append(f"[{timestamp}] [{actor}] {action}")
+        now = time.time()
+        timestamp = datetime.datetime.fromtimestamp(now).strftime("%H:%M:%S")
+        line = f"[{timestamp}] [{actor}] {action}"
+        # ログ・インデックス・イベント列の順序を揃えるため、銀行のロック内で追加する
+        # イベント列には行そのものではなく、ログ上の通し番号を記録する（行はログにだけ保存する）
+        with self._lock:
+            pos = len(self.logs)
+            self.logs.append(line)
+            self.log_index.add(line, now)
+            self.events.append(EVENT_LOG, ts=now, pos=pos)
+            anomaly = self.audit_rules.scan_line(line)
+            if anomaly is not None:
+                self.line_anomalies.append(anomaly)
+
+    def _resolve_vendor(self, vendor: str, log: bool = False) -> Optional[str]:
+        """
+        取引先名を、この銀行に口座のある正規の名前に解決します（完全一致しない場合はマスタの名前・別名で解決）。
+        大文字小文字・法人格・記号の違いや登録済みの別名では "Vendor not found" にならないようにします。
+        頭字語・トライグラムによるあいまい一致では解決しません（"Acme Web Studio" を AWS へ送金するような誤りを防ぐ。
+        あいまい一致の候補は、見つからなかった場合の "Did you mean" として返すだけにする）。
+        log=True（口座変更・送金）の場合だけ、解決した内容を銀行ログに残します（参照系の操作では監査ログを汚さない）。
+        """
+        if vendor in self.accounts:
+            return vendor
+        match = self.vendors.resolve(vendor, fuzzy=False)
+        if match is None or match.vendor not in self.accounts:
+            return None
+        if log:
+            self.log_operation("BankAPI", f"Resolved vendor name '{vendor}' -> '{match.vendor}' ({match.method})")
+        return match.vendor
+
+    def _vendor_not_found(self, vendor: str) -> str:
+        match = self.vendors.resolve(vendor)
+        candidates = ([match] if match is not None else []) + self.vendors.search(vendor, limit=3, threshold=0.2)
+        suggestions = list(dict.fromkeys(m.vendor for m in candidates if m.vendor in self.accounts))[:3]
+        hint = f" Did you mean: {', '.join(suggestions)}?" if suggestions else f" Known vendors: {', '.join(self.accounts)}."
+        return f"ERROR: Vendor {vendor} not found.{hint}"
+
+    def _screen(self, result: ScreeningResult, operation: str, vendor: str, params: Dict[str, object], role: str) -> Optional[str]:
+        """
+        スクリーニング結果を適用します。操作を止める場合はエージェントへ返すメッセージを、続行する場合は None を返します。
+        ログにはルール名と理由だけを記録する（ブラックリストの口座文字列そのものは書かない）。
+        """
+        if result.outcome not in (BLOCK, HOLD):
+            return None
+        if not self.screener.enforcing:
+            self.log_operation("Screening", f"MONITOR: would {result.outcome} {operation} for {vendor} [{result.rule}] {result.reason}")
+            return None
+        if result.outcome == BLOCK:
+            self.log_operation("Screening", f"BLOCK {operation} for {vendor} [{result.rule}] {result.reason}")
+            return f"ERROR: Blocked by pre-commit screening [{result.rule}]. {result.reason}. The operation was not executed."
+        hold_id = f"hold-{next(self._hold_ids)}"
+        self.holds[hold_id] = HeldOperation(hold_id, operation, vendor, params, result, role)
+        self.log_operation("Screening", f"HOLD {operation} for {vendor} [{result.rule}] {result.reason} (hold_id={hold_id})")
+        return f"PENDING: Held for manual review by pre-commit screening [{result.rule}]. {result.reason}. The operation was not executed yet (hold_id={hold_id})."
 
     def update_account(self, vendor: str, new_account: str, role: str = "ADMIN") -> str:
         """取引先の口座情報を更新します。"""
@@ -41,11 +204,40 @@ class MockBank:
             self.log_operation("SecuritySystem", msg)
             return f"ERROR: Permission Denied. {msg}"
         
+        with self._lock:
+            vendor = self._resolve_vendor(vendor, log=True) or vendor
+            if self.screener.enabled:
+                stopped = self._screen(
+                    self.screener.screen_account_change(vendor, new_account),
+                    "update_account", vendor, {"new_account": new_account}, role
+                )
+                if stopped:
+                    return stopped
+            msg = self._commit_account_change(vendor, new_account)
+        return f"SUCCESS: {msg}"
+
+    def _commit_account_change(self, vendor: str, new_account: str) -> str:
         old_account = self.accounts.get(vendor, "UNKNOWN")
+        self._own_state()
         self.accounts[vendor] = new_account
+        if vendor not in self.vendors:
+            if self._shared_vendors:
+                # 他のセッションの解決結果に影響しないよう、共有の辞書には追加せず自分専用のオーバーレイに追加する
+                self.vendors = self.vendors.overlay()
+                self._shared_vendors = False
+            self.vendors.add_vendor(vendor)
+        self.account_history.setdefault(vendor, []).append({
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "old_account": old_account,
+            "new_account": new_account,
+        })
+        now = time.time()
+        self.analytics.record_account_change(vendor, now)
+        self.events.append(EVENT_ACCOUNT_CHANGED, ts=now, vendor=vendor, account=new_account)
+        self.screener.commit_account_change(vendor)
         msg = f"Updated account for {vendor}: {old_account} -> {new_account}"
         self.log_operation("BankAPI", msg)
-        return f"SUCCESS: {msg}"
+        return msg
 
     def send_money(self, vendor: str, amount: int, role: str = "ADMIN") -> str:
         """指定した取引先に送金します。"""
@@ -55,13 +247,167 @@ class MockBank:
             self.log_operation("SecuritySystem", msg)
             return f"ERROR: Permission Denied. {msg}"
 
-        account = self.accounts.get(vendor)
-        if not account:
-            return f"ERROR: Vendor {vendor} not found."
-        
-        self.balances["COMPANY_MAIN"] -= amount
-        msg = f"Sent {amount:,} JPY to {vendor} ({account}). New Balance: {self.balances['COMPANY_MAIN']:,} JPY"
+        # 0 以下・整数でない金額は、台帳に逆向きの仕訳を作らないよう送金前に拒否する
+        if isinstance(amount, bool) or not isinstance(amount, int) or amount <= 0:
+            msg = f"Payment to {vendor} rejected: invalid amount {amount!r} (must be a positive integer JPY)"
+            self.log_operation("BankAPI", msg)
+            return f"ERROR: {msg}"
+
+        with self._lock:
+            resolved = self._resolve_vendor(vendor, log=True)
+            if resolved is None:
+                return self._vendor_not_found(vendor)
+            vendor = resolved
+            account = self.accounts[vendor]
+
+            # 残高不足の送金は、スクリーニングや保留の前に拒否する（決済待ちの送金も含めて判定）
+            pending = self.settlement.pending_total if self.settlement is not None else 0
+            if not self.ledger.can_pay(MAIN_ACCOUNT, amount + pending):
+                return self._insufficient_funds(vendor, amount)
+
+            if self.screener.enabled:
+                stopped = self._screen(
+                    self.screener.screen_payment(vendor, account, amount),
+                    "send_money", vendor, {"amount": amount}, role
+                )
+                if stopped:
+                    return stopped
+            if self.settlement is not None:
+                return self._queue_payment(vendor, account, amount)
+            msg = self._commit_payment(vendor, account, amount)
+        return f"SUCCESS: {msg}"
+
+    def _insufficient_funds(self, vendor: str, amount: int) -> str:
+        pending = self.settlement.pending_total if self.settlement is not None else 0
+        reserved = f", {pending:,} JPY reserved for pending settlement" if pending else ""
+        msg = f"Payment of {amount:,} JPY to {vendor} rejected: insufficient funds (balance {self.ledger.balance(MAIN_ACCOUNT):,} JPY{reserved})"
         self.log_operation("BankAPI", msg)
+        return f"ERROR: {msg}"
+
+    def _commit_payment(self, vendor: str, account: str, amount: int) -> str:
+        now = time.time()
+        self.ledger.record_payment(MAIN_ACCOUNT, vendor, amount, memo=f"Payment to {vendor} ({account})", timestamp=now)
+        self.analytics.record_payment(vendor, amount, now)
+        self.events.append(EVENT_PAYMENT, ts=now, vendor=vendor, account=account, amount=amount)
+        self.screener.commit_payment(vendor, amount)
+        msg = f"Sent {amount:,} JPY to {vendor} ({account}). New Balance: {self.ledger.balance(MAIN_ACCOUNT):,} JPY"
+        self.log_operation("BankAPI", msg)
+        return msg
+
+    def _queue_payment(self, vendor: str, account: str, amount: int) -> str:
+        # 受け付けた送金の分は残高を予約しておく（決済待ちの合計を含めて残高が足りなければ受け付けない）
+        if not self.ledger.can_pay(MAIN_ACCOUNT, amount + self.settlement.pending_total):
+            return self._insufficient_funds(vendor, amount)
+        payment = self.settlement.add(vendor, account, amount)
+        # 速度ルールが決済待ちの送金も数えるよう、スクリーニングのカウンタには受付時点で反映する
+        self.screener.commit_payment(vendor, amount)
+        msg = f"Queued {amount:,} JPY to {vendor} ({account}) for batch settlement (allocation_id={payment.allocation_id})"
+        self.log_operation("BankAPI", msg)
+        if self.settlement.full:
+            self.settle_pending()
+        elif self._settlement_timer is None:
+            self._settlement_timer = threading.Timer(self.settlement.window, self.settle_pending)
+            self._settlement_timer.daemon = True
+            self._settlement_timer.start()
+        return f"SUCCESS: {msg}"
+
+    def settle_pending(self) -> Optional[Dict[str, object]]:
+        """
+        決済待ちの送金を取引先・口座ごとに相殺し、1件の仕訳でまとめて決済します。
+        ログと異常検知には、請求書ごとの送金（割当）を従来どおり "Sent ... JPY to ..." として1件ずつ記録します。
+        受付時に残高を予約しているため通常は全件決済されますが、残高が足りない場合は受け付けた順に収まる分だけ決済し、
+        収まらなかった送金は1件ずつログに残して結果の "failed" に返します（バッチ全体は破棄しない）。
+        """
+        with self._lock:
+            if self._settlement_timer is not None:
+                self._settlement_timer.cancel()
+                self._settlement_timer = None
+            if self.settlement is None or not self.settlement.pending:
+                return None
+            payments = self.settlement.drain()
+            settlement_id = self.settlement.next_settlement_id()
+            failed: List[PendingPayment] = []
+            available = self.ledger.balance(MAIN_ACCOUNT)
+            if sum(p.amount for p in payments) > available:
+                accepted = []
+                for payment in payments:
+                    if payment.amount <= available:
+                        accepted.append(payment)
+                        available -= payment.amount
+                    else:
+                        failed.append(payment)
+                        self.log_operation(
+                            "BankAPI",
+                            f"Payment of {payment.amount:,} JPY to {payment.vendor} rejected at settlement {settlement_id}: "
+                            f"insufficient funds (allocation_id={payment.allocation_id})"
+                        )
+                payments = accepted
+            nets = net_payments(payments)
+            total = sum(nets.values())
+            postings = [(vendor_account(vendor), amount) for (vendor, _), amount in nets.items() if amount]
+            if postings:
+                try:
+                    self.ledger.post(postings + [(MAIN_ACCOUNT, -total)], memo=f"Settlement {settlement_id}")
+                except InsufficientFundsError as e:
+                    # 上で残高に収まる分だけに絞っているため、ここには来ない想定
+                    self.log_operation("BankAPI", f"Settlement {settlement_id} failed: {e}. {len(payments)} payments were not executed.")
+                    return None
+            for payment in payments:
+                now = time.time()
+                self.analytics.record_payment(payment.vendor, payment.amount, now)
+                self.events.append(
+                    EVENT_PAYMENT, ts=now, vendor=payment.vendor, account=payment.account, amount=payment.amount,
+                    settlement_id=settlement_id, allocation_id=payment.allocation_id
+                )
+                self.log_operation(
+                    "BankAPI",
+                    f"Sent {payment.amount:,} JPY to {payment.vendor} ({payment.account}) "
+                    f"[settlement {settlement_id}, allocation_id={payment.allocation_id}]"
+                )
+            failed_note = f", {len(failed)} payments failed" if failed else ""
+            self.log_operation(
+                "BankAPI",
+                f"Settlement {settlement_id}: {len(payments)} payments netted into {len(nets)} transfers "
+                f"({total:,} JPY{failed_note}). New Balance: {self.ledger.balance(MAIN_ACCOUNT):,} JPY"
+            )
+            return self.settlement.record(settlement_id, nets, payments, failed)
+
+    def get_account_history(self, vendor: str) -> List[Dict[str, str]]:
+        with self._lock:
+            vendor = self._resolve_vendor(vendor) or vendor
+            return list(self.account_history.get(vendor, []))
+
+    def list_holds(self) -> List[Dict[str, object]]:
+        with self._lock:
+            return [h.to_dict() for h in self.holds.values()]
+
+    def resolve_hold(self, hold_id: str, approved: bool, role: str = "ADMIN") -> str:
+        """スクリーニングで保留された操作を、人間の判断で実行または却下します。"""
+        if role == "READ_ONLY":
+            msg = f"BLOCKED: User with role '{role}' is not authorized to resolve held operations."
+            self.log_operation("SecuritySystem", msg)
+            return f"ERROR: Permission Denied. {msg}"
+
+        with self._lock:
+            held = self.holds.pop(hold_id, None)
+            if held is None:
+                return f"ERROR: Hold {hold_id} not found."
+            if not approved:
+                self.log_operation("Screening", f"REJECTED {held.operation} for {held.vendor} (hold_id={hold_id})")
+                return f"REJECTED: {held.operation} for {held.vendor} was not executed."
+            self.log_operation("Screening", f"RELEASED {held.operation} for {held.vendor} (hold_id={hold_id})")
+            if held.operation == "update_account":
+                msg = self._commit_account_change(held.vendor, held.params["new_account"])
+            else:
+                account = self.accounts.get(held.vendor)
+                if not account:
+                    return f"ERROR: Vendor {held.vendor} not found."
+                if self.settlement is not None:
+                    return self._queue_payment(held.vendor, account, held.params["amount"])
+                try:
+                    msg = self._commit_payment(held.vendor, account, held.params["amount"])
+                except InsufficientFundsError:
+                    return self._insufficient_funds(held.vendor, held.params["amount"])
         return f"SUCCESS: {msg}"
 
     def audit_logs(self) -> List[Dict[str, str]]:
@@ -70,28 +416,84 @@ class MockBank:
         検知ルール:
         1. 金額の異常: 10,000円を超える送金 (本来は5,000円付近のはず)
         2. ブラックリスト: "MAINTENANCE-999" や "HACKER" を含むログ
+        3. 統計的異常: 取引先ごとの z-score / 送金速度 / 口座変更直後の送金 (LedgerAnalytics)
+        しきい値は self.audit_rules（AuditRules）にまとめてある。
         """
-        anomalies = []
-        for log in self.logs:
-            # Check 1: Blacklist
-            if "MAINTENANCE-999" in log or "HACKER" in log:
-                anomalies.append({"type": "BLACKLIST_HIT", "log": log, "severity": "HIGH"})
-                continue
-                
-            # Check 2: Amount anomaly (Heuristic)
-            # ログの文字列から "Sent X,XXX JPY" を簡易パース
-            if "Sent" in log and "JPY" in log:
-                try:
-                    parts = log.split("Sent ")[1].split(" JPY")[0]
-                    amount = int(parts.replace(",", ""))
-                    if amount > 10000: # Threshold
-                         anomalies.append({"type": "AMOUNT_ANOMALY", "log": log, "severity": "MEDIUM", "details": f"Amount {amount:,} > 10,000"})
-                except:
-                    pass
+        # Check 1, 2: Blacklist / Amount anomaly (evaluated per line in log_operation)
+        anomalies = list(self.line_anomalies)
         
+        # Check 3: Per-vendor statistics (incrementally maintained)
+        anomalies.extend(self.analytics.anomalies)
         return anomalies
 
+    def audit_version(self) -> Tuple[str, int, int, int]:
+        """監査結果が変わると変わる値（ETag 用）"""
+        return self.log_epoch, len(self.line_anomalies), len(self.analytics.anomalies), self.analytics.ts.size
+
+    def audit_window(self, offset: int = 0, limit: Optional[int] = None) -> Dict[str, object]:
+        """
+        監査結果の一部（audit_logs の [offset, offset + limit)）を返します。
+        counts（文字列ルール・統計ルールの件数）が変わらない限り、同じ範囲は同じ内容になります。
+        """
+        with self._lock:
+            rules = len(self.line_anomalies)
+            statistical = list(self.analytics.anomalies)
+            total = rules + len(statistical)
+            stop = total if limit is None else min(offset + limit, total)
+            page = self.line_anomalies[offset:min(stop, rules)]
+            page += statistical[max(offset - rules, 0):max(stop - rules, 0)]
+            return {
+                "epoch": self.log_epoch,
+                "total": total,
+                "counts": {"rules": rules, "statistical": len(statistical)},
+                "offset": offset,
+                "anomalies": page,
+            }
+
+    def search_logs(self, query: str, start: Optional[float] = None, end: Optional[float] = None,
+                    offset: int = 0, limit: int = 50, newest_first: bool = True) -> Dict[str, object]:
+        """転置インデックスでログを検索します（クエリの書式は log_index.py を参照）。"""
+        started = time.perf_counter()
+        docs = self.log_index.search(query, start, end)
+        ordered = docs[::-1] if newest_first else docs
+        page = ordered[offset:offset + limit]
+        positions = page.tolist()
+        lines = self.logs.get_many(positions)
+        return {
+            "query": query,
+            "total": int(len(docs)),
+            "results": [
+                {"index": pos, "ts": ts, "line": line}
+                for pos, ts, line in zip(positions, self.log_index.timestamps(page), lines)
+            ],
+            "page": {"offset": offset, "limit": limit, "has_more": offset + limit < len(docs)},
+            "took_ms": round((time.perf_counter() - started) * 1000, 3),
+        }
+
     def get_logs(self) -> List[str]:
-        return self.logs
+        return list(self.logs)
+
+    def log_version(self) -> Tuple[str, int]:
+        """ログが変わると変わる値（ETag 用）"""
+        return self.log_epoch, len(self.logs)
+
+    def log_window(self, offset: int = 0, limit: Optional[int] = None) -> Dict[str, object]:
+        """
+        ログの [offset, offset + limit) を返します（必要なセグメントだけを読む）。
+        新しい行だけを取得するには、前回の total を offset に渡します。
+        """
+        with self._lock:
+            total = len(self.logs)
+            stop = total if limit is None else min(offset + limit, total)
+            return {
+                "epoch": self.log_epoch,
+                "total": total,
+                "offset": offset,
+                "logs": list(self.logs.iter_range(offset, stop)) if offset < stop else [],
+            }
+
+    def iter_logs(self) -> Iterator[str]:
+        """ログをストリーミングで返します（全件をメモリに載せない）。"""
+        return iter(self.logs)
 
 bank_system = MockBank()
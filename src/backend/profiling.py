@@ -0,0 +1,267 @@
+import hmac
+import io
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional
+
+# --- On-demand Profiling ---
+# 管理者向けのオプトインなプロファイリング機能です。PROFILING_TOKEN が設定されていない場合は完全に無効で、
+# リクエストごとのオーバーヘッドは設定値の確認1回だけです。
+# 1. サンプリングプロファイラ: 対象リクエストの実行中、別スレッドが一定間隔で全スレッドのスタックを採取します。
+#    グラフ実行はスレッドプール・LLM呼び出し用スレッド・ツール実行用スレッドにまたがるため、
+#    スレッド単位でしか計測できない cProfile ではなく、プロセス全体のスタックサンプリングを使います。
+#    （同時に実行中の他リクエストのスタックも含まれる点に注意）
+# 2. tracemalloc: スナップショットを取得し、2点間の差分（チェックポイントやログの増加）を確認できます。
+# レポートは JSON または folded 形式（flamegraph.pl / speedscope で読み込み可能）でダウンロードできます。
+# 環境変数:
+#   PROFILING_TOKEN: 管理者トークン。X-Admin-Token ヘッダで一致した場合のみ利用可能 (未設定なら無効)
+#   PROFILING_SAMPLE_RATE: 対象リクエストを自動でプロファイルする割合 (デフォルト 0)
+#   PROFILING_PATHS: 対象パスの接頭辞（カンマ区切り, デフォルト "/run/,/audit"）
+#   PROFILING_INTERVAL_MS: サンプリング間隔ミリ秒 (デフォルト 5)
+#   PROFILING_MAX_REPORTS: 保持するレポート数 (デフォルト 50)
+
+# プロジェクトのコードを含まないスタック（アイドル中のワーカーなど）は採取しない
+_INTERESTING_FRAMES = ("src/backend", "src\\backend", "langgraph", "langchain")
+
+# tracemalloc の結果を絞り込むためのファイル名パターン
+MEMORY_SCOPES: Dict[str, tuple] = {
+    "all": (),
+    "checkpoint": ("langgraph/checkpoint", "langgraph\\checkpoint", "checkpoint_store.py"),
+    "logs": ("log_store.py", "mock_bank.py"),
+}
+
+
+def profiling_token() -> Optional[str]:
+    return os.getenv("PROFILING_TOKEN") or None
+
+
+def is_admin(token: Optional[str]) -> bool:
+    expected = profiling_token()
+    if expected is None or token is None:
+        return False
+    # トークンの一致判定で比較時間から内容を推測されないよう、定数時間で比較する
+    return hmac.compare_digest(token.encode("utf-8"), expected.encode("utf-8"))
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class ProfileReport:
+    def __init__(self, report_id: str, path: str, interval: float):
+        self.report_id = report_id
+        self.path = path
+        self.interval = interval
+        self.started_at = time.time()
+        self.duration_ms: Optional[float] = None
+        self.status_code: Optional[int] = None
+        self.samples = 0
+        self.stacks: Counter = Counter()       # "root;...;leaf" -> サンプル数
+        self.self_counts: Counter = Counter()  # 関数 -> 自身が先頭だったサンプル数
+        self.total_counts: Counter = Counter() # 関数 -> スタックに含まれていたサンプル数
+
+    def add(self, stack: List[str]) -> None:
+        self.samples += 1
+        self.stacks[";".join(stack)] += 1
+        self.self_counts[stack[-1]] += 1
+        for label in set(stack):
+            self.total_counts[label] += 1
+
+    def summary(self, top: int = 30) -> Dict[str, Any]:
+        def rows(counter: Counter):
+            return [
+                {"function": label, "samples": count, "ms": round(count * self.interval * 1000, 1)}
+                for label, count in counter.most_common(top)
+            ]
+
+        return {
+            "id": self.report_id,
+            "path": self.path,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "status_code": self.status_code,
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "top_self": rows(self.self_counts),
+            "top_cumulative": rows(self.total_counts),
+        }
+
+    def folded(self) -> str:
+        out = io.StringIO()
+        for stack, count in self.stacks.most_common():
+            out.write(f"{stack} {count}\n")
+        return out.getvalue()
+
+
+class Profiler:
+    def __init__(self):
+        self.interval = float(os.getenv("PROFILING_INTERVAL_MS", "5")) / 1000
+        self.sample_rate = float(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+        self.paths = tuple(p for p in os.getenv("PROFILING_PATHS", "/run/,/audit").split(",") if p)
+        self.max_reports = int(os.getenv("PROFILING_MAX_REPORTS", "50"))
+        self.reports: "OrderedDict[str, ProfileReport]" = OrderedDict()
+        self._active: List[ProfileReport] = []
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._sampler: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return profiling_token() is not None
+
+    def should_profile(self, path: str, requested: bool) -> bool:
+        if not path.startswith(self.paths):
+            return False
+        return requested or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    # --- Sampling ---
+
+    def start(self, path: str) -> ProfileReport:
+        report = ProfileReport(f"p{next(self._ids):06d}", path, self.interval)
+        with self._lock:
+            self._active.append(report)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self._sampler.start()
+        return report
+
+    def stop(self, report: ProfileReport, duration: float, status_code: Optional[int]) -> None:
+        report.duration_ms = round(duration * 1000, 1)
+        report.status_code = status_code
+        with self._lock:
+            if report in self._active:
+                self._active.remove(report)
+            self.reports[report.report_id] = report
+            while len(self.reports) > self.max_reports:
+                self.reports.popitem(last=False)
+
+    def _sample_loop(self) -> None:
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                active = list(self._active)
+                if not active:
+                    self._sampler = None
+                    return
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                interesting = False
+                while frame is not None:
+                    interesting = interesting or any(p in frame.f_code.co_filename for p in _INTERESTING_FRAMES)
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                if not interesting:
+                    continue
+                stack.reverse()
+                for report in active:
+                    report.add(stack)
+            time.sleep(self.interval)
+
+    def list_reports(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            reports = list(self.reports.values())
+        return [
+            {"id": r.report_id, "path": r.path, "started_at": r.started_at, "duration_ms": r.duration_ms, "samples": r.samples}
+            for r in reversed(reports)
+        ]
+
+    def get(self, report_id: str) -> Optional[ProfileReport]:
+        with self._lock:
+            return self.reports.get(report_id)
+
+
+class MemoryTracker:
+    """tracemalloc のスナップショットを取得・比較します。"""
+
+    def __init__(self, max_snapshots: int = 10):
+        self.max_snapshots = max_snapshots
+        self.snapshots: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def snapshot(self, gauges: Dict[str, Any], frames: int = 10) -> Dict[str, Any]:
+        # 最初のスナップショットで計測を開始する（開始前の確保は追跡されない）
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        snap = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot_id = f"m{next(self._ids):04d}"
+        entry = {"id": snapshot_id, "taken_at": time.time(), "snapshot": snap, "gauges": gauges,
+                 "traced_bytes": current, "peak_bytes": peak}
+        with self._lock:
+            self.snapshots[snapshot_id] = entry
+            while len(self.snapshots) > self.max_snapshots:
+                self.snapshots.popitem(last=False)
+        return self._describe(entry)
+
+    @staticmethod
+    def _describe(entry: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: v for k, v in entry.items() if k != "snapshot"}
+
+    @staticmethod
+    def _scoped(snapshot: tracemalloc.Snapshot, scope: str) -> tracemalloc.Snapshot:
+        patterns = MEMORY_SCOPES.get(scope, ())
+        if not patterns:
+            return snapshot
+        return snapshot.filter_traces([tracemalloc.Filter(True, f"*{p}*", all_frames=True) for p in patterns])
+
+    def top(self, snapshot_id: str, scope: str = "all", group_by: str = "lineno", limit: int = 20) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self.snapshots.get(snapshot_id)
+        if entry is None:
+            return None
+        stats = self._scoped(entry["snapshot"], scope).statistics(group_by)
+        return {
+            **self._describe(entry),
+            "scope": scope,
+            "top": [{"location": str(s.traceback[0]), "size_bytes": s.size, "count": s.count} for s in stats[:limit]],
+        }
+
+    def diff(self, base_id: str, target_id: str, scope: str = "all", group_by: str = "lineno", limit: int = 20) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            base = self.snapshots.get(base_id)
+            target = self.snapshots.get(target_id)
+        if base is None or target is None:
+            return None
+        stats = self._scoped(target["snapshot"], scope).compare_to(self._scoped(base["snapshot"], scope), group_by)
+        return {
+            "base": self._describe(base),
+            "target": self._describe(target),
+            "scope": scope,
+            "gauge_delta": {
+                k: target["gauges"][k] - base["gauges"][k]
+                for k in target["gauges"]
+                if isinstance(target["gauges"].get(k), (int, float)) and isinstance(base["gauges"].get(k), (int, float))
+            },
+            "top": [
+                {"location": str(s.traceback[0]), "size_diff_bytes": s.size_diff, "size_bytes": s.size,
+                 "count_diff": s.count_diff}
+                for s in stats[:limit]
+            ],
+        }
+
+    def list_snapshots(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [self._describe(e) for e in self.snapshots.values()]
+
+    def stop(self) -> None:
+        with self._lock:
+            self.snapshots.clear()
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+profiler = Profiler()
+memory_tracker = MemoryTracker()
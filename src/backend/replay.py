@@ -0,0 +1,200 @@
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from src.backend.audit_rules import AuditRules
+from src.backend.event_log import EVENT_RESET, EVENT_LOG, EVENT_ACCOUNT_CHANGED, EVENT_PAYMENT
+from src.backend.ledger import Ledger
+from src.backend.ledger_analytics import KIND_PAYMENT, KIND_ACCOUNT_CHANGE
+from src.backend.mock_bank import MAIN_ACCOUNT
+
+# --- Event-sourced Replay / What-if Audit ---
+# 記録済みの操作イベント列（event_log.py）から銀行の状態（口座・残高・ログ）を再構築し、
+# 監査ルールのしきい値を変えた場合の検知結果を、エージェントや LLM を動かさずにバッチで再計算します。
+# - 1つのイベント列（リセットから次のリセットまで）を「期間」と呼ぶ
+# - 期間内の行は時刻順なので、連続した範囲（時間パーティション）に分けて並列に再計算する
+#   統計ルールは取引先ごとの直前の状態に依存するため、各パーティションには取引先ごとに
+#   「直近 window 件の送金」と「velocity_window 秒以内の送金」以降の行を文脈として前置きする（結果は全件再計算と一致する）
+# - 現在のルール（baseline）と候補のルール（candidate）の検知結果の差分を返す
+# 環境変数:
+#   REPLAY_WORKERS: 並列に再計算するスレッド数 (デフォルト 4)
+
+
+class EpochReplay:
+    """1つの期間のイベント列を、状態と監査用の列に分解したもの。"""
+
+    def __init__(self, events: Iterable[Dict[str, object]], epoch: str):
+        self.epoch = epoch
+        self.events = 0
+        self.accounts: Dict[str, str] = {}
+        self.ledger: Optional[Ledger] = None
+        self.lines: List[str] = []
+        vendor_ids: Dict[str, int] = {}
+        self.vendor_names: List[str] = []
+        ts: List[float] = []
+        vids: List[int] = []
+        amounts: List[float] = []
+        kinds: List[int] = []
+
+        for event in events:
+            self.events += 1
+            kind = event["kind"]
+            if kind == EVENT_LOG:
+                self.lines.append(event["line"])
+                continue
+            if kind == EVENT_RESET:
+                self.accounts = dict(event["accounts"])
+                self.ledger = Ledger.from_balances(event["balances"])
+                continue
+            vendor = event["vendor"]
+            vid = vendor_ids.get(vendor)
+            if vid is None:
+                vid = vendor_ids[vendor] = len(self.vendor_names)
+                self.vendor_names.append(vendor)
+            ts.append(event["ts"])
+            vids.append(vid)
+            if kind == EVENT_ACCOUNT_CHANGED:
+                self.accounts[vendor] = event["account"]
+                amounts.append(0.0)
+                kinds.append(KIND_ACCOUNT_CHANGE)
+            elif kind == EVENT_PAYMENT:
+                if self.ledger is not None:
+                    # まとめて決済の場合も、割当ごとに記録しているので残高は同じになる
+                    self.ledger.record_payment(MAIN_ACCOUNT, vendor, event["amount"], timestamp=event["ts"])
+                amounts.append(float(event["amount"]))
+                kinds.append(KIND_PAYMENT)
+
+        self.ts = np.asarray(ts, dtype=np.float64)
+        self.vid = np.asarray(vids, dtype=np.int32)
+        self.amount = np.asarray(amounts, dtype=np.float64)
+        self.kind = np.asarray(kinds, dtype=np.int8)
+        # 取引先ごとの行番号（昇順）。パーティションの文脈を取り出すのに使う
+        order = np.argsort(self.vid, kind="stable")
+        bounds = np.flatnonzero(np.diff(self.vid[order])) + 1
+        self._rows_by_vendor = {int(self.vid[rows[0]]): rows for rows in np.split(order, bounds) if len(rows)}
+
+    def state(self) -> Dict[str, object]:
+        return {
+            "accounts": dict(self.accounts),
+            "balances": dict(self.ledger.balances_view()) if self.ledger is not None else {},
+            "log_count": len(self.lines),
+        }
+
+    # --- Audit ---
+
+    def _context(self, rules: AuditRules, start: int, stop: int) -> np.ndarray:
+        """パーティション [start, stop) の統計ルールに必要な、直前の行（取引先ごとの末尾）"""
+        if start == 0:
+            return np.empty(0, dtype=np.int64)
+        t0 = self.ts[start]
+        context = []
+        for vid in np.unique(self.vid[start:stop]):
+            rows = self._rows_by_vendor[int(vid)]
+            before = rows[:np.searchsorted(rows, start)]
+            if not len(before):
+                continue
+            payments = np.flatnonzero(self.kind[before] == KIND_PAYMENT)
+            # 直近 window 件の送金より後（送金が window 件未満なら口座変更を含めて全件）
+            cut = payments[-rules.window] if len(payments) >= rules.window else 0
+            # velocity_window 秒以内の送金
+            cut = min(cut, int(np.searchsorted(self.ts[before], t0 - rules.velocity_window, side="left")))
+            context.append(before[cut:])
+        return np.concatenate(context) if context else np.empty(0, dtype=np.int64)
+
+    def _partition_anomalies(self, rules: AuditRules, start: int, stop: int) -> List[Dict[str, object]]:
+        rows = np.concatenate((self._context(rules, start, stop), np.arange(start, stop)))
+        rows.sort()
+        analytics = rules.analytics()
+        analytics.extend((self.vendor_names[v] for v in self.vid[rows]), self.amount[rows], self.ts[rows], self.kind[rows])
+        found = []
+        for anomaly in analytics.recompute():
+            local = anomaly["index"]
+            index = int(rows[local])
+            if index < start:
+                continue  # 文脈として前置きした行（前のパーティションで検知済み）
+            anomaly["index"] = index
+            anomaly["log"] = anomaly["log"].replace(f"Payment #{local}:", f"Payment #{index}:", 1)
+            found.append(anomaly)
+        return found
+
+    def audit(self, rules: AuditRules, executor: ThreadPoolExecutor, partitions: int) -> List[Dict[str, object]]:
+        """期間全体を監査します。結果の並びは MockBank.audit_logs と同じ（文字列ルール → 統計ルール）。"""
+        n_rows, n_lines = len(self.ts), len(self.lines)
+        row_bounds = np.linspace(0, n_rows, partitions + 1, dtype=np.int64)
+        line_bounds = np.linspace(0, n_lines, partitions + 1, dtype=np.int64)
+        line_jobs = [
+            executor.submit(lambda a, b: [x for x in map(rules.scan_line, self.lines[a:b]) if x is not None], int(a), int(b))
+            for a, b in zip(line_bounds[:-1], line_bounds[1:]) if b > a
+        ]
+        row_jobs = [
+            executor.submit(self._partition_anomalies, rules, int(a), int(b))
+            for a, b in zip(row_bounds[:-1], row_bounds[1:]) if b > a
+        ]
+        anomalies = [a for job in line_jobs for a in job.result()]
+        statistical = [a for job in row_jobs for a in job.result()]
+        # 全件再計算と同じく、送金の発生順に並べる
+        statistical.sort(key=lambda a: a["index"])
+        for anomaly in anomalies + statistical:
+            anomaly["epoch"] = self.epoch
+        return anomalies + statistical
+
+
+def _anomaly_key(anomaly: Dict[str, object]) -> Tuple[str, str, str]:
+    # しきい値で変わる details は比較に使わない
+    return anomaly["epoch"], anomaly["type"], anomaly["log"]
+
+
+def diff_anomalies(baseline: List[Dict[str, object]], candidate: List[Dict[str, object]]) -> Dict[str, object]:
+    """同じ異常が複数回出る場合も数えて比較します。"""
+    base = Counter(_anomaly_key(a) for a in baseline)
+    cand = Counter(_anomaly_key(a) for a in candidate)
+    added_keys, removed_keys = cand - base, base - cand
+
+    def pick(items, keys):
+        picked = []
+        for anomaly in items:
+            key = _anomaly_key(anomaly)
+            if keys[key] > 0:
+                keys[key] -= 1
+                picked.append(anomaly)
+        return picked
+
+    added = pick(candidate, added_keys)
+    removed = pick(baseline, removed_keys)
+    return {"added": added, "removed": removed, "unchanged": len(candidate) - len(added)}
+
+
+def replay_audit(
+    epochs: List[EpochReplay],
+    baseline: AuditRules,
+    candidate: AuditRules,
+    partitions: Optional[int] = None,
+    live: Optional[Tuple[str, List[Dict[str, object]]]] = None,
+) -> Dict[str, object]:
+    """
+    baseline と candidate のルールで全期間を再計算し、検知結果の差分を返します。
+    live に (期間, 稼働中の監査結果) を渡すと、baseline の再計算結果が稼働中の結果と一致するかも確認します。
+    """
+    workers = int(os.getenv("REPLAY_WORKERS", "4"))
+    partitions = partitions or workers
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="replay") as executor:
+        base = [a for epoch in epochs for a in epoch.audit(baseline, executor, partitions)]
+        cand = [a for epoch in epochs for a in epoch.audit(candidate, executor, partitions)]
+    result = {
+        "epochs": [{"epoch": e.epoch, "events": e.events, **e.state()} for e in epochs],
+        "partitions": partitions,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+        "baseline": {"rules": baseline.to_dict(), "count": len(base)},
+        "candidate": {"rules": candidate.to_dict(), "count": len(cand)},
+        "diff": diff_anomalies(base, cand),
+    }
+    if live is not None:
+        epoch, anomalies = live
+        replayed = Counter((a["type"], a["log"]) for a in base if a["epoch"] == epoch)
+        result["baseline"]["matches_live"] = replayed == Counter((a["type"], a["log"]) for a in anomalies)
+    return result
@@ -0,0 +1,246 @@
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Optional
+
+from src.backend.context import current_context, DeadlineExceeded, RequestCancelled
+
+# --- Resilience Layer for LLM Calls ---
+# すべてのモデル呼び出しを、以下の制御付きで実行します。
+# 1. 呼び出しごとのデッドライン（timeout 秒で打ち切り）
+# 2. ジッター付き指数バックオフによるリトライ
+# 3. ヘッジリクエスト（有効時、p95 レイテンシを過ぎても応答がなければ同じリクエストをもう1本投げ、先に返った方を使う）
+# 4. サーキットブレーカー（連続失敗で一定時間呼び出しを止め、即座に CircuitOpenError を返す）
+#    一定時間後の半開状態では1件だけを試しに通し、その結果が出るまで他の呼び出しは即座に失敗させる
+#    （回復途中のプロバイダへ、待っていた呼び出しが一斉に流れ込まないように）
+# リクエストのデッドライン（context.RequestContext）が呼び出しのデッドラインより早ければそちらで打ち切り、
+# クライアントが切断したら応答を待たずに戻ります。これらはプロバイダの障害ではないため、
+# リトライもサーキットの失敗数への加算もしません。
+# 環境変数:
+#   LLM_TIMEOUT: 1回の呼び出しのデッドライン秒数 (デフォルト 20)
+#   LLM_MAX_RETRIES: リトライ回数 (デフォルト 2)
+#   LLM_HEDGE: "1" でヘッジリクエストを有効化 (デフォルト無効)
+#   LLM_CIRCUIT_FAILURES: サーキットを開く連続失敗回数 (デフォルト 5)
+#   LLM_CIRCUIT_RESET: サーキットを半開にするまでの秒数 (デフォルト 30)
+#   LLM_MAX_CONCURRENCY: モデル呼び出し用スレッド数 (デフォルト 16)
+
+
+# 半開状態で試行中の呼び出しがある間、他の呼び出しに返す再試行までの目安の秒数
+HALF_OPEN_RETRY_AFTER = 1.0
+
+
+class CircuitOpenError(Exception):
+    """サーキットが開いているため、呼び出しを行わずに失敗させたことを示します。"""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit '{name}' is open. Retry after {retry_after:.0f}s.")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"  # closed / open / half_open
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False  # 半開状態で試しに通した呼び出しが実行中か
+        self._lock = threading.Lock()
+
+    def before_call(self) -> bool:
+        """呼び出してよいか確認します。半開状態で試しに通す1件の場合は True を返します。"""
+        with self._lock:
+            if self.state == "open":
+                elapsed = time.monotonic() - self.opened_at
+                if elapsed < self.reset_timeout:
+                    raise CircuitOpenError(self.name, self.reset_timeout - elapsed)
+                # 一定時間経過後は半開にして、試しに1件だけ呼び出しを通す
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._probing:
+                    raise CircuitOpenError(self.name, HALF_OPEN_RETRY_AFTER)
+                self._probing = True
+                return True
+            return False
+
+    def abandon_probe(self, probe: bool) -> None:
+        """試しに通した呼び出しが、成否の判定前に打ち切られた場合（デッドライン・切断）に、次の呼び出しへ試行を譲ります。"""
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self.state != "open":
+                return 0.0
+            return max(self.reset_timeout - (time.monotonic() - self.opened_at), 0.0)
+
+
+class LatencyTracker:
+    """直近の成功した呼び出しのレイテンシを保持し、パーセンタイルを返します。"""
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(int(len(samples) * q), len(samples) - 1)]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+# 応答待ちの間にクライアントの切断を確認する間隔（秒）
+CANCEL_POLL_INTERVAL = 0.2
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LLM_MAX_CONCURRENCY", "16")),
+    thread_name_prefix="llm-call",
+)
+
+
+class ResilientCaller:
+    def __init__(
+        self,
+        name: str,
+        timeout: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        backoff_base: float = 0.5,
+        backoff_max: float = 4.0,
+        hedge: Optional[bool] = None,
+        hedge_min_samples: int = 20,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.name = name
+        self.timeout = timeout if timeout is not None else float(os.getenv("LLM_TIMEOUT", "20"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("LLM_MAX_RETRIES", "2"))
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge if hedge is not None else os.getenv("LLM_HEDGE", "0") == "1"
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker(
+            name,
+            failure_threshold=int(os.getenv("LLM_CIRCUIT_FAILURES", "5")),
+            reset_timeout=float(os.getenv("LLM_CIRCUIT_RESET", "30")),
+        )
+        self.latency = LatencyTracker()
+        self.counters: Dict[str, int] = {"calls": 0, "retries": 0, "timeouts": 0, "hedged": 0, "failures": 0}
+        self._counter_lock = threading.Lock()
+
+    def _count(self, key: str) -> None:
+        with self._counter_lock:
+            self.counters[key] += 1
+
+    def call(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """fn(*args, **kwargs) をデッドライン・リトライ・サーキットブレーカー付きで実行します。"""
+        self._count("calls")
+        ctx = current_context()
+        last_error: Optional[BaseException] = None
+        for attempt in range(self.max_retries + 1):
+            ctx.check()
+            probe = self.breaker.before_call()
+            try:
+                result = self._attempt(fn, args, kwargs)
+            except (DeadlineExceeded, RequestCancelled):
+                self.breaker.abandon_probe(probe)
+                raise
+            except Exception as e:
+                last_error = e
+                self._count("failures")
+                self.breaker.record_failure()
+                if attempt == self.max_retries:
+                    break
+                self._count("retries")
+                # Full jitter: 0 〜 min(上限, base * 2^attempt) の間でランダムに待つ
+                # （待機中にクライアントが切断したら、次の ctx.check() で打ち切る）
+                ctx.wait_cancelled(ctx.clip(random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))))
+                continue
+            self.breaker.record_success()
+            return result
+        raise last_error
+
+    def _submit(self, fn: Callable[..., Any], args, kwargs) -> Future:
+        # 権限・セッションなどの ContextVar をワーカースレッドへ引き継ぐ
+        return _executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+    def _attempt(self, fn: Callable[..., Any], args, kwargs) -> Any:
+        ctx = current_context()
+        started = time.monotonic()
+        timeout = ctx.clip(self.timeout)
+        deadline = started + timeout
+        pending = {self._submit(fn, args, kwargs)}
+
+        hedge_delay = self.latency.percentile(0.95) if self.hedge and len(self.latency) >= self.hedge_min_samples else None
+        if hedge_delay is not None and hedge_delay < timeout:
+            done, _ = wait(pending, timeout=hedge_delay)
+            if not done:
+                self._count("hedged")
+                pending.add(self._submit(fn, args, kwargs))
+
+        error: Optional[BaseException] = None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # キャンセルに気づけるよう、短い間隔で待つ
+            done, pending = wait(pending, timeout=min(remaining, CANCEL_POLL_INTERVAL), return_when=FIRST_COMPLETED)
+            if not done and ctx.cancelled:
+                for other in pending:
+                    other.cancel()
+                ctx.check()
+            for future in done:
+                if future.exception() is None:
+                    # 残りのリクエストは結果を使わない（実行中のスレッドは止められないため、完了を待たずに返す）
+                    for other in pending:
+                        other.cancel()
+                    self.latency.record(time.monotonic() - started)
+                    return future.result()
+                error = future.exception()
+        if pending:
+            for other in pending:
+                other.cancel()
+            if timeout < self.timeout:
+                # 先に来たのはリクエストのデッドライン（プロバイダのタイムアウトとしては数えない）
+                ctx.check()
+            self._count("timeouts")
+            raise TimeoutError(f"{self.name}: no response within {self.timeout:.1f}s")
+        raise error
+
+    def stats(self) -> Dict[str, Any]:
+        p50 = self.latency.percentile(0.5)
+        p95 = self.latency.percentile(0.95)
+        return {
+            "circuit": self.breaker.state,
+            "retry_after": round(self.breaker.retry_after(), 1),
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            **self.counters,
+        }
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import zlib
+from typing import Any, Callable, List, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+try:
+    import orjson
+except ImportError:  # orjson が無ければ標準の json で同じ形式を出力する
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # brotli が無ければ gzip のみ
+    brotli = None
+
+# --- API Response Encoding ---
+# 1. JSON は orjson（インストールされていれば）でシリアライズする
+# 2. 応答本文を Accept-Encoding に応じて brotli / gzip で圧縮する（COMPRESS_MIN_SIZE バイト未満、圧縮済み、SSE は対象外）
+#    ストリーミングの応答も逐次圧縮する
+# 3. 読み取り系のエンドポイントは ETag を付け、If-None-Match が一致すれば本文を作らずに 304 を返す
+#    状態のバージョン（ログの epoch と件数など）から ETag を作れる場合は、本文を組み立てる前に判定する
+# 環境変数:
+#   COMPRESS_MIN_SIZE: 圧縮する最小サイズ (デフォルト 1024)
+#   COMPRESS_GZIP_LEVEL: gzip の圧縮レベル (デフォルト 6)
+#   COMPRESS_BROTLI_QUALITY: brotli の品質 (デフォルト 4)
+
+_COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+# --- ETag ---
+
+def make_etag(data: bytes) -> str:
+    # 圧縮の有無で表現が変わるため弱い ETag を使う
+    return 'W/"' + hashlib.blake2b(data, digest_size=12).hexdigest() + '"'
+
+
+def version_etag(*parts: Any) -> str:
+    return make_etag(repr(parts).encode("utf-8"))
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (tag.strip() for tag in header.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+
+def cached_json(request: Request, build: Callable[[], Any], version: Optional[Tuple[Any, ...]] = None) -> Response:
+    """
+    build() の結果を JSON で返します。ETag が If-None-Match と一致すれば 304 を返します。
+    version を渡すと、その値から ETag を作り、一致すれば build() を呼びません（クエリ文字列も ETag に含める）。
+    """
+    if version is not None:
+        etag = version_etag(request.url.path, str(request.query_params), *version)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        body = dumps(build())
+    else:
+        body = dumps(build())
+        etag = make_etag(body)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+# --- Compression ---
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Accept-Encoding から使う圧縮方式を選びます（q=0 は除外、brotli を優先）。"""
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+class _Compressor:
+    def __init__(self, encoding: str):
+        if encoding == "br":
+            self._br = brotli.Compressor(quality=int(os.getenv("COMPRESS_BROTLI_QUALITY", "4")))
+            self._zlib = None
+        else:
+            self._br = None
+            self._zlib = zlib.compressobj(int(os.getenv("COMPRESS_GZIP_LEVEL", "6")), zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self._br is not None:
+            return self._br.process(data)
+        return self._zlib.compress(data)
+
+    def flush(self) -> bytes:
+        if self._br is not None:
+            return self._br.finish()
+        return self._zlib.flush()
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: Optional[int] = None):
+        self.app = app
+        self.minimum_size = minimum_size if minimum_size is not None else int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(send, encoding, self.minimum_size).send)
+
+
+class _CompressingSend:
+    def __init__(self, send, encoding: str, minimum_size: int):
+        self._send = send
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self._start = None
+        self._buffer: List[bytes] = []
+        self._buffered = 0
+        self._compressor: Optional[_Compressor] = None
+        self._passthrough = False
+
+    def _eligible(self, headers: Headers) -> bool:
+        if "content-encoding" in headers:
+            return False  # エクスポートの gzip やルーター経由の応答など、圧縮済み
+        content_type = headers.get("content-type", "")
+        return content_type.startswith(_COMPRESSIBLE_TYPES) and not content_type.startswith("text/event-stream")
+
+    async def send(self, message) -> None:
+        if message["type"] == "http.response.start":
+            self._start = message
+            self._passthrough = not self._eligible(Headers(raw=message["headers"]))
+            if self._passthrough:
+                await self._send(message)
+            return
+        if message["type"] != "http.response.body" or self._passthrough:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self._start is not None:
+            # ミドルウェアを経由した応答は本文が分割されて届くため、minimum_size に達するか本文が終わるまで溜めてから判断する
+            self._buffer.append(body)
+            self._buffered += len(body)
+            if more_body and self._buffered < self.minimum_size:
+                return
+            body, self._buffer = b"".join(self._buffer), []
+            start, self._start = self._start, None
+            headers = MutableHeaders(raw=start["headers"])
+            if not more_body and len(body) < self.minimum_size:
+                self._passthrough = True
+                await self._send(start)
+                await self._send({"type": "http.response.body", "body": body})
+                return
+            self._compressor = _Compressor(self.encoding)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                # ストリーミング: 長さは分からないため chunked で送る
+                del headers["Content-Length"]
+            else:
+                body = self._compressor.compress(body) + self._compressor.flush()
+                headers["Content-Length"] = str(len(body))
+                await self._send(start)
+                await self._send({"type": "http.response.body", "body": body})
+                return
+            await self._send(start)
+
+        data = self._compressor.compress(body)
+        if not more_body:
+            data += self._compressor.flush()
+        if data or not more_body:
+            await self._send({"type": "http.response.body", "body": data, "more_body": more_body})
@@ -0,0 +1,177 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# --- Thread-affinity Router ---
+# バックエンドを複数のプロセス（uvicorn ワーカー）で動かすためのルーターです。
+# 銀行の状態とエージェントのチェックポイント（MemorySaver）はプロセスごとのメモリにあるため、
+# 同じセッションへのリクエストは常に同じワーカーへ転送します。
+# - ルーティングキーはセッションID。スレッドIDは "<session_id>:<uuid>" 形式なので、
+#   /run/hitl/approve や /state/{thread_id} もスレッドを作成したワーカーへ届く
+# - 担当ワーカーはランデブー・ハッシュ（HRW）で決める。ワーカーが落ちた場合は、そのワーカーが担当していた
+#   セッションだけが残りのワーカーへ移る（他のセッションの担当は変わらない）
+# - ワーカーの死活は定期的なヘルスチェックと接続失敗で判定する。接続できなかったリクエストは次の候補へ再送する
+#   （送信済みのリクエストは二重実行を避けるため再送しない）
+# 落ちたワーカーが持っていたスレッドはメモリと一緒に失われるため、移った先では 404 になります。
+# ワーカーが復帰すると、元の担当セッションはそのワーカーへ戻ります（移っていた間の状態は移った先に残る）。
+# 起動: BACKEND_WORKERS=4 ./start.sh（ワーカーは 8001〜、ルーターは 8000 で待ち受ける）
+# 環境変数:
+#   ROUTER_WORKERS: ワーカーのURL（カンマ区切り, デフォルト "http://127.0.0.1:8001"）
+#   ROUTER_HEALTH_INTERVAL: ヘルスチェックの間隔秒数 (デフォルト 2)
+#   ROUTER_TIMEOUT: ワーカーの応答を待つ秒数 (デフォルト 300)
+
+DEFAULT_SESSION = "default"
+HEALTH_PATH = "/health/admission"
+
+# 転送しないヘッダ（hop-by-hop）
+_HOP_BY_HOP = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+    "transfer-encoding", "upgrade", "host", "content-length",
+}
+
+
+def _score(key: str, worker: str) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{key}\0{worker}".encode(), digest_size=8).digest(), "big")
+
+
+class Worker:
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.alive = True
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_change = time.time()
+
+    def mark(self, alive: bool) -> None:
+        if alive != self.alive:
+            self.alive = alive
+            self.last_change = time.time()
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "url": self.url,
+            "alive": self.alive,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "last_change": self.last_change,
+        }
+
+
+class RendezvousRouter:
+    def __init__(self, urls: List[str]):
+        self.workers = [Worker(url) for url in urls]
+
+    def ranked(self, key: str) -> List[Worker]:
+        """キーに対するワーカーの優先順位（生きているものを先に）。先頭が担当ワーカー。"""
+        ordered = sorted(self.workers, key=lambda w: _score(key, w.url), reverse=True)
+        return [w for w in ordered if w.alive] + [w for w in ordered if not w.alive]
+
+    def owner(self, key: str) -> Worker:
+        return self.ranked(key)[0]
+
+    def stats(self) -> Dict[str, object]:
+        return {"workers": [w.to_dict() for w in self.workers]}
+
+
+def routing_key(request: Request, body: bytes) -> str:
+    """リクエストの担当を決めるセッションID（スレッドIDがあればその名前空間を優先）。"""
+    thread_id: Optional[str] = None
+    parts = request.url.path.split("/")
+    if len(parts) > 2 and parts[1] == "sessions":
+        # セッションの終了は、終了するセッションの担当ワーカーへ送る（管理者が他のセッションを終了する場合も）
+        return parts[2]
+    if len(parts) > 2 and parts[1] == "state":
+        thread_id = parts[2]
+    elif body and request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict) and isinstance(payload.get("thread_id"), str):
+            thread_id = payload["thread_id"]
+    if thread_id:
+        return thread_id.split(":", 1)[0] if ":" in thread_id else DEFAULT_SESSION
+    return request.headers.get("X-Session-ID") or request.query_params.get("session_id") or DEFAULT_SESSION
+
+
+router = RendezvousRouter([u.strip() for u in os.getenv("ROUTER_WORKERS", "http://127.0.0.1:8001").split(",") if u.strip()])
+_client: Optional[httpx.AsyncClient] = None
+
+
+async def _health_loop(interval: float) -> None:
+    while True:
+        for worker in router.workers:
+            try:
+                response = await _client.get(worker.url + HEALTH_PATH, timeout=interval)
+                worker.mark(response.status_code < 500)
+            except httpx.HTTPError:
+                worker.mark(False)
+        await asyncio.sleep(interval)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _client
+    _client = httpx.AsyncClient(timeout=float(os.getenv("ROUTER_TIMEOUT", "300")))
+    health = asyncio.create_task(_health_loop(float(os.getenv("ROUTER_HEALTH_INTERVAL", "2"))))
+    try:
+        yield
+    finally:
+        health.cancel()
+        await _client.aclose()
+
+
+app = FastAPI(title="Tax-Mate AutoPay Router", lifespan=lifespan)
+
+
+@app.get("/router/status")
+def router_status():
+    return router.stats()
+
+
+@app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+async def proxy(request: Request, path: str):
+    body = await request.body()
+    key = routing_key(request, body)
+    headers = [(k, v) for k, v in request.headers.items() if k.lower() not in _HOP_BY_HOP]
+    for worker in router.ranked(key):
+        upstream = _client.build_request(
+            request.method, worker.url + request.url.path, params=request.query_params, headers=headers, content=body
+        )
+        worker.in_flight += 1
+        try:
+            response = await _client.send(upstream, stream=True)
+        except httpx.ConnectError:
+            # 届かなかったリクエストだけ、次の候補へ再送する
+            worker.in_flight -= 1
+            worker.failures += 1
+            worker.mark(False)
+            continue
+        except httpx.HTTPError as e:
+            worker.in_flight -= 1
+            worker.failures += 1
+            return JSONResponse(status_code=502, content={"detail": f"Worker {worker.url} failed: {type(e).__name__}"})
+        worker.requests += 1
+
+        async def body_stream(response=response, worker=worker):
+            try:
+                async for chunk in response.aiter_raw():
+                    yield chunk
+            finally:
+                worker.in_flight -= 1
+                await response.aclose()
+
+        response_headers = {k: v for k, v in response.headers.items() if k.lower() not in _HOP_BY_HOP}
+        response_headers["X-Routed-Worker"] = worker.url
+        return StreamingResponse(body_stream(), status_code=response.status_code, headers=response_headers)
+    return JSONResponse(status_code=503, content={"detail": "No backend worker is available."}, headers={"Retry-After": "2"})
@@ -0,0 +1,201 @@
+import os
+import re
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+# --- Pre-commit Transaction Screening ---
+# 銀行が送金・口座変更を確定する「前」に、同期的にルールを評価します（監査ログによる事後検知の前段）。
+# ルールはすべて事前コンパイル済みの正規表現とメモリ上のカウンタだけで評価し、1回あたり数マイクロ秒で終わります。
+# 判定結果:
+#   ALLOW: そのまま実行
+#   HOLD : 実行せず保留（人間が確認して解除または却下する）
+#   BLOCK: 実行しない
+# ルール:
+#   1. BLACKLIST_ACCOUNT: 変更先・送金先の口座がブラックリストに一致 -> BLOCK
+#   2. AMOUNT_LIMIT: 送金額が上限以上 -> BLOCK / 保留しきい値以上 -> HOLD
+#   3. CHANGED_ACCOUNT: 口座変更から一定時間内の送金 -> HOLD
+#   4. VELOCITY: 取引先ごとの直近の送金合計・回数が上限を超える -> HOLD
+# 環境変数:
+#   SCREENING_MODE: "enforce"（判定どおりに止める） / "monitor"（判定を記録するだけ） / "off" (デフォルト "monitor")
+#   SCREENING_BLACKLIST: ブラックリストの口座パターン（カンマ区切り, デフォルト "MAINTENANCE-999,HACKER,ATTACKER"）
+#   SCREENING_BLOCK_AMOUNT: この金額以上の送金は BLOCK (デフォルト 1000000)
+#   SCREENING_HOLD_AMOUNT: この金額以上の送金は HOLD (デフォルト 50000)
+#   SCREENING_VELOCITY_WINDOW: 送金速度を見る時間窓の秒数 (デフォルト 3600)
+#   SCREENING_VELOCITY_AMOUNT: 時間窓内の取引先ごとの送金合計の上限 (デフォルト 100000)
+#   SCREENING_VELOCITY_COUNT: 時間窓内の取引先ごとの送金回数の上限 (デフォルト 10)
+#   SCREENING_CHANGE_COOLDOWN: 口座変更後、送金を保留する秒数 (デフォルト 86400)
+#   SCREENING_BUDGET_US: 1回の判定にかけてよい時間（マイクロ秒）。超過回数を統計に記録する (デフォルト 200)
+
+ALLOW = "ALLOW"
+HOLD = "HOLD"
+BLOCK = "BLOCK"
+
+# 判定の重さ（複数のルールに該当した場合は最も重いものを採用する）
+_SEVERITY = {ALLOW: 0, HOLD: 1, BLOCK: 2}
+
+
+def screening_mode() -> str:
+    mode = os.getenv("SCREENING_MODE", "monitor").lower()
+    return mode if mode in ("enforce", "monitor", "off") else "monitor"
+
+
+def compile_blacklist(patterns: Optional[str] = None) -> Optional["re.Pattern"]:
+    raw = patterns if patterns is not None else os.getenv("SCREENING_BLACKLIST", "MAINTENANCE-999,HACKER,ATTACKER")
+    items = [p.strip() for p in raw.split(",") if p.strip()]
+    if not items:
+        return None
+    return re.compile("|".join(re.escape(p) for p in items), re.IGNORECASE)
+
+
+class ScreeningResult:
+    __slots__ = ("outcome", "rule", "reason", "elapsed_us")
+
+    def __init__(self, outcome: str = ALLOW, rule: Optional[str] = None, reason: str = "", elapsed_us: float = 0.0):
+        self.outcome = outcome
+        self.rule = rule
+        self.reason = reason
+        self.elapsed_us = elapsed_us
+
+    def escalate(self, outcome: str, rule: str, reason: str) -> None:
+        if _SEVERITY[outcome] > _SEVERITY[self.outcome]:
+            self.outcome = outcome
+            self.rule = rule
+            self.reason = reason
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"outcome": self.outcome, "rule": self.rule, "reason": self.reason, "elapsed_us": self.elapsed_us}
+
+
+class TransactionScreener:
+    """銀行インスタンスごとの事前スクリーニング（カウンタは銀行のロック内で更新される前提）。"""
+
+    def __init__(self, mode: Optional[str] = None):
+        self.mode = mode or screening_mode()
+        self.blacklist = compile_blacklist()
+        self.block_amount = int(os.getenv("SCREENING_BLOCK_AMOUNT", "1000000"))
+        self.hold_amount = int(os.getenv("SCREENING_HOLD_AMOUNT", "50000"))
+        self.velocity_window = float(os.getenv("SCREENING_VELOCITY_WINDOW", "3600"))
+        self.velocity_amount = int(os.getenv("SCREENING_VELOCITY_AMOUNT", "100000"))
+        self.velocity_count = int(os.getenv("SCREENING_VELOCITY_COUNT", "10"))
+        self.change_cooldown = float(os.getenv("SCREENING_CHANGE_COOLDOWN", "86400"))
+        self.budget_us = float(os.getenv("SCREENING_BUDGET_US", "200"))
+        # 取引先ごとの直近の送金 (時刻, 金額) と、その合計
+        self._recent: Dict[str, Deque[Tuple[float, int]]] = {}
+        self._recent_sum: Dict[str, int] = {}
+        self._changed_at: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {"screened": 0, ALLOW: 0, HOLD: 0, BLOCK: 0, "over_budget": 0}
+        self.rule_hits: Dict[str, int] = {}
+        self._total_us = 0.0
+        self._max_us = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    @property
+    def enforcing(self) -> bool:
+        return self.mode == "enforce"
+
+    # --- Rules ---
+
+    def screen_account_change(self, vendor: str, new_account: str) -> ScreeningResult:
+        started = time.perf_counter()
+        result = ScreeningResult()
+        if self.blacklist is not None and self.blacklist.search(new_account):
+            result.escalate(BLOCK, "BLACKLIST_ACCOUNT", f"New account for {vendor} matches the blacklist")
+        return self._finish(result, started)
+
+    def screen_payment(self, vendor: str, account: str, amount: int, now: Optional[float] = None) -> ScreeningResult:
+        started = time.perf_counter()
+        now = time.time() if now is None else now
+        result = ScreeningResult()
+
+        if self.blacklist is not None and self.blacklist.search(account):
+            result.escalate(BLOCK, "BLACKLIST_ACCOUNT", f"Destination account of {vendor} matches the blacklist")
+        if amount >= self.block_amount:
+            result.escalate(BLOCK, "AMOUNT_LIMIT", f"Amount {amount:,} >= {self.block_amount:,}")
+        elif amount >= self.hold_amount:
+            result.escalate(HOLD, "AMOUNT_LIMIT", f"Amount {amount:,} >= {self.hold_amount:,}")
+
+        changed_at = self._changed_at.get(vendor)
+        if changed_at is not None and now - changed_at < self.change_cooldown:
+            result.escalate(HOLD, "CHANGED_ACCOUNT", f"Account of {vendor} was changed {now - changed_at:.0f}s ago")
+
+        recent = self._expire(vendor, now)
+        if recent is not None:
+            total = self._recent_sum[vendor] + amount
+            if total > self.velocity_amount:
+                result.escalate(HOLD, "VELOCITY", f"{total:,} JPY to {vendor} within {self.velocity_window:.0f}s")
+            elif len(recent) + 1 > self.velocity_count:
+                result.escalate(HOLD, "VELOCITY", f"{len(recent) + 1} payments to {vendor} within {self.velocity_window:.0f}s")
+        elif amount > self.velocity_amount:
+            result.escalate(HOLD, "VELOCITY", f"{amount:,} JPY to {vendor} within {self.velocity_window:.0f}s")
+        return self._finish(result, started)
+
+    # --- Counters (実行が確定した操作だけを反映する) ---
+
+    def commit_account_change(self, vendor: str, now: Optional[float] = None) -> None:
+        self._changed_at[vendor] = time.time() if now is None else now
+
+    def commit_payment(self, vendor: str, amount: int, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        self._recent.setdefault(vendor, deque()).append((now, amount))
+        self._recent_sum[vendor] = self._recent_sum.get(vendor, 0) + amount
+        # 口座変更後の最初の送金が確認・実行されたら、以後は通常どおり扱う
+        self._changed_at.pop(vendor, None)
+
+    def _expire(self, vendor: str, now: float) -> Optional[Deque[Tuple[float, int]]]:
+        recent = self._recent.get(vendor)
+        if recent is None:
+            return None
+        while recent and now - recent[0][0] > self.velocity_window:
+            _, old_amount = recent.popleft()
+            self._recent_sum[vendor] -= old_amount
+        return recent
+
+    def _finish(self, result: ScreeningResult, started: float) -> ScreeningResult:
+        elapsed_us = (time.perf_counter() - started) * 1_000_000
+        result.elapsed_us = round(elapsed_us, 2)
+        self.counters["screened"] += 1
+        self.counters[result.outcome] += 1
+        if result.rule is not None:
+            self.rule_hits[result.rule] = self.rule_hits.get(result.rule, 0) + 1
+        if elapsed_us > self.budget_us:
+            self.counters["over_budget"] += 1
+        self._total_us += elapsed_us
+        self._max_us = max(self._max_us, elapsed_us)
+        return result
+
+    def stats(self) -> Dict[str, object]:
+        screened = self.counters["screened"]
+        return {
+            "mode": self.mode,
+            "budget_us": self.budget_us,
+            "avg_us": round(self._total_us / screened, 2) if screened else None,
+            "max_us": round(self._max_us, 2),
+            **self.counters,
+            "rule_hits": dict(self.rule_hits),
+        }
+
+
+class HeldOperation:
+    def __init__(self, hold_id: str, operation: str, vendor: str, params: Dict[str, object], result: ScreeningResult, role: str):
+        self.hold_id = hold_id
+        self.operation = operation
+        self.vendor = vendor
+        self.params = params
+        self.result = result
+        self.role = role
+        self.created_at = time.time()
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "hold_id": self.hold_id,
+            "operation": self.operation,
+            "vendor": self.vendor,
+            "params": self.params,
+            "rule": self.result.rule,
+            "reason": self.result.reason,
+            "created_at": self.created_at,
+        }
@@ -1,19 +1,43 @@
 import uuid
-from typing import Optional, List, Dict, Any
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from typing import Optional, List, Dict, Any, Tuple
+from fastapi import Depends, FastAPI, Header, HTTPException, Query
+from pydantic import BaseModel, Field
 from langchain_core.messages import HumanMessage
 
-from src.backend.agents import vulnerable_app, secure_app, hitl_app
-from src.backend.mock_bank import bank_system
-from src.backend.context import user_role_var
+from src.backend import agents
+from src.backend.agents import vulnerable_app
+from src.backend.sessions import current_bank, session_manager, new_thread_id, session_of_thread
+from src.backend.context import current_context, DeadlineExceeded, RequestCancelled, RequestContextMiddleware
+from src.backend.resilience import CircuitOpenError
+from src.backend.usage import usage_meter, BudgetExceeded
+from src.backend.responses import (
+    FastJSONResponse, CompressionMiddleware, cached_json, etag_matches, not_modified, version_etag
+)
+from src.backend.admission import admission, invoice_priority, OverloadedError, PRIORITY_APPROVAL
+from src.backend.idempotency import idempotency, IdempotencyKeyMismatch
+from src.backend.thread_state import (
+    ThreadStateReader, ThreadNotFound, parse_fields, STATE_FIELDS, MESSAGE_FIELDS, DEFAULT_STATE_FIELDS, DEFAULT_MESSAGE_FIELDS
+)
+from src.backend.event_log import EventLog
+from src.backend.log_index import QueryError
+from src.backend.replay import EpochReplay, replay_audit
+from src.backend.export import (
+    COLUMNS as EXPORT_COLUMNS, FORMATS as EXPORT_FORMATS, ExportFilter, bank_epochs, export_stream,
+    iter_anomalies, iter_ledger, iter_log_lines, pa
+)
+from src.backend.profiling import profiler, memory_tracker, is_admin, MEMORY_SCOPES
+from src.backend.injection_classifier import get_injection_classifier, prescreen_invoice, INJECTION_BLOCK_MESSAGE
 from src.data.invoices import POISONED_INVOICE_TEXT
 
+import json
+import os
+import re
 import time
 from collections import deque
 from fastapi import Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
-app = FastAPI(title="Tax-Mate AutoPay Backend")
+app = FastAPI(title="Tax-Mate AutoPay Backend", default_response_class=FastJSONResponse)
 
 # --- Simple In-Memory Rate Limiter ---
 class RateLimiter:
@@ -50,38 +74,405 @@ async def rate_limit_middleware(request: Request, call_next):
     response = await call_next(request)
     return response
 
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+@app.middleware("http")
+async def session_middleware(request: Request, call_next):
+    # セッションIDをコンテキストに設定（ハンドラ・スレッドプール・ツール実行まで引き継がれる）
+    session_id = request.headers.get("X-Session-ID") or request.query_params.get("session_id") or "default"
+    if not SESSION_ID_PATTERN.match(session_id):
+        from fastapi.responses import JSONResponse
+        return JSONResponse(status_code=400, content={"detail": "Invalid session id."})
+    current_context().session_id = session_id
+    return await call_next(request)
+
+@app.middleware("http")
+async def profiling_middleware(request: Request, call_next):
+    # PROFILING_TOKEN 未設定時は何もしない
+    if not profiler.enabled:
+        return await call_next(request)
+    admin = is_admin(request.headers.get("X-Admin-Token"))
+    requested = request.headers.get("X-Profile") == "1" and admin
+    if not profiler.should_profile(request.url.path, requested):
+        return await call_next(request)
+    report = profiler.start(request.url.path)
+    started = time.monotonic()
+    status_code = None
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        profiler.stop(report, time.monotonic() - started, status_code)
+    # 自動サンプリングされたことやレポートIDは、管理者トークンを確認できたリクエストにだけ返す
+    if admin:
+        response.headers["X-Profile-Report"] = report.report_id
+    return response
+
+# 応答の圧縮（brotli / gzip）。最後に追加したミドルウェアが最も外側になるため、すべての応答が対象になる
+app.add_middleware(CompressionMiddleware)
+# リクエストの実行コンテキスト（デッドライン・切断時のキャンセル・トレースID）。他のミドルウェアより外側で作る
+app.add_middleware(RequestContextMiddleware)
+
 class RunRequest(BaseModel):
     invoice_text: Optional[str] = POISONED_INVOICE_TEXT
     role: str = "ADMIN"  # "ADMIN" or "READ_ONLY"
 
+class ClassifyRequest(BaseModel):
+    texts: List[str]
+
 class ResumeRequest(BaseModel):
     thread_id: str
     action: str  # "approve" or "reject"
 
+class ApprovalRequest(BaseModel):
+    thread_id: str
+    approved: bool  # True = 承認, False = 拒否
+
+class ReplayRequest(BaseModel):
+    rules: Dict[str, Any] = {}  # 変更する監査ルールのしきい値（例: {"amount_threshold": 5000}）
+    partitions: Optional[int] = Field(None, ge=1, le=64)
+    include_archived: bool = False  # リセット前の期間も再生する
+    limit: int = Field(100, ge=0, le=1000)  # 差分として返す異常の最大件数
+
+class HoldDecisionRequest(BaseModel):
+    approved: bool  # True = 保留を解除して実行, False = 却下
+    role: str = "ADMIN"
+
+# --- Admission Control ---
+# 実行枠の確保はイベントループ上で待つため、待機中のリクエストはスレッドプールを消費しない
+
+def overloaded_response(e: OverloadedError) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after) + 1)})
+
+def cancelled_response(e: RequestCancelled) -> HTTPException:
+    # クライアントは既に切断しているため、この応答は届かない（アクセスログ・計測用）
+    return HTTPException(status_code=499, detail=str(e))
+
+def budget_response(e: BudgetExceeded) -> HTTPException:
+    # セッション・権限の予算は集計期間が切り替わるまで使えない
+    headers = {"Retry-After": str(int(e.retry_after) + 1)} if e.retry_after is not None else None
+    return HTTPException(status_code=429, detail=str(e), headers=headers)
+
+async def admit_run(request: Request, req: RunRequest, x_priority: Optional[str] = Header(None)):
+    graph = request.url.path.split("/")[2]  # vulnerable / secure / hitl
+    try:
+        async with admission.slot(graph, invoice_priority(req.invoice_text, x_priority)):
+            yield
+    except OverloadedError as e:
+        raise overloaded_response(e)
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+async def admit_approval(req: ApprovalRequest):
+    # 承認は対話中の利用者を待たせないよう最優先で HITL の枠を割り当てる
+    try:
+        async with admission.slot("hitl", PRIORITY_APPROVAL):
+            yield
+    except OverloadedError as e:
+        raise overloaded_response(e)
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+
+# --- Idempotency ---
+# 同じ請求書の二重送信は、実行中の実行に合流させるか保存済みの結果を返す（LLM の再実行・二重送金を防ぐ）
+
+def run_idempotent(graph: str, req: RunRequest, client_key: Optional[str], execute) -> Dict[str, Any]:
+    session_id = current_context().session_id
+    key, digest, ttl = idempotency.key_for(session_id, graph, req.role, req.invoice_text, client_key)
+    try:
+        result, status = idempotency.run(key, digest, ttl, session_id, execute)
+    except IdempotencyKeyMismatch as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    return {**result, "idempotency": {"status": status, "source": "key" if client_key else "content"}}
+
+session_manager.on_evict(idempotency.clear)
+
 @app.post("/reset")
 def reset_system():
-    bank_system.reset()
+    # 現在のセッションの銀行だけをリセットする（他のセッションには影響しない）
+    current_bank().reset()
+    idempotency.clear(current_context().session_id)
     return {"status": "System and Bank reset"}
 
 @app.post("/reset_agents")
 def reset_agents():
     """Reset agent memory only (preserve bank logs for audit)"""
-    from src.backend.agents import reset_agent_memory
-    reset_agent_memory()
+    agents.reset_agent_memory(current_context().session_id)
+    idempotency.clear(current_context().session_id)
     return {"status": "Agent memory cleared"}
 
+@app.get("/health/llm")
+def llm_health():
+    """モデル呼び出しのサーキット状態・レイテンシ・リトライ回数"""
+    return {
+        "agent": agents.agent_caller.stats(),
+        "guardrail": agents.guard_cascade.stats(),
+        "guardrail_fail_policy": agents.GUARDRAIL_FAIL_POLICY
+    }
+
+@app.get("/health/admission")
+def admission_health():
+    """グラフ種別ごとの実行中件数・待ち行列の長さ・待ち時間"""
+    return admission.stats()
+
+@app.get("/health/idempotency")
+def idempotency_health():
+    """重複リクエストの合流・キャッシュの件数"""
+    return idempotency.stats()
+
+@app.get("/usage")
+def llm_usage(all_sessions: bool = False, x_admin_token: Optional[str] = Header(None)):
+    """
+    LLM のトークン数・コスト（現在のセッション、権限ごと、モデルごとの累計、直近の実行）と予算。
+    all_sessions=true で全セッションの直近の実行を返す（管理者トークンが必要）。
+    """
+    if all_sessions:
+        if not is_admin(x_admin_token):
+            raise HTTPException(status_code=403, detail="Admin token required")
+        return usage_meter.report()
+    return usage_meter.report(current_context().session_id)
+
+@app.get("/sessions")
+def session_stats():
+    return session_manager.stats()
+
+@app.delete("/sessions/{session_id}")
+def end_session(session_id: str, x_admin_token: Optional[str] = Header(None)):
+    """
+    セッションを明示的に終了（銀行状態とチェックポイントを破棄、ログ・イベント列はアーカイブ）。
+    終了できるのは自分のセッション（X-Session-ID が一致）だけ。他のセッションの終了には管理者トークンが必要。
+    """
+    if session_id != current_context().session_id and not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Only the session's own client or an admin can end it")
+    try:
+        dropped = session_manager.drop(session_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not dropped:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"status": "Session ended"}
+
+def stream_json_list(key: str, items, chunk_size: int = 500):
+    """{"key": [...]} 形式のJSONを、リスト全体を組み立てずにチャンク単位で書き出す"""
+    yield f'{{"{key}": ['
+    chunk = []
+    first = True
+    for item in items:
+        chunk.append(json.dumps(item, ensure_ascii=False))
+        if len(chunk) >= chunk_size:
+            yield ("" if first else ",") + ",".join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield ("" if first else ",") + ",".join(chunk)
+    yield "]}"
+
 @app.get("/logs")
-def get_logs():
-    return {"logs": bank_system.get_logs()}
+def get_logs(request: Request, offset: Optional[int] = Query(None, ge=0), limit: Optional[int] = Query(None, ge=0, le=5000)):
+    """
+    offset / limit を指定すると、その範囲のログと total・epoch を返す（前回の total を offset にすれば差分のみ）。
+    どちらも省略すると全件をストリーミングで返す。ログが増えていなければ If-None-Match に 304 を返す。
+    """
+    bank = current_bank()
+    version = bank.log_version()
+    if offset is None and limit is None:
+        etag = version_etag(request.url.path, str(request.query_params), *version)
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        return StreamingResponse(stream_json_list("logs", bank.iter_logs()), media_type="application/json", headers={"ETag": etag})
+    return cached_json(request, lambda: bank.log_window(offset or 0, limit), version)
+
+@app.get("/logs/search")
+def search_logs(
+    request: Request,
+    q: str = "",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(50, ge=0, le=1000),
+    order: str = "desc",
+):
+    """
+    ログの検索（語・"フレーズ"・field:value・先頭 "-" で除外。field は actor / vendor / account / amount）。
+    limit=0 で件数のみ。order=desc で新しい順。
+    """
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be asc or desc")
+    bank = current_bank()
+    try:
+        # 結果はログとクエリだけで決まるため、ログが増えていなければ検索せずに 304 を返す
+        return cached_json(
+            request,
+            lambda: bank.search_logs(q, start, end, offset, limit, newest_first=order == "desc"),
+            bank.log_version(),
+        )
+    except QueryError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/audit")
-def audit_logs():
-    return {"anomalies": bank_system.audit_logs()}
+def audit_logs(request: Request, offset: Optional[int] = Query(None, ge=0), limit: Optional[int] = Query(None, ge=0, le=5000)):
+    """offset / limit を指定すると、その範囲の異常と total・counts・epoch を返す。"""
+    bank = current_bank()
+    if offset is None and limit is None:
+        return cached_json(request, lambda: {"anomalies": bank.audit_logs()}, bank.audit_version())
+    return cached_json(request, lambda: bank.audit_window(offset or 0, limit), bank.audit_version())
+
+@app.post("/audit/recompute")
+def recompute_audit():
+    """統計的異常検知を全取引から一括再計算（バックフィル後など）"""
+    bank = current_bank()
+    bank.analytics.recompute()
+    return {"anomalies": bank.audit_logs()}
+
+@app.post("/audit/replay")
+def replay_audit_rules(req: ReplayRequest):
+    """記録済みの操作を再生し、監査ルールを変えた場合の検知結果を現在のルールと比較（LLM は呼ばない）"""
+    bank = current_bank()
+    try:
+        candidate = bank.audit_rules.with_overrides(**req.rules)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # 現在の期間は、稼働中の状態・監査結果と同じ時点のイベント列を使う
+    with bank._lock:
+        events = list(bank.events.with_lines(bank.logs))
+        live_anomalies = bank.audit_logs()
+        live_state = {"accounts": dict(bank.accounts), "balances": dict(bank.balances), "log_count": len(bank.logs)}
+        archives = bank.events.list_archives() if req.include_archived else []
+    epochs = [EpochReplay(EventLog.iter_archive(a), os.path.basename(a["path"])) for a in archives]
+    epochs.append(EpochReplay(events, "current"))
+    result = replay_audit(epochs, bank.audit_rules, candidate, req.partitions, live=("current", live_anomalies))
+    current = result["epochs"][-1]
+    current["matches_live"] = {k: current[k] for k in live_state} == live_state
+    diff = result["diff"]
+    diff["added_count"], diff["removed_count"] = len(diff["added"]), len(diff["removed"])
+    diff["added"], diff["removed"] = diff["added"][:req.limit], diff["removed"][:req.limit]
+    return result
+
+@app.get("/export/{dataset}")
+def export_data(
+    request: Request,
+    dataset: str,
+    format: str = "jsonl",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    vendor: Optional[str] = None,
+    kind: Optional[str] = None,
+    severity: Optional[str] = None,
+    include_archived: bool = False,
+    gzip: Optional[bool] = None,
+):
+    """
+    履歴（ledger / logs）と監査結果（anomalies）をストリーミングで書き出す。
+    format: jsonl / csv / arrow（pyarrow が必要）。kind・severity はカンマ区切り。
+    gzip を省略した場合は Accept-Encoding に従う。
+    """
+    if dataset not in EXPORT_COLUMNS:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset: {dataset}")
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+    if format == "arrow" and pa is None:
+        raise HTTPException(status_code=501, detail="Arrow export requires pyarrow to be installed")
+    bank = current_bank()
+    if vendor is not None:
+        vendor = bank._resolve_vendor(vendor) or vendor
+    split = lambda raw: [v.strip() for v in raw.split(",") if v.strip()] if raw else None
+    flt = ExportFilter(start, end, vendor, split(kind), split(severity))
+    if dataset == "ledger":
+        rows = iter_ledger(bank_epochs(bank, include_archived), flt)
+    elif dataset == "logs":
+        rows = iter_log_lines(bank_epochs(bank, include_archived), flt)
+    else:
+        rows = iter_anomalies(bank, flt)
+    if gzip is None:
+        gzip = "gzip" in request.headers.get("Accept-Encoding", "")
+    media_type, extension = EXPORT_FORMATS[format]
+    headers = {"Content-Disposition": f'attachment; filename="{dataset}.{extension}"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(export_stream(rows, dataset, format, gzip), media_type=media_type, headers=headers)
+
+@app.get("/screening")
+def screening_status():
+    """確定前スクリーニングの統計（判定件数・ルール別件数・判定時間）と保留中の操作"""
+    bank = current_bank()
+    return {"stats": bank.screener.stats(), "holds": bank.list_holds()}
+
+@app.post("/screening/holds/{hold_id}")
+def resolve_hold(hold_id: str, req: HoldDecisionRequest):
+    """スクリーニングで保留された操作を実行または却下"""
+    result = current_bank().resolve_hold(hold_id, req.approved, role=req.role)
+    if result.startswith("ERROR: Hold"):
+        raise HTTPException(status_code=404, detail=result)
+    return {"result": result}
+
+@app.get("/vendors/resolve")
+def resolve_vendor(name: str, limit: int = 5):
+    """取引先名の表記ゆれを解決（別名・頭字語・トライグラムによるあいまい検索、現在のセッションの取引先を含む）"""
+    vendors = current_bank().vendors
+    match = vendors.resolve(name)
+    return {
+        "match": match.to_dict() if match else None,
+        "candidates": [m.to_dict() for m in vendors.search(name, limit=limit, threshold=0.2)]
+    }
+
+@app.get("/vendors/{vendor}/history")
+def vendor_account_history(vendor: str):
+    """取引先の口座変更履歴（現在のセッションの銀行）"""
+    bank = current_bank()
+    return {
+        "vendor": vendor,
+        "current_account": bank.accounts.get(vendor),
+        "aliases": bank.vendors.aliases_of(vendor),
+        "history": bank.get_account_history(vendor)
+    }
 
-@app.post("/run/vulnerable")
-async def run_vulnerable(req: RunRequest):
+@app.get("/ledger/balance/{account}")
+def ledger_balance(account: str, at: Optional[float] = None):
+    """勘定残高（at にUNIX時刻を指定するとその時点の残高）"""
+    ledger = current_bank().ledger
+    return {"account": account, "at": at, "balance": ledger.balance(account) if at is None else ledger.balance_at(account, at)}
+
+@app.get("/ledger/paid/{vendor}")
+def ledger_paid(vendor: str, start: Optional[float] = None, end: Optional[float] = None):
+    """期間内に取引先へ支払った合計"""
+    return {"vendor": vendor, "start": start, "end": end, "total": current_bank().ledger.paid_to(vendor, start, end)}
+
+@app.get("/ledger/trial_balance")
+def ledger_trial_balance(at: Optional[float] = None):
+    """全勘定の残高一覧（照合用、total が 0 なら貸借一致）"""
+    return current_bank().ledger.trial_balance(at)
+
+@app.get("/settlement")
+def settlement_status():
+    """まとめて決済するモードの状態（決済待ちの送金・直近の決済と割当）"""
+    bank = current_bank()
+    if bank.settlement is None:
+        return {"mode": "immediate"}
+    with bank._lock:
+        return {
+            "mode": "batch",
+            "stats": bank.settlement.stats(),
+            "pending": [p.to_dict() for p in bank.settlement.pending],
+            "recent_settlements": list(bank.settlement.settlements)[-10:]
+        }
+
+@app.post("/settlement/flush")
+def flush_settlement():
+    """ウィンドウを待たずに決済待ちの送金を決済"""
+    return {"settlement": current_bank().settle_pending()}
+
+@app.post("/classify")
+def classify_invoices(req: ClassifyRequest):
+    """ローカル分類器で請求書のバッチをスコアリング（LLMは呼び出さない）"""
+    classifier = get_injection_classifier()
+    return {"threshold": classifier.threshold, "results": classifier.screen(req.texts)}
+
+@app.post("/run/vulnerable", dependencies=[Depends(admit_run)])
+def run_vulnerable(req: RunRequest):
     # Set User Role in Context
-    token = user_role_var.set(req.role)
+    current_context().role = req.role
     
     # 脆弱なエージェント: 最後まで一気に実行
     # ステートを持たないため、毎回新しい実行として扱う
@@ -90,8 +481,19 @@ async def run_vulnerable(req: RunRequest):
 
         # invokeで実行。同期的に完了まで待つ
         # Recursion limitを明示的に指定（デフォルト25だが、無限ループ対策に入れておく）
-        result = vulnerable_app.invoke(inputs, {"recursion_limit": 20})
-        return {"status": "completed", "final_output": str(result["messages"][-1].content)}
+        # トークン・コストの予算を超えた場合は、それより前に打ち切られる
+        with usage_meter.run("vulnerable", req.role, current_context().session_id) as run_usage:
+            result = vulnerable_app.invoke(inputs, {"recursion_limit": 20})
+        return {"status": "completed", "final_output": str(result["messages"][-1].content), "usage": run_usage.to_dict()}
+    except BudgetExceeded as e:
+        raise budget_response(e)
+    except RequestCancelled as e:
+        raise cancelled_response(e)
+    except CircuitOpenError as e:
+        # LLMプロバイダの障害が続いている間は待たせずに即座に 503 を返す
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after) + 1)})
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         # GraphRecursionError もここでキャッチされる（ImportError回避のため文字列チェック等も有効だが、
         # ここでは traceback を出してデバッグしやすくしつつ、500エラーの内容をリッチにする）
@@ -108,21 +510,33 @@ async def run_vulnerable(req: RunRequest):
 
              
         raise HTTPException(status_code=500, detail=f"{type(e).__name__}: {str(e)}")
-    finally:
-        user_role_var.reset(token)
 
-@app.post("/run/secure/start")
-def start_secure(req: RunRequest):
+@app.post("/run/secure/start", dependencies=[Depends(admit_run)])
+def start_secure(req: RunRequest, idempotency_key: Optional[str] = Header(None)):
+    return run_idempotent("secure", req, idempotency_key, lambda: run_secure(req))
+
+def run_secure(req: RunRequest) -> Dict[str, Any]:
+    # LLMを呼ぶ前にローカル分類器で事前判定（gateモードでは明らかな攻撃をここで止める）
+    prescreen = prescreen_invoice(req.invoice_text)
+    if prescreen and prescreen["blocked"]:
+        return {
+            "status": "completed",
+            "thread_id": None,
+            "final_output": INJECTION_BLOCK_MESSAGE,
+            "prescreen": prescreen
+        }
+
     # Set User Role in Context
-    token = user_role_var.set(req.role)
+    current_context().role = req.role
 
-    thread_id = str(uuid.uuid4())
+    thread_id = new_thread_id(current_context().session_id, str(uuid.uuid4()))
     config = {"configurable": {"thread_id": thread_id}}
     inputs = {"messages": [HumanMessage(content=req.invoice_text)]}
     
     # ガードレール付きエージェントを実行（非同期/中断なしで完了まで実行）
     try:
-        result = secure_app.invoke(inputs, config=config)
+        with usage_meter.run("secure", req.role, current_context().session_id) as run_usage:
+            result = agents.secure_app.invoke(inputs, config=config)
         final_output = str(result["messages"][-1].content)
         
         # ガードレールがブロックしたかどうかを判定するためにツールコール履歴を確認することも可能だが
@@ -131,26 +545,49 @@ def start_secure(req: RunRequest):
         return {
             "status": "completed",
             "thread_id": thread_id,
-            "final_output": final_output
+            "final_output": final_output,
+            "prescreen": prescreen,
+            "usage": run_usage.to_dict()
         }
+    except BudgetExceeded as e:
+        raise budget_response(e)
+    except RequestCancelled as e:
+        raise cancelled_response(e)
+    except CircuitOpenError as e:
+        # LLMプロバイダの障害が続いている間は待たせずに即座に 503 を返す
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after) + 1)})
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        user_role_var.reset(token)
 
 # --- HITL Endpoints (Human-in-the-Loop) ---
 
-@app.post("/run/hitl/start")
-def start_hitl(req: RunRequest):
+@app.post("/run/hitl/start", dependencies=[Depends(admit_run)])
+def start_hitl(req: RunRequest, idempotency_key: Optional[str] = Header(None)):
     """HITL付きエージェントを開始"""
-    token = user_role_var.set(req.role)
+    return run_idempotent("hitl", req, idempotency_key, lambda: run_hitl(req))
+
+def run_hitl(req: RunRequest) -> Dict[str, Any]:
+    prescreen = prescreen_invoice(req.invoice_text)
+    if prescreen and prescreen["blocked"]:
+        return {
+            "status": "completed",
+            "thread_id": None,
+            "final_output": INJECTION_BLOCK_MESSAGE,
+            "messages": [],
+            "prescreen": prescreen
+        }
+
+    current_context().role = req.role
     
-    thread_id = str(uuid.uuid4())
+    thread_id = new_thread_id(current_context().session_id, str(uuid.uuid4()))
     config = {"configurable": {"thread_id": thread_id}}
     inputs = {"messages": [HumanMessage(content=req.invoice_text)]}
     
     try:
-        result = hitl_app.invoke(inputs, config=config)
+        with usage_meter.run("hitl", req.role, current_context().session_id) as run_usage:
+            result = agents.hitl_app.invoke(inputs, config=config)
         final_output = str(result["messages"][-1].content)
         
         # 承認待ち状態かチェック
@@ -160,37 +597,50 @@ def start_hitl(req: RunRequest):
             "status": "pending_approval" if is_pending else "completed",
             "thread_id": thread_id,
             "final_output": final_output,
-            "messages": [{"type": msg.type, "content": str(msg.content)} for msg in result["messages"][-3:]]
+            "messages": [{"type": msg.type, "content": str(msg.content)} for msg in result["messages"][-3:]],
+            "prescreen": prescreen,
+            "usage": run_usage.to_dict()
         }
+    except BudgetExceeded as e:
+        raise budget_response(e)
+    except RequestCancelled as e:
+        raise cancelled_response(e)
+    except CircuitOpenError as e:
+        # LLMプロバイダの障害が続いている間は待たせずに即座に 503 を返す
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after) + 1)})
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        user_role_var.reset(token)
-
-class ApprovalRequest(BaseModel):
-    thread_id: str
-    approved: bool  # True = 承認, False = 拒否
 
-@app.post("/run/hitl/approve")
+@app.post("/run/hitl/approve", dependencies=[Depends(admit_approval)])
 def approve_hitl(req: ApprovalRequest):
     """承認待ちの操作を承認または拒否"""
     config = {"configurable": {"thread_id": req.thread_id}}
+    # スレッドを作成したセッションの銀行で再開する
+    ctx = current_context()
+    ctx.session_id = session_of_thread(req.thread_id)
+    # 承認・拒否後のスレッドを、開始リクエストの再送で返さない
+    idempotency.forget_thread(req.thread_id)
     
     try:
         # 現在の状態を取得
-        snapshot = hitl_app.get_state(config)
+        snapshot = agents.hitl_app.get_state(config)
         
         if req.approved:
             # 承認: ツールを実行
             # 承認待ちメッセージを削除して、ツール実行を続行
             # 簡易実装: 新しいメッセージで続行を指示
-            result = hitl_app.invoke(
-                {"messages": [HumanMessage(content="承認されました。処理を続行してください。")]},
-                config=config
-            )
+            # 承認後の再開も1回の実行として予算を数える（承認リクエストは権限を持たないため現在の権限で集計する）
+            with usage_meter.run("hitl", ctx.role, ctx.session_id) as run_usage:
+                result = agents.hitl_app.invoke(
+                    {"messages": [HumanMessage(content="承認されました。処理を続行してください。")]},
+                    config=config
+                )
             return {
                 "status": "approved",
-                "final_output": str(result["messages"][-1].content)
+                "final_output": str(result["messages"][-1].content),
+                "usage": run_usage.to_dict()
             }
         else:
             # 拒否: 処理を中止
@@ -198,14 +648,178 @@ def approve_hitl(req: ApprovalRequest):
                 "status": "rejected",
                 "final_output": "操作が拒否されました。処理を中止します。"
             }
+    except BudgetExceeded as e:
+        raise budget_response(e)
+    except RequestCancelled as e:
+        raise cancelled_response(e)
+    except CircuitOpenError as e:
+        # LLMプロバイダの障害が続いている間は待たせずに即座に 503 を返す
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(int(e.retry_after) + 1)})
+    except TimeoutError as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- Thread State ---
+# secure / HITL のチェックポイントを構造化して返す（graph=auto ではスレッドを持つ方を探す）
+
+def thread_reader(thread_id: str, graph: str) -> Tuple[str, ThreadStateReader]:
+    savers = {"secure": agents.memory, "hitl": agents.hitl_memory}
+    if graph != "auto" and graph not in savers:
+        raise HTTPException(status_code=400, detail="graph must be one of: auto, secure, hitl")
+    for name in ([graph] if graph != "auto" else list(savers)):
+        if savers[name].checkpoint_ids(thread_id):
+            return name, ThreadStateReader(savers[name], thread_id)
+    raise HTTPException(status_code=404, detail="Thread not found")
+
+def parse_field_params(raw: Optional[str], allowed, default) -> Tuple[str, ...]:
+    try:
+        return parse_fields(raw, allowed, default)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/state/{thread_id}")
-def get_state(thread_id: str):
-    config = {"configurable": {"thread_id": thread_id}}
-    snapshot = secure_app.get_state(config)
-    return {
-        "values": str(snapshot.values),
-        "next": snapshot.next
-    }
+def get_state(
+    request: Request,
+    thread_id: str,
+    graph: str = "auto",
+    checkpoint_id: Optional[str] = None,
+    fields: Optional[str] = None,
+    message_fields: Optional[str] = None,
+    offset: int = 0,
+    limit: int = Query(50, ge=1, le=500),
+    max_content: Optional[int] = Query(None, ge=0),
+):
+    """
+    スレッドの状態（fields: checkpoint, metadata, message_count, messages, next）。
+    メッセージは offset/limit でページ分割（offset が負なら末尾から）。next はグラフ全体の復元が必要なため指定時のみ計算する。
+    """
+    graph, reader = thread_reader(thread_id, graph)
+    state_fields = parse_field_params(fields, STATE_FIELDS, DEFAULT_STATE_FIELDS)
+    msg_fields = parse_field_params(message_fields, MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS)
+
+    def build():
+        try:
+            result = reader.state(checkpoint_id, state_fields, msg_fields, offset, limit, max_content)
+        except ThreadNotFound:
+            raise HTTPException(status_code=404, detail="Checkpoint not found")
+        result["graph"] = graph
+        if "next" in state_fields:
+            app_ = agents.secure_app if graph == "secure" else agents.hitl_app
+            config = {"configurable": {"thread_id": thread_id}}
+            if checkpoint_id:
+                config["configurable"]["checkpoint_id"] = checkpoint_id
+            result["next"] = list(app_.get_state(config).next)
+        return result
+
+    # チェックポイントは追記のみなので、最新のチェックポイントが同じなら状態も同じ
+    return cached_json(request, build, (graph, reader.latest_checkpoint_id()))
+
+@app.get("/state/{thread_id}/history")
+def get_state_history(
+    request: Request,
+    thread_id: str,
+    graph: str = "auto",
+    before: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=200),
+):
+    """チェックポイントの一覧（新しい順）。next_before を before に渡すと次のページ"""
+    graph, reader = thread_reader(thread_id, graph)
+
+    def build():
+        try:
+            return {"graph": graph, **reader.history(before, limit)}
+        except ThreadNotFound:
+            raise HTTPException(status_code=404, detail="Thread not found")
+
+    return cached_json(request, build, (graph, reader.latest_checkpoint_id()))
+
+@app.get("/state/{thread_id}/diff")
+def get_state_diff(
+    request: Request,
+    thread_id: str,
+    base: str,
+    target: Optional[str] = None,
+    graph: str = "auto",
+    message_fields: Optional[str] = None,
+    max_content: Optional[int] = Query(None, ge=0),
+):
+    """チェックポイント base から target（省略時は最新）までに追加・削除されたメッセージ"""
+    graph, reader = thread_reader(thread_id, graph)
+    msg_fields = parse_field_params(message_fields, MESSAGE_FIELDS, DEFAULT_MESSAGE_FIELDS)
+
+    def build():
+        try:
+            return {"graph": graph, **reader.diff(base, target, msg_fields, max_content)}
+        except ThreadNotFound:
+            raise HTTPException(status_code=404, detail="Checkpoint not found")
+
+    return cached_json(request, build, (graph, reader.latest_checkpoint_id()))
+
+# --- Admin: Profiling ---
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not profiler.enabled:
+        # 無効時はエンドポイントの存在自体を見せない
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+def memory_gauges() -> Dict[str, Any]:
+    """チェックポイントとログの規模（tracemalloc の差分と合わせて増加の原因を確認する）"""
+    gauges: Dict[str, Any] = {}
+    for name, saver in (("secure", agents.memory), ("hitl", agents.hitl_memory)):
+        gauges[f"{name}_threads"] = len(saver.storage)
+        gauges[f"{name}_checkpoints"] = sum(len(cps) for namespaces in saver.storage.values() for cps in namespaces.values())
+        gauges[f"{name}_blobs"] = len(saver.blobs)
+    gauges.update({f"content_store_{k}": v for k, v in agents.content_store.stats().items()})
+    gauges["bank_log_lines"] = len(current_bank().logs)
+    gauges["active_sessions"] = session_manager.stats()["active_sessions"]
+    return gauges
+
+@app.get("/admin/profiling/reports", dependencies=[Depends(require_admin)])
+def list_profile_reports():
+    return {"reports": profiler.list_reports()}
+
+@app.get("/admin/profiling/reports/{report_id}", dependencies=[Depends(require_admin)])
+def get_profile_report(report_id: str, format: str = "json", top: int = 30):
+    """format=folded で flamegraph 用の折りたたみスタックをダウンロード"""
+    report = profiler.get(report_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Report not found")
+    if format == "folded":
+        return PlainTextResponse(
+            report.folded(),
+            headers={"Content-Disposition": f'attachment; filename="{report_id}.folded.txt"'}
+        )
+    return report.summary(top)
+
+@app.post("/admin/profiling/memory/snapshots", dependencies=[Depends(require_admin)])
+def take_memory_snapshot():
+    """tracemalloc のスナップショットを取得（初回呼び出しで計測を開始）"""
+    return memory_tracker.snapshot(memory_gauges())
+
+@app.get("/admin/profiling/memory/snapshots", dependencies=[Depends(require_admin)])
+def list_memory_snapshots():
+    return {"snapshots": memory_tracker.list_snapshots(), "scopes": list(MEMORY_SCOPES)}
+
+@app.get("/admin/profiling/memory/snapshots/{snapshot_id}", dependencies=[Depends(require_admin)])
+def get_memory_snapshot(snapshot_id: str, scope: str = "all", group_by: str = "lineno", limit: int = 20):
+    result = memory_tracker.top(snapshot_id, scope, group_by, limit)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+    return result
+
+@app.get("/admin/profiling/memory/diff", dependencies=[Depends(require_admin)])
+def diff_memory_snapshots(base: str, target: str, scope: str = "all", group_by: str = "lineno", limit: int = 20):
+    """2つのスナップショット間で増えた確保箇所（scope=checkpoint / logs で絞り込み）"""
+    result = memory_tracker.diff(base, target, scope, group_by, limit)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
+    return result
+
+@app.delete("/admin/profiling/memory/snapshots", dependencies=[Depends(require_admin)])
+def stop_memory_tracking():
+    """スナップショットを破棄して tracemalloc を停止"""
+    memory_tracker.stop()
+    return {"status": "Memory tracking stopped"}
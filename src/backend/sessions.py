@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from src.backend.context import current_context
+from src.backend.mock_bank import MockBank, bank_system
+
+# --- Session-scoped Bank State ---
+# セッションIDごとに独立した MockBank を持たせ、同時に操作する利用者同士が状態を上書きしないようにします。
+# 新しいセッションの銀行はシードスナップショットを共有して作られ、最初の書き込みでコピーされます（Copy-on-Write）。
+# 一定時間アクセスのないセッションは破棄します（ログ・イベント列はアーカイブとしてディスクに残ります）。
+# "default" セッションは従来どおりグローバルな bank_system を使い、破棄しません（初期化は /reset で行う）。
+# 環境変数:
+#   SESSION_IDLE_TTL: アイドルセッションを破棄するまでの秒数 (デフォルト 1800)
+#   SESSION_MAX: 同時に保持するセッション数の上限 (デフォルト 1000)
+
+DEFAULT_SESSION = "default"
+
+
+class Session:
+    def __init__(self, session_id: str, bank: MockBank):
+        self.session_id = session_id
+        self.bank = bank
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+
+class SessionManager:
+    def __init__(self, idle_ttl: Optional[float] = None, max_sessions: Optional[int] = None, sweep_interval: float = 60.0):
+        self.idle_ttl = idle_ttl or float(os.getenv("SESSION_IDLE_TTL", "1800"))
+        self.max_sessions = max_sessions or int(os.getenv("SESSION_MAX", "1000"))
+        self.sweep_interval = sweep_interval
+        self._sessions: Dict[str, Session] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        self._evict_hooks: List[Callable[[str], None]] = []
+
+    def on_evict(self, hook: Callable[[str], None]) -> None:
+        """セッション破棄時に呼ばれるフックを登録します（エージェントのチェックポイント削除など）。"""
+        self._evict_hooks.append(hook)
+
+    def get(self, session_id: str) -> Session:
+        now = time.time()
+        evicted: List[Session] = []
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                bank = bank_system if session_id == DEFAULT_SESSION else MockBank.from_snapshot(session_id)
+                session = self._sessions[session_id] = Session(session_id, bank)
+            session.last_used = now
+            if now - self._last_sweep >= self.sweep_interval or len(self._sessions) > self.max_sessions:
+                evicted = self._collect_idle(now)
+        for old in evicted:
+            self._finalize(old)
+        return session
+
+    def drop(self, session_id: str) -> bool:
+        if session_id == DEFAULT_SESSION:
+            # グローバルな bank_system はログだけ退避しても索引・台帳が残るため、破棄せず reset() で初期化する
+            raise ValueError("The default session cannot be ended; use /reset instead")
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self._finalize(session)
+        return True
+
+    def evict_idle(self) -> List[str]:
+        with self._lock:
+            evicted = self._collect_idle(time.time())
+        for session in evicted:
+            self._finalize(session)
+        return [s.session_id for s in evicted]
+
+    def _collect_idle(self, now: float) -> List[Session]:
+        self._last_sweep = now
+        candidates = [s for s in self._sessions.values() if s.session_id != DEFAULT_SESSION]
+        idle = [s for s in candidates if now - s.last_used > self.idle_ttl]
+        # 上限を超えている場合は、最も古いものから追加で破棄する
+        overflow = len(self._sessions) - len(idle) - self.max_sessions
+        if overflow > 0:
+            active = sorted((s for s in candidates if s not in idle), key=lambda s: s.last_used)
+            idle.extend(active[:overflow])
+        for session in idle:
+            del self._sessions[session.session_id]
+        return idle
+
+    def _finalize(self, session: Session) -> None:
+        session.bank.archive()
+        for hook in self._evict_hooks:
+            hook(session.session_id)
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            return {
+                "active_sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "idle_ttl": self.idle_ttl,
+            }
+
+
+session_manager = SessionManager()
+
+
+def current_bank() -> MockBank:
+    """現在のリクエストのセッションに対応する銀行を返します。"""
+    return session_manager.get(current_context().session_id).bank
+
+
+def new_thread_id(session_id: str, suffix: str) -> str:
+    """セッションIDを名前空間として含むスレッドIDを作成します。"""
+    return f"{session_id}:{suffix}"
+
+
+def session_of_thread(thread_id: str) -> str:
+    return thread_id.split(":", 1)[0] if ":" in thread_id else DEFAULT_SESSION
@@ -0,0 +1,105 @@
+import itertools
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+# --- Batched Settlement with Netting ---
+# 送金を1件ずつ即時に実行する代わりに、一定時間（ウィンドウ）の間に承認された送金を溜めておき、
+# 取引先・口座ごとに相殺（ネッティング）した上で、1回のまとめた仕訳として決済します。
+# 請求書ごとの送金は「割当（allocation）」として記録し、銀行ログ・異常検知には従来どおり1件ずつ反映します。
+# 環境変数:
+#   SETTLEMENT_MODE: "immediate"（従来どおり即時送金） / "batch"（まとめて決済） (デフォルト "immediate")
+#   SETTLEMENT_WINDOW: 最初の送金を受け付けてから決済するまでの秒数 (デフォルト 2)
+#   SETTLEMENT_MAX_BATCH: この件数に達したらウィンドウを待たずに決済 (デフォルト 100)
+
+
+def settlement_mode() -> str:
+    mode = os.getenv("SETTLEMENT_MODE", "immediate").lower()
+    return mode if mode in ("immediate", "batch") else "immediate"
+
+
+class PendingPayment:
+    __slots__ = ("allocation_id", "vendor", "account", "amount", "queued_at")
+
+    def __init__(self, allocation_id: str, vendor: str, account: str, amount: int):
+        self.allocation_id = allocation_id
+        self.vendor = vendor
+        self.account = account
+        self.amount = amount
+        self.queued_at = time.time()
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "allocation_id": self.allocation_id,
+            "vendor": self.vendor,
+            "account": self.account,
+            "amount": self.amount,
+            "queued_at": self.queued_at,
+        }
+
+
+def net_payments(payments: List[PendingPayment]) -> Dict[Tuple[str, str], int]:
+    """取引先・口座ごとに金額を合算します（口座が途中で変わった場合は別の振込として扱う）。"""
+    nets: Dict[Tuple[str, str], int] = {}
+    for payment in payments:
+        key = (payment.vendor, payment.account)
+        nets[key] = nets.get(key, 0) + payment.amount
+    return nets
+
+
+class SettlementBatcher:
+    """決済待ちの送金を保持します（銀行のロック内で操作される前提）。"""
+
+    def __init__(self, window: Optional[float] = None, max_batch: Optional[int] = None, history: int = 100):
+        self.window = window if window is not None else float(os.getenv("SETTLEMENT_WINDOW", "2"))
+        self.max_batch = max_batch or int(os.getenv("SETTLEMENT_MAX_BATCH", "100"))
+        self.pending: List[PendingPayment] = []
+        self.pending_total = 0
+        self.settlements: Deque[Dict[str, object]] = deque(maxlen=history)
+        self._allocation_ids = itertools.count(1)
+        self._settlement_ids = itertools.count(1)
+        self.counters: Dict[str, int] = {"payments": 0, "settlements": 0, "transfers": 0, "failed": 0}
+
+    def add(self, vendor: str, account: str, amount: int) -> PendingPayment:
+        payment = PendingPayment(f"alloc-{next(self._allocation_ids)}", vendor, account, amount)
+        self.pending.append(payment)
+        self.pending_total += amount
+        self.counters["payments"] += 1
+        return payment
+
+    @property
+    def full(self) -> bool:
+        return len(self.pending) >= self.max_batch
+
+    def drain(self) -> List[PendingPayment]:
+        payments, self.pending = self.pending, []
+        self.pending_total = 0
+        return payments
+
+    def next_settlement_id(self) -> str:
+        return f"stl-{next(self._settlement_ids)}"
+
+    def record(self, settlement_id: str, nets: Dict[Tuple[str, str], int], payments: List[PendingPayment],
+               failed: Optional[List[PendingPayment]] = None) -> Dict[str, object]:
+        self.counters["settlements"] += 1
+        self.counters["transfers"] += len(nets)
+        self.counters["failed"] += len(failed or [])
+        record = {
+            "settlement_id": settlement_id,
+            "settled_at": time.time(),
+            "transfers": [{"vendor": v, "account": a, "amount": amount} for (v, a), amount in nets.items()],
+            "allocations": [p.to_dict() for p in payments],
+            "failed": [p.to_dict() for p in failed or []],
+        }
+        self.settlements.append(record)
+        return record
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            "window": self.window,
+            "max_batch": self.max_batch,
+            "pending_count": len(self.pending),
+            "pending_total": self.pending_total,
+            **self.counters,
+        }
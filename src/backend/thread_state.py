@@ -0,0 +1,182 @@
+import hashlib
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from langchain_core.messages import BaseMessage
+
+from src.backend.checkpoint_store import DedupMemorySaver
+
+# --- Structured Thread State ---
+# チェックポイント済みのスレッド（secure / HITL）の状態を、構造化された形でページ単位に返します。
+# - メッセージは種別・本文・ツール呼び出しなどのフィールドに分け、必要なフィールドだけを返す
+# - メッセージの件数・ページ分割・チェックポイント間の差分は、保存済みのダイジェストの並びだけで計算し、
+#   実際に返すページのメッセージだけを復元する（長いスレッドでも全体を文字列化しない）
+# - チェックポイントの一覧は新しい順に、before（チェックポイントID）をカーソルとしてページ分割する
+
+MESSAGE_FIELDS = ("id", "type", "content", "name", "tool_calls", "tool_call_id", "usage")
+STATE_FIELDS = ("checkpoint", "metadata", "message_count", "messages", "next")
+DEFAULT_MESSAGE_FIELDS = ("id", "type", "content", "tool_calls")
+DEFAULT_STATE_FIELDS = ("checkpoint", "message_count", "messages")
+
+
+class ThreadNotFound(Exception):
+    pass
+
+
+def parse_fields(raw: Optional[str], allowed: Sequence[str], default: Sequence[str]) -> Tuple[str, ...]:
+    """カンマ区切りのフィールド指定を検証します（未知のフィールドは ValueError）。"""
+    if not raw:
+        return tuple(default)
+    fields = tuple(f.strip() for f in raw.split(",") if f.strip())
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)} (allowed: {', '.join(allowed)})")
+    return fields
+
+
+def message_to_dict(message: BaseMessage, fields: Sequence[str], max_content: Optional[int] = None) -> Dict[str, Any]:
+    item: Dict[str, Any] = {}
+    for field in fields:
+        if field == "content":
+            content = message.content if isinstance(message.content, str) else str(message.content)
+            if max_content is not None and len(content) > max_content:
+                item["content"] = content[:max_content]
+                item["truncated"] = True
+            else:
+                item["content"] = content
+        elif field == "tool_calls":
+            calls = getattr(message, "tool_calls", None)
+            if calls:
+                item["tool_calls"] = [{"id": c.get("id"), "name": c["name"], "args": c["args"]} for c in calls]
+        elif field == "usage":
+            usage = getattr(message, "usage_metadata", None)
+            if usage:
+                item["usage"] = dict(usage)
+        else:
+            value = getattr(message, field, None)
+            if value is not None:
+                item[field] = value
+    return item
+
+
+class MessageList:
+    """チェックポイントのメッセージリスト。ダイジェストで保存されていれば、ページ単位で復元します。"""
+
+    def __init__(self, saver: DedupMemorySaver, blob: Optional[Tuple[str, bytes]]):
+        self.saver = saver
+        self.digests = saver.message_digests(blob) if blob is not None else []
+        self._messages: Optional[List[BaseMessage]] = None
+        if self.digests is None:
+            # ダイジェストで保存されていない値（空リストなど）はそのまま復元する
+            self._messages = saver.serde.loads_typed(blob) or []
+            self.digests = [hashlib.sha256(saver.serde.dumps_typed(m)[1]).hexdigest() for m in self._messages]
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    def load(self, start: int, stop: int) -> List[BaseMessage]:
+        if self._messages is not None:
+            return self._messages[start:stop]
+        return self.saver.serde.load_messages(self.digests[start:stop])
+
+
+class ThreadStateReader:
+    def __init__(self, saver: DedupMemorySaver, thread_id: str, channel: str = "messages"):
+        self.saver = saver
+        self.thread_id = thread_id
+        self.channel = channel
+
+    def latest_checkpoint_id(self) -> Optional[str]:
+        ids = self.saver.checkpoint_ids(self.thread_id)
+        return ids[0] if ids else None
+
+    def _read(self, checkpoint_id: Optional[str]) -> Tuple[str, Dict[str, Any], Dict[str, Any], Optional[str]]:
+        saved = self.saver.read_checkpoint(self.thread_id, checkpoint_id)
+        if saved is None:
+            raise ThreadNotFound(checkpoint_id or self.thread_id)
+        return saved
+
+    def _messages(self, checkpoint: Dict[str, Any]) -> MessageList:
+        return MessageList(self.saver, self.saver.channel_blob(self.thread_id, checkpoint, self.channel))
+
+    @staticmethod
+    def _summary(checkpoint_id: str, checkpoint: Dict[str, Any], metadata: Dict[str, Any],
+                 parent_id: Optional[str]) -> Dict[str, Any]:
+        return {
+            "checkpoint_id": checkpoint_id,
+            "parent_checkpoint_id": parent_id,
+            "created_at": checkpoint.get("ts"),
+            "step": metadata.get("step"),
+            "source": metadata.get("source"),
+        }
+
+    def state(self, checkpoint_id: Optional[str] = None, fields: Sequence[str] = DEFAULT_STATE_FIELDS,
+              message_fields: Sequence[str] = DEFAULT_MESSAGE_FIELDS, offset: int = 0, limit: int = 50,
+              max_content: Optional[int] = None) -> Dict[str, Any]:
+        """
+        チェックポイント（省略時は最新）の状態を返します。
+        offset が負の場合は末尾から数える（offset=-10 で最新10件）。
+        """
+        checkpoint_id, checkpoint, metadata, parent_id = self._read(checkpoint_id)
+        result: Dict[str, Any] = {"thread_id": self.thread_id}
+        if "checkpoint" in fields:
+            result["checkpoint"] = self._summary(checkpoint_id, checkpoint, metadata, parent_id)
+        if "metadata" in fields:
+            result["metadata"] = metadata
+        if "message_count" in fields or "messages" in fields:
+            messages = self._messages(checkpoint)
+            total = len(messages)
+            if "message_count" in fields:
+                result["message_count"] = total
+            if "messages" in fields:
+                start = max(total + offset, 0) if offset < 0 else min(offset, total)
+                stop = min(start + limit, total)
+                result["messages"] = [message_to_dict(m, message_fields, max_content) for m in messages.load(start, stop)]
+                result["page"] = {"offset": start, "limit": limit, "total": total, "has_more": stop < total}
+        return result
+
+    def history(self, before: Optional[str] = None, limit: int = 20, with_counts: bool = True) -> Dict[str, Any]:
+        """チェックポイントの一覧（新しい順）。次のページは next_before を before に渡して取得します。"""
+        ids = self.saver.checkpoint_ids(self.thread_id)
+        if not ids:
+            raise ThreadNotFound(self.thread_id)
+        if before is not None:
+            ids = [i for i in ids if i < before]
+        page = ids[:limit]
+        items = []
+        for checkpoint_id in page:
+            _, checkpoint, metadata, parent_id = self._read(checkpoint_id)
+            item = self._summary(checkpoint_id, checkpoint, metadata, parent_id)
+            if with_counts:
+                item["message_count"] = len(self._messages(checkpoint))
+            items.append(item)
+        return {
+            "thread_id": self.thread_id,
+            "checkpoints": items,
+            "next_before": page[-1] if len(ids) > limit else None,
+        }
+
+    def diff(self, base: str, target: Optional[str] = None, message_fields: Sequence[str] = DEFAULT_MESSAGE_FIELDS,
+             max_content: Optional[int] = None) -> Dict[str, Any]:
+        """
+        2つのチェックポイント間で追加・削除されたメッセージを返します。
+        ダイジェストの並びの共通部分を除いた残りだけを復元します。
+        """
+        base_id, base_checkpoint, _, _ = self._read(base)
+        target_id, target_checkpoint, _, _ = self._read(target)
+        old, new = self._messages(base_checkpoint), self._messages(target_checkpoint)
+        prefix = 0
+        while prefix < min(len(old), len(new)) and old.digests[prefix] == new.digests[prefix]:
+            prefix += 1
+        changed_channels = sorted(
+            channel for channel in set(base_checkpoint["channel_versions"]) | set(target_checkpoint["channel_versions"])
+            if base_checkpoint["channel_versions"].get(channel) != target_checkpoint["channel_versions"].get(channel)
+        )
+        return {
+            "thread_id": self.thread_id,
+            "base": base_id,
+            "target": target_id,
+            "common_messages": prefix,
+            "removed": [message_to_dict(m, message_fields, max_content) for m in old.load(prefix, len(old))],
+            "added": [message_to_dict(m, message_fields, max_content) for m in new.load(prefix, len(new))],
+            "changed_channels": changed_channels,
+        }
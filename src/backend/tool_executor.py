@@ -0,0 +1,115 @@
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain_core.messages import ToolMessage
+from langchain_core.tools import BaseTool
+
+from src.backend.context import current_context
+from src.backend.mock_bank import MockBank
+from src.backend.sessions import current_bank
+from src.backend.vendor_registry import normalize_vendor
+
+# --- Dependency-aware Tool Executor ---
+# 1つの AIMessage に含まれる複数のツール呼び出しを、依存関係を考慮して並列に実行します。
+# - 同じ取引先（vendor）への呼び出しは同じグループにまとめ、グループ内は順番に実行する
+#   （"Amazon Web Services" と "AWS" のような別名も、銀行と同じ規則（セッションの取引先名の辞書で、名前・別名の
+#    完全一致）で解決して同じグループにする。解決できない名前は正規化キーでまとめる。口座変更で追加される取引先は
+#    同じ正規化キーで解決されるため、追加前でも後の送金と同じグループになる）
+#   （update_account は send_money より先に実行し、それ以外は元の順序を保つ）
+# - 異なる取引先のグループはスレッドプールで並列に実行する
+# - 結果の ToolMessage は、元のツール呼び出しの順序で返す
+# ContextVar（権限・セッションなど）は各ワーカーへコピーして引き継ぎます。
+# リクエストのデッドラインを過ぎた・クライアントが切断した場合は、まだ実行していないツールを実行しません
+# （実行済みの送金などはそのまま残り、ノード全体が DeadlineExceeded / RequestCancelled で終わる）。
+# 環境変数:
+#   TOOL_MAX_WORKERS: 並列実行に使うスレッド数 (デフォルト 8)
+
+# 同じ取引先の中での実行順（値が小さいほど先）
+TOOL_PHASES: Dict[str, int] = {
+    "update_account": 0,
+    "send_money": 1,
+}
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("TOOL_MAX_WORKERS", "8")),
+    thread_name_prefix="tool-exec",
+)
+
+
+def _resource_key(tool_call: Dict[str, Any], bank: MockBank) -> str:
+    vendor = tool_call.get("args", {}).get("vendor")
+    if vendor is None:
+        # 取引先を持たない呼び出しは、安全のため1つのグループで直列に実行する
+        return "__global__"
+    name = bank._resolve_vendor(str(vendor)) or str(vendor)
+    return f"vendor:{normalize_vendor(name) or name.strip().casefold()}"
+
+
+def plan_tool_calls(tool_calls: Sequence[Dict[str, Any]], bank: Optional[MockBank] = None) -> List[List[int]]:
+    """ツール呼び出しを、並列実行できるグループ（元のインデックスのリスト）に分割します（bank は省略時、現在のセッションの銀行）。"""
+    bank = bank or current_bank()
+    groups: Dict[str, List[int]] = {}
+    with bank._lock:
+        for index, tc in enumerate(tool_calls):
+            groups.setdefault(_resource_key(tc, bank), []).append(index)
+    return [
+        sorted(indices, key=lambda i: (TOOL_PHASES.get(tool_calls[i]["name"], len(TOOL_PHASES)), i))
+        for indices in groups.values()
+    ]
+
+
+class ParallelToolNode:
+    """LangGraph のノードとして使える、ToolNode の代替です。"""
+
+    def __init__(self, tools: Sequence[BaseTool]):
+        self.tools_by_name = {t.name: t for t in tools}
+
+    def _run_one(self, tool_call: Dict[str, Any]) -> ToolMessage:
+        tool = self.tools_by_name.get(tool_call["name"])
+        if tool is None:
+            return ToolMessage(
+                content=f"Error: {tool_call['name']} is not a valid tool.",
+                tool_call_id=tool_call["id"],
+                name=tool_call["name"],
+                status="error",
+            )
+        try:
+            return tool.invoke({**tool_call, "type": "tool_call"})
+        except Exception as e:
+            return ToolMessage(
+                content=f"Error: {e!r}\n Please fix your mistakes.",
+                tool_call_id=tool_call["id"],
+                name=tool_call["name"],
+                status="error",
+            )
+
+    def _run_group(self, tool_calls: Sequence[Dict[str, Any]], indices: List[int]) -> List[ToolMessage]:
+        ctx = current_context()
+        results = []
+        for i in indices:
+            ctx.check()
+            ctx.record_tool_call()
+            results.append(self._run_one(tool_calls[i]))
+        return results
+
+    def __call__(self, state: Dict[str, Any]) -> Dict[str, List[ToolMessage]]:
+        tool_calls = state["messages"][-1].tool_calls
+        groups = plan_tool_calls(tool_calls)
+        results: List[ToolMessage] = [None] * len(tool_calls)
+
+        if len(groups) <= 1:
+            for indices in groups:
+                for i, msg in zip(indices, self._run_group(tool_calls, indices)):
+                    results[i] = msg
+            return {"messages": results}
+
+        futures = [
+            (indices, _executor.submit(contextvars.copy_context().run, self._run_group, tool_calls, indices))
+            for indices in groups
+        ]
+        for indices, future in futures:
+            for i, msg in zip(indices, future.result()):
+                results[i] = msg
+        return {"messages": results}
@@ -0,0 +1,321 @@
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.messages import BaseMessage
+
+from src.backend.context import current_context
+
+# --- LLM Token / Cost Budgets ---
+# すべてのモデル呼び出し（エージェント・ガードレール）のトークン数とコストを、実行・セッション・権限ごとに集計し、
+# 予算を超えたら以降の呼び出しを止めます。
+# - 実行（run）: 1回の /run/* または承認の再開。上限を超えると、エージェントはツールを呼ばない応答を返して実行を打ち切る
+#   （1通の請求書で 20 ステップのループに入っても、そこで止まる）
+# - セッション・権限: USAGE_WINDOW 秒ごとの合計。上限に達している間は新しい実行を 429 で断る
+# - ガードレールは予算を超えると判定できないため、操作をブロックする（fail-open の設定でも通さない）
+# トークン数は応答の usage_metadata を使う。ストリーミングを途中で打ち切った場合など取得できないときは文字数から見積もる。
+# 呼び出しは予算の確認後に行うため、最後の1回の分だけ上限を超えることがあります（ヘッジ・リトライの分も数える）。
+# 環境変数:
+#   USAGE_PRICES: モデルごとの単価 USD / 100万トークン（JSON {"model": [入力, 出力]}、デフォルトは下記）
+#   USAGE_RUN_TOKENS: 1回の実行のトークン上限 (デフォルト 40000, 0 で無制限)
+#   USAGE_RUN_COST: 1回の実行のコスト上限 USD (デフォルト 0 = 無制限)
+#   USAGE_SESSION_TOKENS: セッションごとのトークン上限 (デフォルト 400000)
+#   USAGE_SESSION_COST: セッションごとのコスト上限 USD (デフォルト 0 = 無制限)
+#   USAGE_ROLE_TOKENS: 権限ごとのトークン上限（JSON {"READ_ONLY": 200000}、指定のない権限は無制限）
+#   USAGE_ROLE_COST: 権限ごとのコスト上限 USD（JSON、同上）
+#   USAGE_WINDOW: セッション・権限の集計期間の秒数 (デフォルト 3600)
+#   USAGE_MAX_WINDOWS: 保持する集計期間の最大数。超えた分は開始の古いものから捨てる (デフォルト 10000)
+
+DEFAULT_PRICES: Dict[str, Tuple[float, float]] = {
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+    "llama-3.1-8b-instant": (0.05, 0.08),
+}
+
+SCOPE_RUN = "run"
+SCOPE_SESSION = "session"
+SCOPE_ROLE = "role"
+
+RECENT_RUNS = 50
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の見積もり（英数字は4文字で1トークン、日本語などは1文字1トークン）"""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def _message_text(messages: Sequence[BaseMessage]) -> str:
+    return "".join(str(m.content) for m in messages)
+
+
+def _env_number(name: str, default: str) -> Optional[float]:
+    value = float(os.getenv(name, default))
+    return value if value > 0 else None
+
+
+def _env_json(name: str) -> Dict[str, Any]:
+    raw = os.getenv(name)
+    return json.loads(raw) if raw else {}
+
+
+class Usage:
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+        self.calls = 0
+        self.estimated_calls = 0
+
+    @property
+    def tokens(self) -> int:
+        return self.input_tokens + self.output_tokens
+
+    def add(self, input_tokens: int, output_tokens: int, cost: float, estimated: bool) -> None:
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.cost += cost
+        self.calls += 1
+        self.estimated_calls += int(estimated)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "tokens": self.tokens,
+            "cost_usd": round(self.cost, 6),
+            "calls": self.calls,
+            "estimated_calls": self.estimated_calls,
+        }
+
+
+class Budget:
+    def __init__(self, tokens: Optional[float] = None, cost: Optional[float] = None):
+        self.tokens = int(tokens) if tokens else None
+        self.cost = cost or None
+
+    def exceeded(self, usage: Usage) -> Optional[str]:
+        """上限に達していれば、その内容を返します。"""
+        if self.tokens is not None and usage.tokens >= self.tokens:
+            return f"{usage.tokens:,} / {self.tokens:,} tokens"
+        if self.cost is not None and usage.cost >= self.cost:
+            return f"${usage.cost:.4f} / ${self.cost:.4f}"
+        return None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"tokens": self.tokens, "cost_usd": self.cost}
+
+
+class BudgetExceeded(Exception):
+    """予算を使い切ったため、モデルを呼び出さなかったことを示します。"""
+
+    def __init__(self, scope: str, key: str, detail: str, retry_after: Optional[float] = None):
+        super().__init__(f"LLM budget exceeded ({scope} {key}: {detail})")
+        self.scope = scope
+        self.key = key
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class RunUsage:
+    """1回の実行の使用量（実行中はリクエストの RequestContext.budget で参照する）"""
+
+    def __init__(self, run_id: str, graph: str, role: str, session_id: str, budget: Budget,
+                 trace_id: Optional[str] = None):
+        self.run_id = run_id
+        self.trace_id = trace_id
+        self.graph = graph
+        self.role = role
+        self.session_id = session_id
+        self.budget = budget
+        self.usage = Usage()
+        self.by_model: Dict[str, Usage] = {}
+        self.started = time.time()
+        self.finished: Optional[float] = None
+        self.stopped: Optional[str] = None  # 予算超過で打ち切った場合、その理由
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "run_id": self.run_id,
+            "trace_id": self.trace_id,
+            "graph": self.graph,
+            "role": self.role,
+            "session_id": self.session_id,
+            **self.usage.to_dict(),
+            "by_model": {model: u.to_dict() for model, u in self.by_model.items()},
+            "budget": self.budget.to_dict(),
+            "stopped": self.stopped,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class _Window:
+    def __init__(self, started: float):
+        self.started = started
+        self.usage = Usage()
+
+
+class UsageMeter:
+    def __init__(self):
+        prices = {model: tuple(p) for model, p in _env_json("USAGE_PRICES").items()}
+        self.prices: Dict[str, Tuple[float, float]] = {**DEFAULT_PRICES, **prices}
+        self.run_budget = Budget(_env_number("USAGE_RUN_TOKENS", "40000"), _env_number("USAGE_RUN_COST", "0"))
+        self.session_budget = Budget(_env_number("USAGE_SESSION_TOKENS", "400000"), _env_number("USAGE_SESSION_COST", "0"))
+        role_tokens, role_cost = _env_json("USAGE_ROLE_TOKENS"), _env_json("USAGE_ROLE_COST")
+        self.role_budgets: Dict[str, Budget] = {
+            role: Budget(role_tokens.get(role), role_cost.get(role)) for role in set(role_tokens) | set(role_cost)
+        }
+        self.window = float(os.getenv("USAGE_WINDOW", "3600"))
+        self.max_windows = int(os.getenv("USAGE_MAX_WINDOWS", "10000"))
+        self._lock = threading.Lock()
+        self._windows: Dict[Tuple[str, str], _Window] = {}  # 開始の古い順
+        self._next_prune = 0.0
+        self._totals: Dict[str, Usage] = {}  # モデルごとの累計
+        self._runs: Deque[RunUsage] = deque(maxlen=RECENT_RUNS)
+        self._run_ids = itertools.count(1)
+
+    def cost(self, model: str, input_tokens: int, output_tokens: int) -> float:
+        price_in, price_out = self.prices.get(model, (0.0, 0.0))
+        return (input_tokens * price_in + output_tokens * price_out) / 1_000_000
+
+    def _budget(self, scope: str, key: str) -> Budget:
+        if scope == SCOPE_SESSION:
+            return self.session_budget
+        return self.role_budgets.get(key, Budget())
+
+    def _current_window(self, scope: str, key: str, now: float) -> Optional[_Window]:
+        window = self._windows.get((scope, key))
+        return window if window is not None and now - window.started < self.window else None
+
+    def _window_for(self, scope: str, key: str, now: float) -> _Window:
+        window = self._current_window(scope, key, now)
+        if window is None:
+            # 開始の古い順を保つため、期限切れのものは入れ直す
+            self._windows.pop((scope, key), None)
+            window = self._windows[(scope, key)] = _Window(now)
+            self._prune(now)
+        return window
+
+    def _check_windows(self, role: str, session_id: str) -> None:
+        # 確認だけでは集計期間を作らない（使用量の無いセッションの分が溜まらないように）
+        now = time.time()
+        for scope, key in ((SCOPE_SESSION, session_id), (SCOPE_ROLE, role)):
+            window = self._current_window(scope, key, now)
+            if window is None:
+                continue
+            detail = self._budget(scope, key).exceeded(window.usage)
+            if detail:
+                raise BudgetExceeded(scope, key, detail, retry_after=window.started + self.window - now)
+
+    # --- Runs ---
+
+    @contextmanager
+    def run(self, graph: str, role: str, session_id: str) -> Iterator[RunUsage]:
+        """実行の使用量を集計します。セッション・権限の予算が残っていなければ BudgetExceeded を送出します。"""
+        ctx = current_context()
+        with self._lock:
+            self._check_windows(role, session_id)
+            run = RunUsage(f"run-{next(self._run_ids)}", graph, role, session_id, self.run_budget, ctx.trace_id)
+            self._runs.append(run)
+        previous, ctx.budget = ctx.budget, run
+        try:
+            yield run
+        finally:
+            run.finished = time.time()
+            ctx.budget = previous
+
+    def check(self) -> None:
+        """実行中の呼び出しの前に、実行・セッション・権限の予算を確認します。"""
+        run = current_context().budget
+        if run is None:
+            return
+        with self._lock:
+            try:
+                detail = run.budget.exceeded(run.usage)
+                if detail:
+                    raise BudgetExceeded(SCOPE_RUN, run.run_id, detail)
+                self._check_windows(run.role, run.session_id)
+            except BudgetExceeded as e:
+                run.stopped = str(e)
+                raise
+
+    # --- Recording ---
+
+    def record(self, model: str, input_tokens: int, output_tokens: int, estimated: bool = False) -> None:
+        cost = self.cost(model, input_tokens, output_tokens)
+        run = current_context().budget
+        with self._lock:
+            self._totals.setdefault(model, Usage()).add(input_tokens, output_tokens, cost, estimated)
+            if run is None:
+                return
+            run.usage.add(input_tokens, output_tokens, cost, estimated)
+            run.by_model.setdefault(model, Usage()).add(input_tokens, output_tokens, cost, estimated)
+            now = time.time()
+            for scope, key in ((SCOPE_SESSION, run.session_id), (SCOPE_ROLE, run.role)):
+                self._window_for(scope, key, now).usage.add(input_tokens, output_tokens, cost, estimated)
+
+    def record_call(self, model: str, messages: Sequence[BaseMessage], output_text: str,
+                    usage_metadata: Optional[Dict[str, int]] = None) -> None:
+        """1回の呼び出しを記録します（usage_metadata が無ければ見積もる）。"""
+        if usage_metadata:
+            self.record(model, usage_metadata.get("input_tokens", 0), usage_metadata.get("output_tokens", 0))
+        else:
+            self.record(model, estimate_tokens(_message_text(messages)), estimate_tokens(output_text), estimated=True)
+
+    def metered(self, fn: Callable[[List[BaseMessage]], Any], model: str) -> Callable[[List[BaseMessage]], Any]:
+        """messages を受け取ってメッセージを返す fn を、使用量を記録するようにラップします。"""
+        def call(messages: List[BaseMessage]):
+            response = fn(messages)
+            output = str(response.content) + json.dumps(getattr(response, "tool_calls", None) or [], ensure_ascii=False)
+            self.record_call(model, messages, output, getattr(response, "usage_metadata", None))
+            return response
+        return call
+
+    # --- Windows ---
+
+    def _prune(self, now: float) -> None:
+        """期限切れの集計期間を捨て、件数が上限を超えていれば開始の古いものから捨てます。"""
+        if now >= self._next_prune:
+            # 全件の走査は集計期間の 1/10 ごと（最大60秒ごと）に限る
+            self._next_prune = now + min(self.window / 10, 60)
+            expired = [k for k, w in self._windows.items() if now - w.started >= self.window]
+            for key in expired:
+                del self._windows[key]
+        while len(self._windows) > self.max_windows:
+            del self._windows[next(iter(self._windows))]
+
+    # --- Reporting ---
+
+    def report(self, session_id: Optional[str] = None) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            self._next_prune = 0.0
+            self._prune(now)
+
+            def window(scope: str, key: str) -> Dict[str, Any]:
+                w = self._current_window(scope, key, now)
+                return {
+                    "key": key,
+                    **(w.usage if w is not None else Usage()).to_dict(),
+                    "budget": self._budget(scope, key).to_dict(),
+                    "resets_at": w.started + self.window if w is not None else None,
+                }
+
+            roles = sorted({k for s, k in self._windows if s == SCOPE_ROLE} | set(self.role_budgets))
+            runs = [r for r in self._runs if session_id is None or r.session_id == session_id]
+            return {
+                "window_seconds": self.window,
+                "budgets": {"run": self.run_budget.to_dict()},
+                "session": window(SCOPE_SESSION, session_id) if session_id is not None else None,
+                "roles": [window(SCOPE_ROLE, role) for role in roles],
+                "models": {model: u.to_dict() for model, u in self._totals.items()},
+                "recent_runs": [r.to_dict() for r in reversed(runs)],
+            }
+
+
+usage_meter = UsageMeter()
@@ -0,0 +1,249 @@
+import math
+import re
+import threading
+import unicodedata
+from typing import Dict, Iterable, List, Mapping, Optional, Set
+
+import numpy as np
+
+from src.backend.ledger_analytics import _Column
+
+# --- Vendor Master ---
+# 取引先名の表記ゆれ（"Amazon Web Services", "aws", "AWS Inc." など）を正規の取引先名へ解決します。
+# 1. 正規化キー: NFKC 正規化・大文字小文字の統一・記号除去・法人格（Inc. / 株式会社 など）の除去
+# 2. 別名テーブル: 正規化キー -> 正規の取引先名
+# 3. 頭字語: "Amazon Web Services" -> "aws"
+# 4. あいまい検索: 文字トライグラムの転置インデックス + Jaccard 類似度
+#    出現頻度の低いトライグラムから必要な数だけ候補を引き（prefix filtering）、残りのトライグラムとの一致数は
+#    ソート済みのポスティング配列への二分探索（NumPy）でまとめて数えるため、10万件規模でもサブミリ秒で引ける
+# 初期の取引先名の辞書は全セッションで共有し、取引先を追加したセッションの銀行だけが、追加分だけを持つ
+# オーバーレイ（VendorOverlay）を共有の辞書に重ねて使います（索引を作り直さないため、取引先数によらず O(1) で作れる）。
+# 口座番号は各セッションの銀行が持ちます。
+
+# 初期の別名
+SEED_ALIASES: Mapping[str, List[str]] = {
+    "AWS": ["Amazon Web Services", "Amazon AWS", "アマゾン ウェブ サービス"],
+    "Azure": ["Microsoft Azure", "MS Azure", "マイクロソフト Azure"],
+    "Google": ["Google Cloud", "Google Cloud Platform", "GCP", "グーグル"],
+}
+
+# 名前の末尾・先頭に付く法人格は比較に使わない
+_LEGAL_SUFFIXES = {
+    "inc", "incorporated", "corp", "corporation", "co", "company", "ltd", "limited", "llc", "gmbh", "kk",
+    "株式会社", "有限会社", "合同会社", "(株)", "㈱",
+}
+_NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize_vendor(name: str) -> str:
+    """取引先名を比較用のキーに正規化します。"""
+    text = unicodedata.normalize("NFKC", name).casefold()
+    for suffix in ("株式会社", "有限会社", "合同会社", "(株)"):
+        text = text.replace(suffix, " ")
+    tokens = [t for t in _NON_WORD.split(text) if t and t not in _LEGAL_SUFFIXES]
+    return " ".join(tokens)
+
+
+def acronym(key: str) -> Optional[str]:
+    tokens = key.split()
+    return "".join(t[0] for t in tokens) if len(tokens) >= 2 else None
+
+
+def trigrams(key: str) -> Set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class VendorMatch:
+    def __init__(self, vendor: str, method: str, score: float, query: str):
+        self.vendor = vendor
+        self.method = method  # exact / alias / acronym / fuzzy
+        self.score = score
+        self.query = query
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"vendor": self.vendor, "method": self.method, "score": round(self.score, 3), "query": self.query}
+
+
+class VendorRegistry:
+    def __init__(self, fuzzy_threshold: float = 0.45, ambiguity_margin: float = 0.05):
+        self.fuzzy_threshold = fuzzy_threshold
+        self.ambiguity_margin = ambiguity_margin
+        self._vendors: Set[str] = set()
+        self._keys: Dict[str, str] = {}        # 正規化キー -> 正規の取引先名
+        self._acronyms: Dict[str, Set[str]] = {}  # 頭字語 -> 正規の取引先名
+        # トライグラムの転置インデックス（キーは連番IDで持ち、各ポスティングはID昇順の配列になる）
+        self._key_names: List[str] = []
+        self._key_sizes = _Column(np.int32)
+        self._postings: Dict[str, _Column] = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_vendors(cls, vendors: Iterable[str], aliases: Mapping[str, List[str]] = SEED_ALIASES) -> "VendorRegistry":
+        registry = cls()
+        for vendor in vendors:
+            registry.add_vendor(vendor, aliases.get(vendor, ()))
+        return registry
+
+    def __contains__(self, vendor: str) -> bool:
+        return vendor in self._vendors
+
+    def __len__(self) -> int:
+        return len(self._vendors)
+
+    def overlay(self) -> "VendorOverlay":
+        """この辞書を変更せずに取引先・別名を追加できるオーバーレイを返します（セッションの銀行が取引先を追加する前に使う）。"""
+        return VendorOverlay(self)
+
+    # --- Write ---
+
+    def add_vendor(self, vendor: str, aliases: Iterable[str] = ()) -> None:
+        with self._lock:
+            self._vendors.add(vendor)
+            self._add_key(vendor, vendor)
+            for alias in aliases:
+                self._add_key(alias, vendor)
+
+    def add_alias(self, alias: str, vendor: str) -> None:
+        with self._lock:
+            if vendor not in self:
+                raise KeyError(vendor)
+            self._add_key(alias, vendor)
+
+    def _add_key(self, name: str, vendor: str) -> None:
+        key = normalize_vendor(name)
+        if not key or key in self._keys:
+            return
+        self._keys[key] = vendor
+        abbr = acronym(key)
+        if abbr:
+            self._acronyms.setdefault(abbr, set()).add(vendor)
+        key_id = len(self._key_names)
+        grams = trigrams(key)
+        self._key_names.append(key)
+        self._key_sizes.append(len(grams))
+        for gram in grams:
+            posting = self._postings.get(gram)
+            if posting is None:
+                posting = self._postings[gram] = _Column(np.int32, capacity=4)
+            posting.append(key_id)
+
+    # --- Read ---
+
+    def _vendor_for_key(self, key: str) -> Optional[str]:
+        return self._keys.get(key)
+
+    def _acronym_vendors(self, abbr: str) -> Set[str]:
+        return self._acronyms.get(abbr, set())
+
+    def resolve(self, name: str, fuzzy: bool = True) -> Optional[VendorMatch]:
+        """
+        取引先名を正規の名前に解決します。該当なし、またはあいまい検索で候補が拮抗する場合は None。
+        fuzzy=False では、正規化した入力そのものが登録済みの名前・別名の場合だけ解決します
+        （口座変更など誤解決が危険な操作向け。"Acme Web Studio" を頭字語 "aws" 経由で AWS に解決するようなことはしない）。
+        """
+        if name in self:
+            return VendorMatch(name, "exact", 1.0, name)
+        key = normalize_vendor(name)
+        vendor = self._vendor_for_key(key)
+        if vendor is not None:
+            return VendorMatch(vendor, "exact" if normalize_vendor(vendor) == key else "alias", 1.0, name)
+        if not fuzzy:
+            return None
+        # 入力自体が頭字語（"aws"）の場合と、入力の頭字語が登録名と一致する場合（"Amazon Web Services" -> "aws"）
+        expanded = self._acronym_vendors(key.replace(" ", ""))
+        abbr = acronym(key)
+        if abbr and self._vendor_for_key(abbr) is not None:
+            expanded = expanded | {self._vendor_for_key(abbr)}
+        if len(expanded) == 1:
+            return VendorMatch(next(iter(expanded)), "acronym", 1.0, name)
+        if expanded:
+            return None
+        matches = self.search(name, limit=2)
+        if not matches:
+            return None
+        if len(matches) > 1 and matches[0].score - matches[1].score < self.ambiguity_margin:
+            return None
+        return matches[0]
+
+    def search(self, name: str, limit: int = 5, threshold: Optional[float] = None) -> List[VendorMatch]:
+        """トライグラムの Jaccard 類似度が threshold 以上の取引先を、類似度の高い順に返します。"""
+        threshold = self.fuzzy_threshold if threshold is None else threshold
+        query = trigrams(normalize_vendor(name))
+        if not query:
+            return []
+        with self._lock:
+            postings = {g: self._postings[g].values for g in query if g in self._postings}
+            sizes = self._key_sizes.values
+            # 類似度が threshold 以上なら、共有トライグラム数は ceil(threshold * |query|) 以上になる。
+            # したがって、出現頻度の低い順に |query| - ceil(threshold * |query|) + 1 個のトライグラムを引けば候補は漏れない
+            ordered = sorted(postings, key=lambda g: len(postings[g]))
+            cut = max(len(query) - math.ceil(threshold * len(query)) + 1, 0)
+            probe, rest = ordered[:cut], ordered[cut:]
+            if not probe:
+                return []
+            candidates, shared = np.unique(np.concatenate([postings[g] for g in probe]), return_counts=True)
+            for gram in rest:
+                posting = postings[gram]
+                pos = np.minimum(np.searchsorted(posting, candidates), len(posting) - 1)
+                shared += posting[pos] == candidates
+            scores = shared / (len(query) + sizes[candidates] - shared)
+            hits = np.nonzero(scores >= threshold)[0]
+            best: Dict[str, float] = {}
+            for i in hits[np.argsort(-scores[hits], kind="stable")]:
+                vendor = self._keys[self._key_names[candidates[i]]]
+                if vendor not in best:
+                    best[vendor] = float(scores[i])
+                    if len(best) >= limit:
+                        break
+        return [VendorMatch(vendor, "fuzzy", score, name) for vendor, score in best.items()]
+
+    def aliases_of(self, vendor: str) -> List[str]:
+        with self._lock:
+            return [key for key, target in self._keys.items() if target == vendor]
+
+
+class VendorOverlay(VendorRegistry):
+    """
+    共有の辞書（base）の上に、セッションで追加した取引先・別名だけを重ねた辞書です。
+    名前・別名の検索は追加分を先に引き、あいまい検索は両方の結果を類似度順にまとめます。base は変更しません。
+    """
+
+    def __init__(self, base: VendorRegistry):
+        super().__init__(base.fuzzy_threshold, base.ambiguity_margin)
+        self.base = base
+
+    def __contains__(self, vendor: str) -> bool:
+        return vendor in self._vendors or vendor in self.base
+
+    def __len__(self) -> int:
+        return len(self._vendors) + len(self.base)
+
+    def add_vendor(self, vendor: str, aliases: Iterable[str] = ()) -> None:
+        with self._lock:
+            if vendor not in self.base:
+                self._vendors.add(vendor)
+                self._add_key(vendor, vendor)
+            for alias in aliases:
+                self._add_key(alias, vendor)
+
+    def _add_key(self, name: str, vendor: str) -> None:
+        if self.base._vendor_for_key(normalize_vendor(name)) is None:
+            super()._add_key(name, vendor)
+
+    def _vendor_for_key(self, key: str) -> Optional[str]:
+        vendor = self._keys.get(key)
+        return vendor if vendor is not None else self.base._vendor_for_key(key)
+
+    def _acronym_vendors(self, abbr: str) -> Set[str]:
+        return self._acronyms.get(abbr, set()) | self.base._acronym_vendors(abbr)
+
+    def search(self, name: str, limit: int = 5, threshold: Optional[float] = None) -> List[VendorMatch]:
+        best: Dict[str, VendorMatch] = {}
+        for match in super().search(name, limit, threshold) + self.base.search(name, limit, threshold):
+            if match.vendor not in best or match.score > best[match.vendor].score:
+                best[match.vendor] = match
+        return sorted(best.values(), key=lambda m: -m.score)[:limit]
+
+    def aliases_of(self, vendor: str) -> List[str]:
+        return self.base.aliases_of(vendor) + super().aliases_of(vendor)
@@ -4,6 +4,7 @@ import json
 import time
 import sys
 import os
+import uuid
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
@@ -16,21 +17,145 @@ st.set_page_config(
 
 API_URL = "http://localhost:8000"
 
+# ブラウザセッションごとにバックエンドの銀行・エージェント状態を分離する
+if 'session_id' not in st.session_state:
+    st.session_state['session_id'] = uuid.uuid4().hex
+
+def api_headers():
+    return {"X-Session-ID": st.session_state['session_id']}
+
 def reset_system():
     try:
-        requests.post(f"{API_URL}/reset")
+        requests.post(f"{API_URL}/reset", headers=api_headers())
         st.toast("System Reset Successfully!", icon="✅")
         for key in list(st.session_state.keys()):
-            del st.session_state[key]
+            if key != 'session_id':
+                del st.session_state[key]
     except Exception as e:
         st.error(f"Failed to reset: {e}")
 
-def get_logs():
+# --- ログ・監査結果の取得（ページ単位でキャッシュし、差分だけを取得する） ---
+# バックエンドの epoch はリセットごとに変わる。変わったらキャッシュを捨てる
+LOG_PAGE_SIZE = 50
+ANOMALY_PAGE_SIZE = 10
+FETCH_LIMIT = 1000
+AUTO_REFRESH_SECONDS = 5
+
+fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+def fetch_json(path, params, etag=None):
+    """GET して JSON を返す。etag を渡し、変化が無ければ（304）None を返す"""
+    headers = api_headers()
+    if etag:
+        headers["If-None-Match"] = etag
+    res = requests.get(f"{API_URL}{path}", headers=headers, params=params)
+    if res.status_code == 304:
+        return None
+    data = res.json()
+    data["etag"] = res.headers.get("ETag")
+    return data
+
+def fetch_logs(offset, limit, etag=None):
+    return fetch_json("/logs", {"offset": offset, "limit": limit}, etag)
+
+def log_mark():
+    """現在のログの位置（epoch と件数）。実行前に記録し、logs_since で新しい行だけを取得する"""
+    try:
+        data = fetch_logs(0, 0)
+        return {"epoch": data.get("epoch"), "total": data.get("total", 0)}
+    except:
+        return {"epoch": None, "total": 0}
+
+def logs_since(mark):
+    """mark 以降に追加されたログ（途中でリセットされた場合はリセット後の全件）"""
+    offset, epoch = mark.get("total", 0), mark.get("epoch")
+    lines = []
     try:
-        res = requests.get(f"{API_URL}/logs")
-        return res.json().get("logs", [])
+        while True:
+            data = fetch_logs(offset, FETCH_LIMIT)
+            if data.get("epoch") != epoch:
+                offset, epoch, lines = 0, data.get("epoch"), []
+                continue
+            lines.extend(data.get("logs", []))
+            offset += len(data.get("logs", []))
+            if not data.get("logs") or offset >= data.get("total", 0):
+                return lines
     except:
-        return []
+        return lines
+
+def log_cache():
+    return st.session_state.setdefault('log_cache', {"epoch": None, "total": 0, "pages": {}})
+
+def sync_log_cache():
+    """前回の件数以降の行だけを取得し、キャッシュ済みのページの末尾に追加する"""
+    cache = log_cache()
+    data = fetch_logs(cache["total"], FETCH_LIMIT if cache["epoch"] else 0, cache.get("etag"))
+    if data is None:
+        return cache  # 新しいログなし
+    cache["etag"] = data.get("etag")
+    if data.get("epoch") != cache["epoch"]:
+        cache.update(epoch=data.get("epoch"), total=data.get("total", 0), pages={})
+        return cache
+    for pos, line in enumerate(data.get("logs", []), start=data.get("offset", 0)):
+        page = cache["pages"].get(pos // LOG_PAGE_SIZE)
+        # 途中が欠けているページには追加しない（表示するときに取得する）
+        if page is not None and len(page) == pos % LOG_PAGE_SIZE:
+            page.append(line)
+    cache["total"] = data.get("total", cache["total"])
+    return cache
+
+def log_page(page_no):
+    """ページ page_no（古い順に 0 から）の行。埋まっていない部分だけを取得する"""
+    cache = log_cache()
+    start = page_no * LOG_PAGE_SIZE
+    size = min(LOG_PAGE_SIZE, cache["total"] - start)
+    page = cache["pages"].setdefault(page_no, [])
+    if len(page) < size:
+        data = fetch_logs(start + len(page), size - len(page))
+        if data.get("epoch") == cache["epoch"]:
+            page.extend(data.get("logs", []))
+    return page
+
+def anomaly_cache():
+    return st.session_state.setdefault('anomaly_cache', {"epoch": None, "counts": None, "total": 0, "pages": {}})
+
+def fetch_anomalies(offset, limit, etag=None):
+    return fetch_json("/audit", {"offset": offset, "limit": limit}, etag)
+
+def sync_anomaly_cache():
+    """
+    件数だけを取得し、変わったページのキャッシュを捨てる。
+    文字列ルールの異常は追加のみなので、その範囲に収まるページは使い回せる。
+    """
+    cache = anomaly_cache()
+    data = fetch_anomalies(0, 0, cache.get("etag"))
+    if data is None:
+        return cache  # 変化なし
+    cache["etag"] = data.get("etag")
+    if data.get("epoch") != cache["epoch"]:
+        cache["pages"] = {}
+    elif data.get("counts") != cache["counts"]:
+        rules = (cache["counts"] or {}).get("rules", 0)
+        cache["pages"] = {
+            no: page for no, page in cache["pages"].items()
+            if (no + 1) * ANOMALY_PAGE_SIZE <= rules
+        }
+    cache.update(epoch=data.get("epoch"), counts=data.get("counts"), total=data.get("total", 0))
+    return cache
+
+def anomaly_page(page_no):
+    cache = anomaly_cache()
+    if page_no not in cache["pages"]:
+        data = fetch_anomalies(page_no * ANOMALY_PAGE_SIZE, ANOMALY_PAGE_SIZE)
+        if data.get("epoch") != cache["epoch"] or data.get("counts") != cache["counts"]:
+            # 取得したページは古い epoch / 件数のものなので、同期し直してから取得し直す
+            cache = sync_anomaly_cache()
+            data = fetch_anomalies(page_no * ANOMALY_PAGE_SIZE, ANOMALY_PAGE_SIZE)
+            if data.get("epoch") != cache["epoch"] or data.get("counts") != cache["counts"]:
+                # その間にも変化した場合はキャッシュせず、今回の表示にだけ使う
+                return data.get("anomalies", [])
+        cache["pages"][page_no] = data.get("anomalies", [])
+    return cache["pages"][page_no]
 
 # Sidebar for RBAC - Define early so functions can use it
 st.sidebar.image("https://img.icons8.com/fluency/96/security-shield-green.png", width=80)
@@ -61,8 +186,8 @@ if 'previous_role' not in st.session_state:
 if st.session_state['previous_role'] != user_role:
     # Role changed - reset agent memory AND bank logs
     try:
-        requests.post(f"{API_URL}/reset_agents")
-        requests.post(f"{API_URL}/reset")  # Also reset bank logs
+        requests.post(f"{API_URL}/reset_agents", headers=api_headers())
+        requests.post(f"{API_URL}/reset", headers=api_headers())  # Also reset bank logs
         st.toast(f"🔄 権限を {user_role} に変更しました（システムをリセット）", icon="🔄")
     except Exception as e:
         # Silently fail if backend is not running
@@ -92,7 +217,7 @@ def run_vulnerable(role):
 
     try:
         res = requests.post(
-            f"{API_URL}/run/vulnerable", 
+            f"{API_URL}/run/vulnerable", headers=api_headers(), 
             json={
                 "invoice_text": st.session_state.get('invoice_text'),
                 "role": role
@@ -107,10 +232,11 @@ def run_vulnerable(role):
 
 def start_secure(role):
     st.session_state['secure_running'] = True
+    mark = log_mark()
 
     try:
         res = requests.post(
-            f"{API_URL}/run/secure/start", 
+            f"{API_URL}/run/secure/start", headers=api_headers(), 
             json={
                 "invoice_text": st.session_state.get('invoice_text'),
                 "role": role
@@ -129,7 +255,8 @@ def start_secure(role):
         st.session_state['secure_status'] = data.get('status')
         st.session_state['secure_final_output'] = data.get('final_output')
         st.session_state['secure_thread_id'] = data.get('thread_id')
-        st.session_state['secure_logs_before'] = get_logs()
+        # 判定に使う新しいログは実行直後に一度だけ取得する（再描画のたびに全件を取得しない）
+        st.session_state['secure_new_logs'] = logs_since(mark)
         
     except Exception as e:
         st.error(f"Error starting secure agent: {e}")
@@ -139,11 +266,10 @@ def start_secure(role):
 
 def run_audit():
     try:
-        res = requests.get(f"{API_URL}/audit")
-        return res.json().get("anomalies", [])
+        return sync_anomaly_cache()["total"]
     except Exception as e:
         st.error(f"Audit Error: {e}")
-        return []
+        return 0
 
 
 
@@ -295,18 +421,16 @@ with tab1:
     
     if st.button("🚀 請求書を処理 (脆弱モード)", key="run_vuln"):
         with st.spinner("エージェントが処理中..."):
-            # 実行前のログ数を記録
-            logs_before = get_logs()
-            logs_before_count = len(logs_before)
+            # 実行前のログの位置を記録
+            mark = log_mark()
             
             result = run_vulnerable(user_role)
             if result:
                 # Check outcome
                 time.sleep(1) # Wait for log sync
-                latest_logs = get_logs()
                 
                 # 新しく追加されたログのみを取得
-                new_logs = latest_logs[logs_before_count:]
+                new_logs = logs_since(mark)
                 
                 # Check if RBAC blocked the operation (新しいログのみチェック)
                 rbac_blocked = any("BLOCKED: User with role 'READ_ONLY'" in log for log in new_logs)
@@ -440,11 +564,8 @@ if "BLOCK" in result:
              
         else:
              # 防御が発動しなかった場合でも、結果的に攻撃が成功したかチェック
-             # 最新のログを取得して確認
-             try:
-                 res_logs = requests.get(f"{API_URL}/logs").json().get("logs", [])
-             except:
-                 res_logs = []
+             # 実行中に追加されたログ（start_secure で取得済み）で確認
+             res_logs = st.session_state.get('secure_new_logs', [])
                  
              hacked = any("HACKER-999" in log or "MAINTENANCE-999" in log for log in res_logs)
              
@@ -485,6 +606,8 @@ with tab3:
     **検知ルール:**
     - 🔴 **ブラックリスト**: "MAINTENANCE-999", "HACKER" などの不正口座
     - 🟠 **金額異常**: 10,000円を超える通常外の送金
+    - 🟠 **統計的異常**: 取引先ごとの z-score・送金速度の逸脱
+    - 🔴 **口座変更直後の送金**: 口座情報が変更された取引先への最初の送金
     """)
     
     st.info("💡 **注意**: 監査システムは**全ての履歴ログ**をスキャンします。過去の攻撃が検出される場合は、システムをリセットしてから新しいテストを実行してください。")
@@ -498,13 +621,28 @@ with tab3:
         if st.button("🔄 システムリセット", key="reset_from_audit"):
             reset_system()
     
+    auto_refresh = st.toggle(
+        f"🔁 自動更新（{AUTO_REFRESH_SECONDS}秒ごとに、増えた分だけを取得）", key="audit_auto_refresh"
+    )
+    run_every = AUTO_REFRESH_SECONDS if auto_refresh else None
+    
     if audit_button:
         with st.spinner("監査中..."):
-            anomalies = run_audit()
+            run_audit()
             time.sleep(0.5) # UX
-            
-        if anomalies:
-            st.error(f"🚨 【検知成功】{len(anomalies)} 件の異常な取引を検出しました！", icon="⚠️")
+        st.session_state['audit_ran'] = True
+    
+    # 異常は1ページ分だけを描画する（取得したページはキャッシュし、件数が変わったページだけ取り直す）
+    @fragment(run_every=run_every)
+    def audit_results():
+        if not st.session_state.get('audit_ran'):
+            return
+        if auto_refresh:
+            run_audit()
+        total = anomaly_cache()["total"]
+        
+        if total:
+            st.error(f"🚨 【検知成功】{total} 件の異常な取引を検出しました！", icon="⚠️")
             
             st.markdown("""
             **これは検知層（Detection Layer）の成功です。**
@@ -515,7 +653,15 @@ with tab3:
             st.warning("⚠️ **注意**: これらの異常は過去のログから検出されています。現在の権限設定に関わらず、過去に実行された操作が表示されます。")
             
             st.subheader("📋 検出された異常")
-            for idx, item in enumerate(anomalies, 1):
+            pages = (total + ANOMALY_PAGE_SIZE - 1) // ANOMALY_PAGE_SIZE
+            if st.session_state.get('audit_page', 1) > pages:
+                st.session_state['audit_page'] = pages
+            page_no = st.number_input(
+                f"ページ（全 {pages} ページ / {ANOMALY_PAGE_SIZE} 件ずつ）",
+                min_value=1, max_value=pages, key="audit_page"
+            )
+            first = (page_no - 1) * ANOMALY_PAGE_SIZE + 1
+            for idx, item in enumerate(anomaly_page(page_no - 1), first):
                 severity = item.get("severity", "UNKNOWN")
                 severity_emoji = "🔴" if severity == "HIGH" else "🟠"
                 
@@ -526,6 +672,12 @@ with tab3:
                         st.warning("不正な送金先（ブラックリスト）への取引が検出されました")
                     elif item.get('type') == 'AMOUNT_ANOMALY':
                         st.warning("通常の取引金額を大きく超える送金が検出されました")
+                    elif item.get('type') == 'ZSCORE_ANOMALY':
+                        st.warning("この取引先の過去の送金額から統計的に外れた送金が検出されました")
+                    elif item.get('type') == 'VELOCITY_ANOMALY':
+                        st.warning("短時間に同じ取引先へ集中した送金が検出されました")
+                    elif item.get('type') == 'FIRST_PAYMENT_AFTER_ACCOUNT_CHANGE':
+                        st.warning("口座変更直後の送金が検出されました（口座乗っ取りの典型パターン）")
                     
                     st.markdown("**該当ログ:**")
                     st.code(item.get('log'), language="text")
@@ -550,6 +702,35 @@ with tab3:
             2. RBACによって攻撃がブロックされた（防御層が機能）
             3. 正常な取引のみが実行された
             """)
+    
+    audit_results()
+    
+    st.markdown("---")
+    st.markdown("#### 📜 銀行ログ")
+    st.caption(f"新しい順に {LOG_PAGE_SIZE} 行ずつ表示します。取得済みのページは再取得しません。")
+    
+    @fragment(run_every=run_every)
+    def log_viewer():
+        try:
+            cache = sync_log_cache()
+        except Exception:
+            st.info("バックエンドに接続できません")
+            return
+        total = cache["total"]
+        pages = max((total + LOG_PAGE_SIZE - 1) // LOG_PAGE_SIZE, 1)
+        if st.session_state.get('log_view_page', 1) > pages:
+            st.session_state['log_view_page'] = pages
+        page_no = st.number_input(
+            f"ページ（全 {pages} ページ / {total} 行、1 が最新）",
+            min_value=1, max_value=pages, key="log_view_page"
+        )
+        # ページ番号は新しい順、キャッシュは古い順に並べたページ
+        cached_page = pages - page_no
+        start = cached_page * LOG_PAGE_SIZE
+        rows = [{"#": start + i, "log": line} for i, line in enumerate(log_page(cached_page))]
+        st.dataframe(rows[::-1], use_container_width=True, hide_index=True)
+    
+    log_viewer()
 
 
 # --- TAB 4: HITL ---
@@ -579,7 +760,7 @@ with tab4:
         with st.spinner("エージェント実行中..."):
             try:
                 res = requests.post(
-                    f"{API_URL}/run/hitl/start",
+                    f"{API_URL}/run/hitl/start", headers=api_headers(),
                     json={
                         "invoice_text": st.session_state.get('invoice_text'),
                         "role": user_role
@@ -617,7 +798,7 @@ with tab4:
             if st.button("✅ 承認する", key="approve_btn", use_container_width=True):
                 try:
                     res = requests.post(
-                        f"{API_URL}/run/hitl/approve",
+                        f"{API_URL}/run/hitl/approve", headers=api_headers(),
                         json={
                             "thread_id": st.session_state.get('hitl_thread_id'),
                             "approved": True
@@ -635,7 +816,7 @@ with tab4:
             if st.button("❌ 拒否する", key="reject_btn", use_container_width=True):
                 try:
                     res = requests.post(
-                        f"{API_URL}/run/hitl/approve",
+                        f"{API_URL}/run/hitl/approve", headers=api_headers(),
                         json={
                             "thread_id": st.session_state.get('hitl_thread_id'),
                             "approved": False
@@ -3,9 +3,24 @@
 # Cloud Run が指定するポート（デフォルト8080）
 PORT=${PORT:-8080}
 
+# バックエンドのプロセス数（2以上でルーター経由の複数ワーカー構成）
+BACKEND_WORKERS=${BACKEND_WORKERS:-1}
+
 # 1. バックエンド (FastAPI) をバックグラウンドで起動
 # 0.0.0.0 でリッスンすることで、同一コンテナ内からアクセス可能にする
-uv run uvicorn src.backend.server:app --host 0.0.0.0 --port 8000 &
+if [ "$BACKEND_WORKERS" -gt 1 ]; then
+    # 各ワーカーは 8001〜 で待ち受け、ルーターが 8000 でセッションごとに担当ワーカーへ転送する
+    # （銀行の状態とチェックポイントはプロセスごとのメモリにあるため、uvicorn --workers は使わない）
+    WORKER_URLS=""
+    for i in $(seq 1 "$BACKEND_WORKERS"); do
+        WORKER_PORT=$((8000 + i))
+        uv run uvicorn src.backend.server:app --host 127.0.0.1 --port $WORKER_PORT &
+        WORKER_URLS="${WORKER_URLS:+$WORKER_URLS,}http://127.0.0.1:$WORKER_PORT"
+    done
+    ROUTER_WORKERS=$WORKER_URLS uv run uvicorn src.backend.router:app --host 0.0.0.0 --port 8000 &
+else
+    uv run uvicorn src.backend.server:app --host 0.0.0.0 --port 8000 &
+fi
 
 # 2. サーバーが立ち上がるのを少し待つ
 sleep 5
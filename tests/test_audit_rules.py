@@ -0,0 +1,25 @@
+import pytest
+
+from src.backend.audit_rules import AuditRules
+
+
+@pytest.mark.parametrize("overrides", [
+    {"window": 0},
+    {"min_history": 0},
+    {"zscore_threshold": -1},
+    {"zscore_threshold": "3"},
+    {"velocity_window": 0},
+    {"amount_threshold": 1.5},
+    {"blacklist": "HACKER"},
+    {"blacklist": ["HACKER", 1]},
+    {"unknown": 1},
+])
+def test_with_overrides_rejects_invalid_parameters(overrides):
+    with pytest.raises(ValueError):
+        AuditRules().with_overrides(**overrides)
+
+
+def test_with_overrides_keeps_other_parameters():
+    rules = AuditRules().with_overrides(window=5, zscore_threshold=2, blacklist=["X-1"])
+    assert (rules.window, rules.zscore_threshold, rules.blacklist) == (5, 2, ("X-1",))
+    assert rules.min_history == AuditRules().min_history
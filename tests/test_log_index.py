@@ -0,0 +1,59 @@
+import pytest
+
+from src.backend.event_log import EVENT_LOG, EventLog
+from src.backend.log_index import LogIndex
+from src.backend.mock_bank import MockBank
+
+LINES = [
+    f"[10:00:{i % 60:02d}] [{'BankAPI' if i % 3 else 'Screening'}] Sent {1000 * (i % 7):,} JPY to {'AWS' if i % 2 else 'Azure'}"
+    for i in range(50)
+]
+
+
+def _fill(index):
+    for i, line in enumerate(LINES):
+        index.add(line, 1000.0 + i)
+    return index
+
+
+@pytest.mark.parametrize("query, start, end", [
+    ("", None, None),
+    ("vendor:aws", None, None),
+    ('"sent 3000 jpy" -actor:screening', None, None),
+    ("actor:bankapi azure", 1010.0, 1040.0),
+    ("amount:6000", 1045.0, None),
+    ("missing-term", None, None),
+])
+def test_spilled_index_matches_in_memory_index(tmp_path, query, start, end):
+    memory = _fill(LogIndex())
+    spilled = _fill(LogIndex(str(tmp_path), hot_limit=8, segment_lines=4))
+    assert spilled.stats()["segments"] == 11
+    expected = memory.search(query, start, end)
+    assert spilled.search(query, start, end).tolist() == expected.tolist()
+    assert spilled.timestamps(expected[::-1]) == memory.timestamps(expected[::-1])
+    assert spilled.stats()["postings"] == memory.stats()["postings"]
+
+
+def test_hot_postings_stay_bounded(tmp_path):
+    index = _fill(LogIndex(str(tmp_path), hot_limit=8, segment_lines=4))
+    assert len(index) == len(LINES)
+    assert index.stats()["lines"] == len(LINES)
+    assert index._ts.size <= 8
+    assert all(p[0] >= index._hot_start for p in index._postings.values())
+
+
+def test_bank_event_log_references_log_lines(monkeypatch):
+    monkeypatch.setenv("BANK_LOG_HOT_LIMIT", "4")
+    bank = MockBank.from_snapshot("test-event-refs")
+    for i in range(5):
+        bank.send_money("AWS", 1000 + i)
+    raw = [e for e in bank.events if e["kind"] == EVENT_LOG]
+    assert raw and all("line" not in e for e in raw)
+    joined = [e["line"] for e in bank.events.with_lines(bank.logs) if e["kind"] == EVENT_LOG]
+    assert joined == bank.get_logs()
+    assert bank.search_logs("amount:1004")["total"] == 1
+
+    bank.reset()
+    archive = bank.events.list_archives()[-1]
+    archived = [e["line"] for e in EventLog.iter_archive(archive) if e["kind"] == EVENT_LOG]
+    assert archived == joined
@@ -0,0 +1,25 @@
+from src.backend.log_store import SegmentedLog
+
+
+def _filled_log(tmp_path, lines=10):
+    log = SegmentedLog(directory=str(tmp_path), hot_limit=2, segment_lines=2)
+    for i in range(lines):
+        log.append(f"line-{i}")
+    return log
+
+
+def test_iter_range_survives_concurrent_archive(tmp_path):
+    log = _filled_log(tmp_path)
+    reader = log.iter_range(0, None)
+    assert next(reader) == "line-0"
+    assert log.archive() is not None
+    assert list(reader) == [f"line-{i}" for i in range(1, 10)]
+    assert len(log) == 0
+
+
+def test_get_many_reads_archived_segments(tmp_path):
+    log = _filled_log(tmp_path)
+    segments = list(log._segments)
+    log.archive()
+    log._segments = segments  # archive() 前に一覧を取得したリーダーを再現する
+    assert log.get_many([7, 1, 4]) == ["line-7", "line-1", "line-4"]
@@ -0,0 +1,50 @@
+import pytest
+
+from src.backend.ledger import Ledger
+from src.backend.mock_bank import MAIN_ACCOUNT, MockBank
+
+
+@pytest.mark.parametrize("amount", [-5000, 0, 10.5, True, "1000"])
+def test_send_money_rejects_invalid_amounts(amount):
+    bank = MockBank.from_snapshot("test-amounts")
+    result = bank.send_money("AWS", amount)
+    assert result.startswith("ERROR")
+    assert bank.balances[MAIN_ACCOUNT] == 10000000
+    assert len(bank.ledger.entries) == 1  # 期首残高のみ
+
+
+@pytest.mark.parametrize("amount", [-1, 0])
+def test_record_payment_rejects_non_positive_amounts(amount):
+    ledger = Ledger.from_balances({MAIN_ACCOUNT: 1000})
+    with pytest.raises(ValueError):
+        ledger.record_payment(MAIN_ACCOUNT, "AWS", amount)
+    assert ledger.balance(MAIN_ACCOUNT) == 1000
+
+
+@pytest.fixture
+def batch_bank(monkeypatch):
+    monkeypatch.setenv("SETTLEMENT_MODE", "batch")
+    monkeypatch.setenv("SETTLEMENT_WINDOW", "60")
+    bank = MockBank.from_snapshot("test-settlement")
+    bank.screener.mode = "off"
+    yield bank
+    bank.reset()
+
+
+def test_queue_reserves_pending_total(batch_bank):
+    assert batch_bank.send_money("AWS", 6000000).startswith("SUCCESS")
+    assert batch_bank._queue_payment("Azure", "MS-8765-4321", 5000000).startswith("ERROR")
+    assert batch_bank.settlement.pending_total == 6000000
+
+
+def test_settlement_posts_payments_that_fit(batch_bank):
+    batch_bank.send_money("AWS", 3000000)
+    batch_bank.send_money("Azure", 4000000)
+    batch_bank.send_money("Google", 2000000)
+    # 受付後に残高が減った場合（外部の出金など）
+    batch_bank.ledger.post([("VENDOR:Other", 5000000), (MAIN_ACCOUNT, -5000000)])
+    record = batch_bank.settle_pending()
+    assert [p["amount"] for p in record["allocations"]] == [3000000, 2000000]
+    assert [p["amount"] for p in record["failed"]] == [4000000]
+    assert batch_bank.balances[MAIN_ACCOUNT] == 0
+    assert any("rejected at settlement" in line and "Azure" in line for line in batch_bank.get_logs())
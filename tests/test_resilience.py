@@ -0,0 +1,40 @@
+import pytest
+
+from src.backend.resilience import CircuitBreaker, CircuitOpenError
+
+
+def _half_open_breaker():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.state == "open"
+    return breaker
+
+
+def test_half_open_allows_a_single_probe():
+    breaker = _half_open_breaker()
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.before_call() is False
+    assert breaker.before_call() is False
+
+
+def test_failed_probe_reopens_the_circuit():
+    breaker = _half_open_breaker()
+    breaker.reset_timeout = 60.0
+    breaker.opened_at -= 60.0
+    assert breaker.before_call() is True
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_abandoned_probe_lets_the_next_caller_probe():
+    breaker = _half_open_breaker()
+    probe = breaker.before_call()
+    breaker.abandon_probe(probe)
+    assert breaker.state == "half_open"
+    assert breaker.before_call() is True
@@ -0,0 +1,23 @@
+import pytest
+
+from src.backend.sessions import DEFAULT_SESSION, SessionManager
+
+
+def test_default_session_cannot_be_dropped():
+    manager = SessionManager()
+    bank = manager.get(DEFAULT_SESSION).bank
+    with pytest.raises(ValueError):
+        manager.drop(DEFAULT_SESSION)
+    assert manager.get(DEFAULT_SESSION).bank is bank
+    assert len(bank.logs) == len(bank.log_index)
+
+
+def test_drop_archives_logs_and_events():
+    manager = SessionManager()
+    bank = manager.get("test-drop").bank
+    bank.send_money("AWS", 1000)
+    assert manager.drop("test-drop")
+    assert len(bank.logs) == 0
+    assert len(bank.events) == 0
+    assert len(bank.events.list_archives()) == 1
+    assert not manager.drop("test-drop")
@@ -0,0 +1,36 @@
+from src.backend.mock_bank import MockBank
+from src.backend.tool_executor import plan_tool_calls
+
+
+def _call(name, vendor, **args):
+    return {"name": name, "args": {"vendor": vendor, **args}, "id": f"{name}-{vendor}"}
+
+
+def test_alias_and_canonical_name_share_a_group():
+    bank = MockBank.from_snapshot("test-plan-alias")
+    calls = [
+        _call("send_money", "AWS", amount=1000),
+        _call("update_account", "Amazon Web Services Inc.", new_account="AWS-0000-0001"),
+        _call("send_money", "Azure", amount=1000),
+    ]
+    assert sorted(plan_tool_calls(calls, bank)) == [[1, 0], [2]]
+
+
+def test_session_vendor_groups_with_its_later_payment():
+    bank = MockBank.from_snapshot("test-plan-session")
+    bank.update_account("Acme Web Studio", "ACME-0001")
+    calls = [
+        _call("send_money", "ACME WEB STUDIO Inc.", amount=1000),
+        _call("update_account", "Acme Web Studio", new_account="ACME-0002"),
+        _call("send_money", "AWS", amount=1000),
+    ]
+    assert sorted(plan_tool_calls(calls, bank)) == [[1, 0], [2]]
+
+
+def test_new_vendor_groups_before_it_is_added():
+    bank = MockBank.from_snapshot("test-plan-new")
+    calls = [
+        _call("update_account", "Nimbus Hosting", new_account="NIM-0001"),
+        _call("send_money", "NIMBUS HOSTING, Inc.", amount=1000),
+    ]
+    assert plan_tool_calls(calls, bank) == [[0, 1]]
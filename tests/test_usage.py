@@ -0,0 +1,37 @@
+from src.backend.context import current_context
+from src.backend.usage import UsageMeter
+
+
+def _record(meter, session_id, tokens=10):
+    with meter.run("secure", "ADMIN", session_id):
+        meter.check()
+        meter.record("llama-3.1-8b-instant", tokens, 0)
+
+
+def test_windows_are_bounded(monkeypatch):
+    monkeypatch.setenv("USAGE_MAX_WINDOWS", "5")
+    meter = UsageMeter()
+    for i in range(20):
+        _record(meter, f"s{i}")
+    assert len(meter._windows) == 5
+    assert ("session", "s19") in meter._windows
+
+
+def test_expired_windows_are_pruned_on_record(monkeypatch):
+    monkeypatch.setenv("USAGE_WINDOW", "10")
+    meter = UsageMeter()
+    clock = [1000.0]
+    monkeypatch.setattr("src.backend.usage.time.time", lambda: clock[0])
+    for i in range(3):
+        _record(meter, f"s{i}")
+    clock[0] += 11
+    _record(meter, "s-new")
+    assert set(meter._windows) == {("session", "s-new"), ("role", "ADMIN")}
+
+
+def test_check_does_not_create_windows():
+    meter = UsageMeter()
+    with meter.run("secure", "ADMIN", "idle"):
+        meter.check()
+    assert meter._windows == {}
+    assert current_context().budget is None
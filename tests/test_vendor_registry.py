@@ -0,0 +1,91 @@
+from src.backend.mock_bank import MockBank, vendor_registry
+from src.backend.vendor_registry import VendorRegistry
+
+
+def make_registry() -> VendorRegistry:
+    return VendorRegistry.from_vendors(["AWS", "Azure", "Google"])
+
+
+# --- VendorRegistry.resolve ---
+
+def test_resolve_exact_and_alias():
+    registry = make_registry()
+    assert registry.resolve("AWS").method == "exact"
+    match = registry.resolve("Amazon Web Services Inc.")
+    assert (match.vendor, match.method) == ("AWS", "alias")
+    assert registry.resolve("gcp", fuzzy=False).vendor == "Google"
+
+
+def test_strict_resolve_does_not_expand_acronyms():
+    registry = make_registry()
+    # 入力の頭字語 "aws" が登録名と一致しても、別の取引先へは解決しない
+    assert registry.resolve("Acme Web Studio", fuzzy=False) is None
+    assert registry.resolve("Amazon Web Srvices", fuzzy=False) is None
+
+
+def test_fuzzy_resolve_uses_acronyms_and_trigrams():
+    registry = make_registry()
+    assert registry.resolve("Amazon Web Srvices").vendor == "AWS"
+    assert registry.resolve("Microsoft Azure Cloud").vendor == "Azure"
+    assert registry.resolve("Completely Unrelated Vendor") is None
+
+
+def test_overlay_does_not_change_base():
+    registry = make_registry()
+    overlay = registry.overlay()
+    overlay.add_vendor("Acme Web Studio", ["Acme"])
+    assert "Acme Web Studio" in overlay and "AWS" in overlay
+    assert "Acme Web Studio" not in registry
+    assert len(overlay) == len(registry) + 1
+    assert overlay.resolve("acme inc.", fuzzy=False).vendor == "Acme Web Studio"
+    assert overlay.resolve("MS Azure", fuzzy=False).vendor == "Azure"
+    assert registry.resolve("acme", fuzzy=False) is None
+    assert [m.vendor for m in overlay.search("Acme Web Studios", limit=1)] == ["Acme Web Studio"]
+    # base の取引先へのあいまい解決も従来どおり
+    assert overlay.resolve("Amazon Web Srvices").vendor == "AWS"
+    assert overlay.aliases_of("Acme Web Studio") == ["acme web studio", "acme"]
+
+
+# --- MockBank ---
+
+def test_update_account_does_not_redirect_to_acronym_vendor():
+    bank = MockBank.from_snapshot("test-acronym")
+    result = bank.update_account("Acme Web Studio", "ACME-0001")
+    assert result.startswith("SUCCESS")
+    assert bank.accounts["AWS"] == "AWS-1234-5678"
+    assert bank.accounts["Acme Web Studio"] == "ACME-0001"
+
+
+def test_update_account_resolves_alias():
+    bank = MockBank.from_snapshot("test-alias")
+    bank.update_account("Amazon Web Services", "AWS-0000-0001")
+    assert bank.accounts["AWS"] == "AWS-0000-0001"
+    assert "Amazon Web Services" not in bank.accounts
+
+
+def test_added_vendor_stays_in_its_session():
+    bank = MockBank.from_snapshot("test-owner")
+    other = MockBank.from_snapshot("test-other")
+    bank.update_account("Acme Web Studio", "ACME-0001")
+    assert "Acme Web Studio" in bank.vendors
+    assert "Acme Web Studio" not in vendor_registry
+    assert "Acme Web Studio" not in other.vendors
+
+
+def test_read_only_resolution_does_not_log():
+    bank = MockBank.from_snapshot("test-readonly")
+    before = bank.log_version()
+    bank.get_account_history("Amazon Web Services")
+    assert bank.log_version() == before
+    bank.send_money("Amazon Web Services", 1000)
+    assert any("Resolved vendor name" in line for line in bank.get_logs())
+
+
+def test_send_money_refuses_near_miss_payee():
+    bank = MockBank.from_snapshot("test-near-miss")
+    for name in ("Acme Web Studio", "Atlas Web Systems", "Google Ads"):
+        result = bank.send_money(name, 1000)
+        assert result.startswith("ERROR: Vendor"), result
+        assert "Did you mean" in result
+    assert bank.balances["COMPANY_MAIN"] == 10000000
+    assert bank.send_money("Amazon Web Services Inc.", 1000).startswith("SUCCESS")